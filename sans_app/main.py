@@ -1,10 +1,6 @@
-from contextlib import closing
 import pandas
 from pathlib import Path
-import socket
 import streamlit as st
-import subprocess
-import sys
 import tempfile
 import uuid
 
@@ -24,25 +20,9 @@ if 'first_initialization' not in st.session_state:
     st.session_state['update_counter'] = 0
     st.session_state["user_sans_temp_dir"] = tempfile.mkdtemp()
 
-    # get free server port and start PSE server
-    with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
-        s.bind(('', 0))  # Bind to a free port provided by the host.
-        port = s.getsockname()[1]  # Return the port number assigned.
-    st.session_state['gp_server_port'] = port
-    st.session_state['gp_server_process'] = subprocess.Popen(
-        [
-            sys.executable,
-            "-c",
-            (
-                "import sys; "
-                "from scattertools.infotheory.entropy import Entropy_server; "
-                "Entropy_server().run(int(sys.argv[1]))"
-            ),
-            str(port),
-        ],
-        stdout=None,
-        stderr=None,
-    )
+    # identifies the session towards shared services such as the PSE server pool, which is only started once the
+    # Experimental Optimization page is used
+    st.session_state['session_id'] = str(uuid.uuid4())
 
 if st.session_state["data_folders_ready"]:
     df_folders = pandas.DataFrame({
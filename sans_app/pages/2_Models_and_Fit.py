@@ -1,9 +1,12 @@
-import hashlib
 import os
 from pathlib import Path
 import shutil
 import streamlit as st
 from sans_app.support import app_functions
+from sans_app.support import batch_fit
+from sans_app.support import caching
+from sans_app.support import fit_engine
+from sans_app.support import fit_jobs
 
 if not st.session_state["data_folders_ready"]:
     st.info("Files and Folders not set up. Please visit the File System tab.")
@@ -17,19 +20,6 @@ user_sans_temp_dir = Path(st.session_state['user_sans_temp_dir']).expanduser().r
 cfg = st.session_state['cfg']
 
 # ---- Functionality --------
-def _generate_key(path: Path) -> str:
-    """
-    Generates a unique key for a file path based on the file content
-    :param path: file path
-    :return: (str) key
-    """
-    chunk_size=8192
-    h = hashlib.sha256()
-    with path.open("rb") as f:
-        for chunk in iter(lambda: f.read(chunk_size), b""):
-            h.update(chunk)
-    return h.hexdigest()
-
 def add_par(parname, model_name, fitobj):
     fitobj.Interactor.fnReplaceParameterLimitsInSetup(parname, 0., 1., modify='add')
     shutil.copyfile(user_sans_fit_dir / model_name, user_sans_model_dir / model_name)
@@ -111,7 +101,7 @@ st.write("""
 with open(model_path / model_name) as f:
     model_txt = f.readlines()
 with st.expander("Edit Model Script"):
-    widget_key = _generate_key(model_path / model_name)
+    widget_key = caching.file_digest(model_path / model_name)
     txt = st.text_area(
         'Model Script', "".join(model_txt),
         key= widget_key,
@@ -174,26 +164,138 @@ if uploaded_file is not None:
         filelist = [uploaded_file]
     app_functions.load_sans_files(uploaded_file, user_sans_file_dir)
 
-col1_3, col1_4 = st.columns([1, 1])
+col1_3, col1_4, col1_5 = st.columns([1, 1, 1])
 col1_3.number_input('burn', format='%i', step=50, min_value=50, value=cfg.fit_mcmcburn, key='fit_burn')
 cfg.fit_mcmcburn = st.session_state.fit_burn
 col1_4.number_input('steps', format='%i', step=50, min_value=50, value=cfg.fit_mcmcsteps, key='fit_steps')
 cfg.fit_mcmcsteps = st.session_state.fit_steps
+col1_5.number_input('stop at R-hat', format='%.3f', step=0.01, min_value=0.0, value=cfg.fit_rhat_stop,
+                    key='fit_rhat_stop', help='Ends the MCMC early once the Gelman-Rubin statistic of all parameters '
+                                              'is below this value. 0 runs all steps.')
+cfg.fit_rhat_stop = st.session_state.fit_rhat_stop
+st.checkbox('warm start', value=cfg.fit_warm_start, key='fit_warm_start',
+            help='Starts from the closest earlier result with the same parameters. The burn-in is cut to a quarter '
+                 'if that result used the same model script or the same data.')
+cfg.fit_warm_start = st.session_state.fit_warm_start
+with st.expander('Parallel evaluation'):
+    col1_6, col1_7 = st.columns([1, 1])
+    mappers = list(fit_engine.MAPPERS)
+    col1_6.selectbox('mapper', mappers, index=mappers.index(cfg.fit_mapper) if cfg.fit_mapper in mappers else 0,
+                     key='fit_mapper', help='Evaluates the DREAM population serially, in threads or in processes.')
+    cfg.fit_mapper = st.session_state.fit_mapper
+    col1_7.number_input('workers', format='%i', step=1, min_value=0, value=cfg.fit_workers, key='fit_workers',
+                        help='0 uses ' + str(fit_jobs.DEFAULT_FIT_WORKERS) + ' workers per fit, sharing the cores '
+                             'between ' + str(fit_jobs.MAX_CONCURRENT_FITS) + ' concurrent fits.')
+    cfg.fit_workers = st.session_state.fit_workers
 
 if st.button('Run Fit'):
     if model_name is not None and uploaded_file is not None:
         datafile_names_uploaded = [file.name for file in uploaded_file]
-        app_functions.run_fit(fitdir=str(user_sans_fit_dir), runfile=model_name, datafile_names=datafile_names,
-                              datafile_names_uploaded=datafile_names_uploaded, file_dir=str(user_sans_file_dir),
-                              model_dir=str(user_sans_model_dir), burn=cfg.fit_mcmcburn, steps=cfg.fit_mcmcsteps)
-        # zip fit folder for download
-        st.info('Zipping the fit ...')
-        shutil.make_archive(os.path.join(user_sans_temp_dir, 'fit'), 'zip', user_sans_fit_dir)
-        with open(os.path.join(user_sans_temp_dir, 'fit.zip'), "rb") as file:
-            btn2 = st.download_button(
-                label='Download  Fit',
-                data=file,
-                file_name='fit.zip',
-                mime=None
-            )
+        job_id = app_functions.run_fit(fitdir=str(user_sans_fit_dir), runfile=model_name,
+                                       datafile_names=datafile_names, datafile_names_uploaded=datafile_names_uploaded,
+                                       file_dir=str(user_sans_file_dir), model_dir=str(user_sans_model_dir),
+                                       burn=cfg.fit_mcmcburn, steps=cfg.fit_mcmcsteps, rhat_stop=cfg.fit_rhat_stop,
+                                       mapper=cfg.fit_mapper, workers=cfg.fit_workers,
+                                       warm_start=cfg.fit_warm_start)
+        if job_id is not None:
+            st.session_state['fit_job_select'] = job_id
+
+st.write("""
+# Fit Jobs
+""")
+
+
+def job_active(job):
+    return job is not None and job['status'] in ('queued', 'running')
+
+
+# poll for progress only while the selected fit is queued or running; run_every is fixed at a full rerun, so the
+# fragments rerun the app once the state they poll for changes
+fit_job_polling = job_active(fit_jobs.get_job(user_sans_fit_dir, st.session_state['fit_job_select'])
+                             if st.session_state.get('fit_job_select') else None)
 
+
+@st.fragment(run_every=2 if fit_job_polling else None)
+def fit_job_monitor():
+    jobs = fit_jobs.list_jobs(user_sans_fit_dir)
+    if not jobs:
+        st.info('No fits yet.')
+        return
+    job_ids = [job['job_id'] for job in jobs]
+    if st.session_state.get('fit_job_select') not in job_ids:
+        st.session_state['fit_job_select'] = job_ids[0]
+    labels = {job['job_id']: job['job_id'] + ' - ' + job['runfile'] + ' (' + job['status'] + ')' for job in jobs}
+    job_id = st.selectbox('Fit', job_ids, format_func=lambda x: labels[x], key='fit_job_select')
+    if job_active(fit_jobs.get_job(user_sans_fit_dir, job_id)) != fit_job_polling:
+        st.rerun(scope='app')
+    st.caption(str(fit_jobs.running_jobs()) + ' of ' + str(fit_jobs.MAX_CONCURRENT_FITS) +
+               ' fit slots in use on this server.')
+    app_functions.show_fit_job(str(user_sans_fit_dir), job_id, str(user_sans_temp_dir))
+
+
+fit_job_monitor()
+
+st.write("""
+# Batch Fit
+""")
+st.write('Fits the selected model to every data file in the user file folder that matches a pattern. Each file '
+         'replaces the first data file of the model script.')
+col1_8, col1_9 = st.columns([2, 1])
+pattern = col1_8.text_input('file pattern', value=cfg.fit_batch_pattern, key='fit_batch_pattern',
+                            help="e.g. 'sample_T*.ABS'")
+cfg.fit_batch_pattern = st.session_state.fit_batch_pattern
+batch_files = batch_fit.match_files(user_sans_file_dir, pattern) if pattern else []
+col1_9.metric('matching files', len(batch_files))
+if st.button('Run Batch Fit', disabled=not batch_files or model_name is None):
+    try:
+        batch_id = batch_fit.submit_batch(user_sans_fit_dir, model_name, user_sans_model_dir, user_sans_file_dir,
+                                          pattern, burn=cfg.fit_mcmcburn, steps=cfg.fit_mcmcsteps,
+                                          rhat_stop=cfg.fit_rhat_stop, mapper=cfg.fit_mapper, workers=cfg.fit_workers,
+                                          warm_start=cfg.fit_warm_start)
+        st.session_state['fit_batch_select'] = batch_id
+    except (ValueError, OSError) as exc:
+        st.error(str(exc))
+
+
+def batch_active(batch_id):
+    if batch_id is None:
+        return False
+    df_batch = batch_fit.batch_table(user_sans_fit_dir, batch_id)
+    return not df_batch.empty and not df_batch['status'].isin(fit_jobs.FINISHED_STATES +
+                                                              (batch_fit.UNSUBMITTED,)).all()
+
+
+# poll only while the selected batch has fits left, see fit_job_polling
+batch_polling = batch_active(st.session_state.get('fit_batch_select'))
+
+
+@st.fragment(run_every=2 if batch_polling else None)
+def batch_monitor():
+    batches = batch_fit.list_batches(user_sans_fit_dir)
+    if not batches:
+        st.info('No batch fits yet.')
+        return
+    batch_ids = [batch['batch_id'] for batch in batches]
+    if st.session_state.get('fit_batch_select') not in batch_ids:
+        st.session_state['fit_batch_select'] = batch_ids[0]
+    labels = {b['batch_id']: b['batch_id'] + ' - ' + b['model'] + ' on ' + b['pattern'] + ' (' + str(len(b['items']))
+              + ' files)' for b in batches}
+    batch_id = st.selectbox('Batch', batch_ids, format_func=lambda x: labels[x], key='fit_batch_select')
+    batch = batches[batch_ids.index(batch_id)]
+    if batch.get('error'):
+        st.error('Submitting the batch failed: ' + batch['error'])
+    df_batch = batch_fit.batch_table(user_sans_fit_dir, batch_id)
+    finished = df_batch['status'].isin(fit_jobs.FINISHED_STATES + (batch_fit.UNSUBMITTED,)).sum()
+    if (finished < len(df_batch)) != batch_polling:
+        st.rerun(scope='app')
+    st.progress(finished / len(df_batch), text=str(finished) + ' of ' + str(len(df_batch)) + ' fits finished')
+    st.dataframe(df_batch, hide_index=True)
+    col1, col2 = st.columns([1, 1])
+    col1.download_button('Download Table', data=df_batch.to_csv(index=False), file_name='batch_' + batch_id + '.csv',
+                         mime='text/csv', key='download_batch_' + batch_id)
+    if finished < len(df_batch):
+        col2.button('Cancel Batch', on_click=batch_fit.cancel_batch, args=[user_sans_fit_dir, batch_id],
+                    key='cancel_batch_' + batch_id)
+
+
+batch_monitor()
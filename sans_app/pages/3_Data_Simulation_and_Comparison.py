@@ -2,12 +2,16 @@ import numpy
 import os
 import pandas
 from pathlib import Path
-import plotly.graph_objects as go
-from scattertools.support import api_sasview
-import shutil
 import streamlit as st
 from sans_app.support import app_functions
+from sans_app.support import caching
+from sans_app.support import config_store
+from sans_app.support import plotting
+from sans_app.support import simulation
 import tempfile
+from sans_app.support.lazy import lazy_import
+
+api_sasview = lazy_import('scattertools.support.api_sasview')
 
 if not st.session_state["data_folders_ready"]:
     st.info("Files and Folders not set up. Please visit the File System tab.")
@@ -88,10 +92,7 @@ def column_simulate_data(column_number=None, col=None, model_list=None, config_l
 
         configurations = []
         if config_list is not None:
-            for entry in config_list:
-                df_config = pandas.read_json(os.path.join(config_path, entry), orient='record')
-                config_dict = df_config.set_index('setting').T.to_dict('records')
-                configurations.append(config_dict[0])
+            configurations = config_store.get_store(user_sans_config_dir).configurations(config_list)
 
         # create a new series of data files called sim.dat or simX.dat
         # one configuration per dataset
@@ -105,25 +106,69 @@ def column_simulate_data(column_number=None, col=None, model_list=None, config_l
                 new_file_list.append('sim' + str(i) + '.dat')
                 # the same configuration per dataset
                 dataset_configurations.append(configurations)
-        api_sasview.write_data_filenames_to_runfile(runfile=str(temp_dir / model_name), filelist=new_file_list)
+        # point the temporary copy of the script to the simulated data files, unless it already does
+        runfile_sim = temp_dir / model_name
+        if list(api_sasview.extract_data_filenames_from_runfile(runfile=str(runfile_sim))) != new_file_list:
+            api_sasview.write_data_filenames_to_runfile(runfile=str(runfile_sim), filelist=new_file_list)
         for filename in new_file_list:
-            api_sasview.write_dummy_sans_file(filename)
+            if not (temp_dir / filename).is_file():
+                api_sasview.write_dummy_sans_file(str(temp_dir / filename))
 
         if configurations:
-            liData = fitobj.fnSimulateData(basefilename='sim.dat', liConfigurations=dataset_configurations, qmin=qmin,
-                                           qmax=qmax, t_total=None, simpar=simpar_edited, average=average)
-            for i in range(len(liData)):
-                sans_graphs.append([liData[i][1], new_file_list[i]])
+            # reruns caused by widgets that do not affect the simulation are served from the cache
+            key = simulation.simulation_key(Path(user_sans_model_dir) / model_name, simpar_edited, configurations,
+                                            qmin, qmax, average, len(new_file_list))
+            disk_dir = caching.cache_dir(user_sans_fit_dir, 'simulations') if cfg.sim_disk_cache else None
+            cached = simulation.simulation_cache.get(key, disk_dir=disk_dir)
+            if cached is None:
+                liData = fitobj.fnSimulateData(basefilename='sim.dat', liConfigurations=dataset_configurations,
+                                               qmin=qmin, qmax=qmax, t_total=None, simpar=simpar_edited,
+                                               average=average)
+                datasets = [data[1] for data in liData]
+                simulation.simulation_cache.put(key, simulation.pack_datasets(datasets), disk_dir=disk_dir)
+            else:
+                datasets = simulation.unpack_datasets(cached)
+            for i in range(len(datasets)):
+                sans_graphs.append([datasets[i], new_file_list[i]])
+            sans_graphs += column_parameter_sweep(cns, col, temp_dir, model_name, new_file_list, simpar_edited,
+                                                  [datasets])
 
             if col.button("Copy simulated data to user directory.", key='simulation_copy_btn'+cns):
-                for file in new_file_list:
-                    shutil.copyfile(os.path.join(user_sans_temp_dir, file), os.path.join(user_sans_file_dir, file))
+                for i, file in enumerate(new_file_list):
+                    simulation.write_sans_file(datasets[i], os.path.join(user_sans_file_dir, file))
         else:
             col.info('Select configuration!')
 
     return sans_graphs
 
 
+def column_parameter_sweep(cns, col, fit_dir, model_name, file_list, simpar, templates):
+    """
+    Simulates a series of values of one parameter on the Q-grids of the column's simulation in a single batch.
+    """
+    sans_graphs = []
+    exp = col.expander('Parameter sweep')
+    par = exp.selectbox('Parameter', simpar['par'], key='simulation_sweep_par' + cns)
+    value = float(simpar.loc[simpar['par'] == par, 'value'].iloc[0])
+    col_a, col_b, col_c = exp.columns([1, 1, 1])
+    lower = col_a.number_input('from', value=0.5 * value, format='%g', key='simulation_sweep_lower' + cns + par)
+    upper = col_b.number_input('to', value=1.5 * value, format='%g', key='simulation_sweep_upper' + cns + par)
+    num = col_c.number_input('steps', min_value=2, max_value=50, value=5, key='simulation_sweep_num' + cns)
+    if not exp.toggle('Show sweep', key='simulation_sweep_show' + cns):
+        return sans_graphs
+
+    reference = simulation.simpar_to_parameter_sets(simpar)
+    values = numpy.linspace(lower, upper, int(num))
+    parameter_sets = pandas.concat([reference] * len(values), ignore_index=True)
+    parameter_sets[par] = values
+    problem = simulation.get_problem(fit_dir, model_name, file_list)
+    batch = simulation.simulate_batch(problem, templates, parameter_sets, reference)
+    for i, dataset in enumerate(batch[0]):
+        for n, v in enumerate(values):
+            sans_graphs.append([simulation.batch_to_dataframe(dataset, n), file_list[i] + ' ' + par + '=' + f'{v:g}'])
+    return sans_graphs
+
+
 def create_non_default_configuration(default, modifier):
     modifier = modifier.strip()
     if modifier == '':
@@ -136,7 +181,7 @@ def create_non_default_configuration(default, modifier):
     splitpath = os.path.splitext(default)
     config_name = splitpath[0] + '_' + modifier + splitpath[1]
     if not os.path.isfile(os.path.join(user_sans_config_dir, config_name)):
-        shutil.copyfile(os.path.join(user_sans_config_dir, default), os.path.join(user_sans_config_dir, config_name))
+        config_store.get_store(user_sans_config_dir).copy(default, config_name)
         st.info('Created new configuration ' + config_name + ' from ' + default + ' .')
     else:
         st.info('Switching to existing configuration ' + config_name + ' .')
@@ -147,16 +192,14 @@ def create_non_default_configuration(default, modifier):
 
 def load_config(file):
     try:
-        with open(os.path.join(user_sans_config_dir, file.name), "wb") as f:
-            f.write(file.getbuffer())
+        config_store.get_store(user_sans_config_dir).write_bytes(file.name, bytes(file.getbuffer()))
         st.session_state['sans_config_selectbox'] = file.name
     except IOError:
         pass
 
 
 def remove_configuration(name):
-    if os.path.isfile(os.path.join(user_sans_config_dir, name)):
-        os.remove(os.path.join(user_sans_config_dir, name))
+    if config_store.get_store(user_sans_config_dir).delete(name):
         st.info('Removed configuration ' + name + ' .')
     remove_key_exp_data_frame_edit()
 
@@ -167,72 +210,100 @@ def remove_key_exp_data_frame_edit():
 
 
 def save_config(df, fname):
-    df.to_json(os.path.join(user_sans_config_dir, fname), orient='records')
-
-
-# ------------  GUI -------------------
-file_path = user_sans_file_dir
-file_list = os.listdir(file_path)
-file_list = sorted(element for element in file_list if element[0] != '.')
-
-model_path = user_sans_model_dir
-model_list = os.listdir(model_path)
-model_list = sorted([element for element in model_list if '.py' in element])
-
-configfile_names = None
-config_path = user_sans_config_dir
-config_list = os.listdir(config_path)
-config_list = sorted([element for element in config_list if '.json' in element])
-
-
-if 'sans_config_selectbox' in st.session_state:
-    if st.session_state.sans_config_selectbox not in config_list:
-        # it got deleted via the remove button
-        st.session_state.sans_config_selectbox = None
-
-if 'sans_config_modifier' in st.session_state and 'sans_config_selectbox' in st.session_state:
-    config_name = create_non_default_configuration(st.session_state.sans_config_selectbox,
-                                                   st.session_state.sans_config_modifier)
-    st.session_state.sans_config_selectbox = config_name
-    st.session_state.sans_config_modifier = ''
-
-# repeat in case there were changes
-config_path = user_sans_config_dir
-config_list = os.listdir(config_path)
-config_list = [element for element in config_list if '.json' in element]
-config_list = sorted(config_list)
-
-
-st.write("""
-# Instrument Configurations
-""")
-
-with st.expander('Edit'):
-    uploaded_config = st.file_uploader("Upload", type=['json'])
-    if uploaded_config is not None:
-        load_config(uploaded_config)
-
-    col1_a, col1_b, = st.columns([1.2, 1])
-
-    if cfg.sim_config_name in config_list:
-        indx = config_list.index(cfg.sim_config_name)
-    else:
-        cfg.sim_config_name = None
-        indx = None
-    config_name = col1_a.selectbox("Select configuration", config_list, index=indx)
-    if config_name is None:
-        st.info('Please upload and/or select a configuration. You can also populate the configuration folder with '
-                'examples via the File System Tab.')
+    """
+    :return: (bool) whether the configuration changed and was written
+    """
+    return config_store.get_store(user_sans_config_dir).save(fname, df)
+
+
+def fragment_rerun_only(name):
+    """
+    Tells whether a fragment runs on its own, as opposed to within a rerun of the whole page. Fragments that change
+    data used elsewhere on the page rerun the page only in the former case.
+
+    :param name: (str) identifies the fragment
+    :return: (bool) True for a rerun of the fragment only
+    """
+    key = 'sim_fragment_run_' + name
+    alone = st.session_state.get(key) == st.session_state['sim_page_run']
+    st.session_state[key] = st.session_state['sim_page_run']
+    return alone
+
+
+def graphs_digest(graphs):
+    return caching.digest([[[g[0][c].to_numpy(dtype=float) for c in ('Q', 'I', 'dI', 'dQ')], g[1]] for g in graphs])
+
+
+@st.fragment
+def data_column(column_number, file_list, model_list, config_list):
+    """
+    One data column, rerun on its own when its widgets change. The datasets of the column are kept in the session
+    state for the plots, which are only redrawn by rerunning the page if the datasets changed.
+    """
+    cns = str(column_number)
+    alone = fragment_rerun_only('column' + cns)
+    st.radio("Source Data " + cns, ("Load File", "Simulate Data"), key='sim_choice' + cns)
+    st.divider()
+    sans_graphs = []
+    if st.session_state['sim_choice' + cns] == 'Load File':
+        ds, file_name = column_load_file(column_number=column_number, col=st, file_list=file_list)
+        if ds is not None:
+            sans_graphs = [[ds, file_name]]
     else:
+        sans_graphs = column_simulate_data(column_number=column_number, col=st, model_list=model_list,
+                                           config_list=config_list)
+
+    digest = graphs_digest(sans_graphs)
+    changed = digest != st.session_state.get('sim_graphs_digest' + cns)
+    st.session_state['sim_graphs' + cns] = sans_graphs
+    st.session_state['sim_graphs_digest' + cns] = digest
+    if changed and alone:
+        st.rerun(scope='app')
+
+
+@st.fragment
+def configuration_editor(config_list):
+    """
+    The instrument configuration editor, rerun on its own when its widgets change. The page is only rerun if a
+    configuration was written, created or deleted.
+    """
+    alone = fragment_rerun_only('configurations')
+    if 'sans_config_modifier' in st.session_state and 'sans_config_selectbox' in st.session_state:
+        config_name = create_non_default_configuration(st.session_state.sans_config_selectbox,
+                                                       st.session_state.sans_config_modifier)
+        st.session_state.sans_config_selectbox = config_name
+        st.session_state.sans_config_modifier = ''
+
+    with st.expander('Edit'):
+        uploaded_config = st.file_uploader("Upload", type=['json'])
+        if uploaded_config is not None:
+            load_config(uploaded_config)
+        if alone and config_store.get_store(user_sans_config_dir).names() != config_list:
+            # the configuration selections of the data columns need the new list
+            st.rerun(scope='app')
+
+        col1_a, col1_b, = st.columns([1.2, 1])
+
+        if cfg.sim_config_name in config_list:
+            indx = config_list.index(cfg.sim_config_name)
+        else:
+            cfg.sim_config_name = None
+            indx = None
+        config_name = col1_a.selectbox("Select configuration", config_list, index=indx)
+        if config_name is None:
+            st.info('Please upload and/or select a configuration. You can also populate the configuration folder '
+                    'with examples via the File System Tab.')
+            return
+
         if config_name != cfg.sim_config_name:
             cfg.sim_config_name = config_name
             cfg.save()
             remove_key_exp_data_frame_edit()
 
-        btn_remove = col1_a.button("Delete", on_click=remove_configuration, args=[config_name])
-        name_modifier = col1_b.text_input('Create or switch to copy with extension', '', key='sans_config_modifier')
+        col1_a.button("Delete", on_click=remove_configuration, args=[config_name])
+        col1_b.text_input('Create or switch to copy with extension', '', key='sans_config_modifier')
         with open(os.path.join(user_sans_config_dir, str(config_name)), "rb") as file:
-            btn = col1_b.download_button(
+            col1_b.download_button(
                 label="Download",
                 data=file,
                 file_name=config_name,
@@ -245,87 +316,55 @@ with st.expander('Edit'):
         # requires to remove key from session_state when changing config to edit
 
         if 'exp_data_frame_config' not in st.session_state:
-            df_config = pandas.read_json(os.path.join(config_path, str(config_name)), orient='record')
+            df_config = config_store.get_store(user_sans_config_dir).frame(str(config_name))
             st.session_state.exp_data_frame_config = st.data_editor(df_config, width='stretch')
             df_config_edited = st.session_state.exp_data_frame_config
         else:
             df_config_edited = st.data_editor(st.session_state.exp_data_frame_config, width='stretch')
 
-        save_config(df_config_edited, config_name)
+        # only real edits are written, and only they affect the simulations of the data columns
+        if save_config(df_config_edited, config_name) and alone:
+            st.rerun(scope='app')
+
+
+# ------------  GUI -------------------
+file_path = user_sans_file_dir
+file_list = os.listdir(file_path)
+file_list = sorted(element for element in file_list if element[0] != '.')
+
+model_path = user_sans_model_dir
+model_list = os.listdir(model_path)
+model_list = sorted([element for element in model_list if '.py' in element])
+
+configfile_names = None
+config_list = config_store.get_store(user_sans_config_dir).names()
 
 
+if 'sans_config_selectbox' in st.session_state:
+    if st.session_state.sans_config_selectbox not in config_list:
+        # it got deleted via the remove button
+        st.session_state.sans_config_selectbox = None
+
+# counts the reruns of the whole page, see fragment_rerun_only()
+st.session_state['sim_page_run'] = st.session_state.get('sim_page_run', 0) + 1
+
+st.write("""
+# Instrument Configurations
+""")
+configuration_editor(config_list)
+
 st.write("""
     # Simulate and Compare Data
     """)
 
 col_data1, col_data2 = st.columns([1, 1])
-
-# ----------- data column 1 ----------
-col_data1.radio("Source Data 1", ("Load File", "Simulate Data"), key='sim_choice1')
-col_data1.divider()
-sans_graphs1 = sans_graphs2 = []
-
-if st.session_state.sim_choice1 == 'Load File':
-    ds1, file_name1 = column_load_file(column_number=1, col=col_data1, file_list=file_list)
-    if ds1 is not None:
-        sans_graphs1 = [[ds1, file_name1]]
-else:
-    sans_graphs1 = column_simulate_data(column_number=1, col=col_data1, model_list=model_list, config_list=config_list)
-
-# ----------- data column 2 ----------
-col_data2.radio("Source Data 2", ("Load File", "Simulate Data"), key='sim_choice2')
-col_data2.divider()
-if st.session_state.sim_choice2 == 'Load File':
-    ds2, file_name2 = column_load_file(column_number=2, col=col_data2, file_list=file_list)
-    if ds2 is not None:
-        sans_graphs2 = [[ds2, file_name2]]
-else:
-    sans_graphs2 = column_simulate_data(column_number=2, col=col_data2, model_list=model_list, config_list=config_list)
-
-fig = go.Figure()
-if sans_graphs1:
-    for g in sans_graphs1:
-        fig.add_trace(go.Scatter(x=g[0]['Q'], y=g[0]['I'], mode='markers',
-                                 error_y=dict(type='data', array=g[0]['dI'], visible=True), name='1 - '+g[1]))
-if sans_graphs2:
-    for g in sans_graphs2:
-        fig.add_trace(go.Scatter(x=g[0]['Q'], y=g[0]['I'], mode='markers',
-                                 error_y=dict(type='data', array=g[0]['dI'], visible=True), name='2 - '+g[1]))
-fig.update_xaxes(type="log", ticks='inside', showgrid=True, showline=True, linewidth=2, mirror=True,
-                 title_text='Momentum transfer (1/Å)')
-fig.update_yaxes(type="log", ticks='inside', showgrid=True, showline=True, linewidth=2, mirror=True,
-                 title_text='Intensity (1/cm)')
-fig['data'][0]['showlegend'] = True
-st.plotly_chart(fig, width='stretch')
-
-fig = go.Figure()
-if sans_graphs1:
-    for g in sans_graphs1:
-        y_result = numpy.divide(g[0]['dI'], g[0]['I'], out=numpy.zeros_like(g[0]['dI']), where=g[0]['I']!=0)
-        fig.add_trace(go.Scatter(x=g[0]['Q'], y=y_result, mode='markers', name='1 - '+g[1]))
-if sans_graphs2:
-    for g in sans_graphs2:
-        y_result = numpy.divide(g[0]['dI'], g[0]['I'], out=numpy.zeros_like(g[0]['dI']), where=g[0]['I'] != 0)
-        fig.add_trace(go.Scatter(x=g[0]['Q'], y=y_result, mode='markers', name='2 - '+g[1]))
-fig.update_xaxes(type="log", ticks='inside', showgrid=True, showline=True, linewidth=2, mirror=True,
-                 title_text='Momentum transfer (1/Å)')
-fig.update_yaxes(type="log", ticks='inside', showgrid=True, showline=True, linewidth=2, mirror=True,
-                 title_text='dI / I')
-fig['data'][0]['showlegend'] = True
-st.plotly_chart(fig, width='stretch')
-
-fig = go.Figure()
-if sans_graphs1:
-    for g in sans_graphs1:
-        y_result = numpy.divide(g[0]['dQ'], g[0]['Q'], out=numpy.zeros_like(g[0]['dQ']), where=g[0]['Q']!=0)
-        fig.add_trace(go.Scatter(x=g[0]['Q'], y=y_result, mode='markers', name='1 - '+g[1]))
-if sans_graphs2:
-    for g in sans_graphs2:
-        y_result = numpy.divide(g[0]['dQ'], g[0]['Q'], out=numpy.zeros_like(g[0]['dQ']), where=g[0]['Q']!=0)
-        fig.add_trace(go.Scatter(x=g[0]['Q'], y=y_result, mode='markers', name='2 - '+g[1]))
-fig.update_xaxes(type="log", ticks='inside', showgrid=True, showline=True, linewidth=2, mirror=True,
-                 title_text='Momentum transfer (1/Å)')
-fig.update_yaxes(type="log", ticks='inside', showgrid=True, showline=True, linewidth=2, mirror=True,
-                 title_text='dQ / Q')
-fig['data'][0]['showlegend'] = True
-st.plotly_chart(fig, width='stretch')
\ No newline at end of file
+with col_data1:
+    data_column(1, file_list, model_list, config_list)
+with col_data2:
+    data_column(2, file_list, model_list, config_list)
+sans_graphs1 = st.session_state.get('sim_graphs1', [])
+sans_graphs2 = st.session_state.get('sim_graphs2', [])
+
+graphs = [(g[0], '1 - ' + g[1]) for g in sans_graphs1] + [(g[0], '2 - ' + g[1]) for g in sans_graphs2]
+for fig in plotting.comparison_figures(graphs):
+    st.plotly_chart(fig, width='stretch')
@@ -5,103 +5,58 @@ import streamlit as st
 import uuid
 
 from sans_app.support import app_functions
+from sans_app.support import caching
+from sans_app.support import config_store
 from sans_app.support import configuration
+from sans_app.support import design_grid
+from sans_app.support import entropy_server
+from sans_app.support import pse_setup
+from sans_app.support.lazy import lazy_import
 
-from scattertools.support import api_sasview
 from pse.streamlit_components import (start_of_script_business, monitor, run_control, pse_directory,
                                       end_of_script_business)
 
+api_sasview = lazy_import('scattertools.support.api_sasview')
+
 # ------------ Functionality -----------
 
-def adjust_consecutive_configurations():
-    if len(st.session_state['df_opt_config']) > 1:
-        for j in range(1, len(st.session_state['df_opt_config'])):
-            change_flag = False
-            # shorthand handles
-            df0 = st.session_state['df_opt_config_edited'][0]
-            dfj = st.session_state['df_opt_config_edited'][j]
-            # modify successive configurations if any setting is shared with first configuration
-            for par in df0.index.values:
-                # copy a shared setting from the first to consecutive dataframes
-                if par in dfj.index and bool(df0.loc[par, "shared"]) and not bool(dfj.loc[par, "shared"]):
-                    dfj.loc[par, :] = df0.loc[par, :]
-                    change_flag = True
-                if par in dfj.index and bool(df0.loc[par, "shared"]) and bool(dfj.loc[par, "shared"]):
-                    if not dfj.loc[par, :].equals(df0.loc[par, :]):
-                        dfj.loc[par, :] = df0.loc[par, :]
-                        change_flag = True
-                if par in dfj.index and not bool(df0.loc[par, "shared"]) and bool(dfj.loc[par, "shared"]):
-                    dfj.loc[par, :] = st.session_state['df_opt_config_original'][j].loc[par, :]
-                    change_flag = True
-            if change_flag:
-                # change key of data editor associated with that particular data frame
-                st.session_state['df_opt_config_key'][j] = str(uuid.uuid4())
-                st.session_state['df_opt_config'][j] = dfj
-                st.session_state['df_opt_config_edited'][j] = dfj
+def adjust_consecutive_configurations(targets=None):
+    """
+    Copies settings shared in the first configuration to consecutive configurations, see
+    pse_setup.propagate_shared(). Configurations that changed get a new data editor key.
+
+    :param targets: (list) indices of the configurations to update, all but the first if None
+    """
+    changed = pse_setup.propagate_shared(st.session_state['df_opt_config_edited'],
+                                         st.session_state['df_opt_config_original'], targets)
+    for j in changed:
+        # change key of data editor associated with that particular data frame
+        st.session_state['df_opt_config_key'][j] = str(uuid.uuid4())
+        st.session_state['df_opt_config'][j] = st.session_state['df_opt_config_edited'][j]
+
 
 def summarize_optimization_parameter_settings():
-    li_summary = []
-    dfb = st.session_state['opt_background']
-
-    # add model parameters
-    for index, row in st.session_state['opt_parameters'].iterrows():
-        parname = index
-        # ["value", "lowerlimit", "upperlimit", "relative", "lower_opt", "upper_opt", "optimize"]
-        if row['type'] == 'information':
-            partype = 'd'
-        else:
-            partype = 'i'
-        if not row['relative']:
-            partype = 'f' + partype
-
-        if index in dfb['source'].values:
-            dataset = str(dfb.loc[dfb['source'] == index, 'dataset'].at[0])
-            parconfig = '*'
-        elif index in dfb['sink'].values:
-            dataset = 'b'+str(dfb.loc[dfb['sink'] == index, 'dataset'].at[0])
-            parconfig = '*'
-        else:
-            dataset = '-'
-            parconfig = '-'
-
-        if row['optimize']:
-            lower_opt = str(row['lower_opt'])
-            upper_opt = str(row['upper_opt'])
-            step_opt = str(row['step_opt'])
-        else:
-            lower_opt = None
-            upper_opt = None
-            step_opt = None
-        li_summary.append([partype, dataset, parconfig, parname, row['value'], row['lowerlimit'], row['upperlimit'],
-                           lower_opt, upper_opt, step_opt])
-
-    # add configuration settings
-    df0 = st.session_state['df_opt_config_edited'][0]
-    num_config = len(st.session_state['df_opt_config_edited'])
-    for i, config in enumerate(st.session_state['df_opt_config_edited']):
-        for index, row in config.iterrows():
-            parname = index
-            if parname in df0.index.values and (num_config == 1 or df0.loc[index, 'shared']):
-                parconfig = '*'
-            else:
-                parconfig = str(i)
-            if row['optimize']:
-                lfit = ufit = 0.
-                lower_opt = row['lower_opt']
-                upper_opt = row['upper_opt']
-                step_opt = row['step_opt']
-            else:
-                lfit = ufit = lower_opt = upper_opt = step_opt = None
+    return pse_setup.summarize(st.session_state['pse_setup_tracker'], st.session_state['opt_parameters'],
+                               st.session_state['opt_background'], st.session_state['df_opt_config_edited'])
 
-            li_summary.append(['n', '*', parconfig, parname, row['value'], lfit, ufit, lower_opt, upper_opt, step_opt])
 
-    columns = pandas.Index(['type', 'dataset', 'config.', 'parameter', 'value', 'l_fit', 'u_fit', 'l_opt', 'u_opt',
-                            'step_opt'])
-    df_summary = pandas.DataFrame(li_summary, columns=columns)
-    # remove shared configuration parameters that end up being exact duplicate rows
-    df_summary = df_summary.drop_duplicates()
+def persist_setup_table(field_name, frames):
+    """
+    Stores setup dataframes as JSON records in the app configuration. Only tables that changed since the last rerun
+    are converted, and the configuration field is only assigned if any of them did.
 
-    return df_summary
+    :param field_name: (str) the DataManagerConfig field
+    :param frames: (list) the dataframes
+    """
+    tracker = st.session_state['pse_setup_tracker']
+    records = list(getattr(cfg, field_name) or [])[:len(frames)]
+    records += [None] * (len(frames) - len(records))
+    dirty = len(records) != len(getattr(cfg, field_name) or [])
+    for i, df in enumerate(frames):
+        records[i], rebuilt = tracker.derive((field_name, i), lambda: pse_setup.to_records(df), df)
+        dirty = dirty or rebuilt
+    if dirty:
+        setattr(cfg, field_name, records)
 
 
 def update_df_config(config_list_select):
@@ -117,11 +72,10 @@ def update_df_config(config_list_select):
 
     df_config = []          # for streamlit data input and downstream processing
     configurations = []     # do be passed to Entropy(config= )
+    store = config_store.get_store(user_sans_config_dir)
     for config_name in config_list_select:
-        df = pandas.read_json(Path(user_sans_config_dir) / config_name, orient='record')
-        df_config.append(df.copy(deep=True))
-        config_dict = df.set_index('setting').T.to_dict('records')
-        configurations.append(config_dict[0])
+        df_config.append(store.frame(config_name))
+        configurations.append(store.configuration(config_name))
 
     st.session_state['pse_configurations'] = configurations
 
@@ -152,10 +106,33 @@ def update_df_config(config_list_select):
 
     return
 
+
+@st.fragment(run_every=entropy_server.HEARTBEAT_INTERVAL)
+def server_heartbeat():
+    # keeps the lease alive while the page is open, also when only the monitor and run control fragments rerun
+    if not entropy_server.touch(st.session_state['session_id']):
+        lease_server()
+        st.rerun(scope='app')
+
+
+def lease_server():
+    st.session_state['gp_server_port'] = entropy_server.acquire(st.session_state['session_id'])
+    # the key of the former per-session server process, kept for PSE components that may still read it; the process
+    # is shared by all sessions of the server and must not be terminated by a session
+    st.session_state['gp_server_process'] = entropy_server.server_process(st.session_state['session_id'])
+
+
 # ------------  GUI -------------------
+# lease a shared PSE server, this also serves as the session's heartbeat towards the server pool
+lease_server()
+server_heartbeat()
+
 start_of_script_business()
 
 cfg = st.session_state.cfg
+# derived tables of the setup, a reloaded app configuration invalidates them
+if 'pse_setup_tracker' not in st.session_state or st.session_state['configuration_reloaded']:
+    st.session_state['pse_setup_tracker'] = pse_setup.SetupTracker()
 
 # the optimization directory, that will contain all PSE-related files
 user_sans_opt_dir = st.session_state['user_sans_opt_dir']
@@ -179,8 +156,7 @@ file_list = sorted(p.name for p in Path(user_sans_file_dir).iterdir()
 model_list = sorted(p.name for p in Path(user_sans_model_dir).iterdir()
                    if p.is_file() and not p.name.startswith('.'))
 
-config_list = sorted(p.name for p in Path(user_sans_config_dir).iterdir()
-                   if p.is_file() and not p.name.startswith('.'))
+config_list = config_store.get_store(user_sans_config_dir).names()
 
 
 
@@ -307,7 +283,11 @@ with (((((st.expander('Setup')))))):
         }
     )
     # save current dataframe state to the configuration
-    cfg.pse_parameters_edited_json = st.session_state.opt_parameters.reset_index().to_dict(orient="records")
+    records, rebuilt = st.session_state['pse_setup_tracker'].derive(
+        'pse_parameters_edited_json', lambda: pse_setup.to_records(st.session_state.opt_parameters),
+        st.session_state.opt_parameters)
+    if rebuilt:
+        cfg.pse_parameters_edited_json = records
 
     st.write("""
     ### Instrument Configurations
@@ -356,14 +336,13 @@ with (((((st.expander('Setup')))))):
                 st.session_state['df_opt_config'][i].copy(deep=True),
                 **common_keyword_args
             )
-            adjust_consecutive_configurations()
+            # edits of the first configuration may affect all others, edits of any other configuration only itself
+            adjust_consecutive_configurations(None if i == 0 else [i])
 
     # save various instrument configuration data frames to the app config
-    cfg.pse_configs_json = [df.reset_index().to_dict(orient="records") for df in st.session_state.df_opt_config]
-    cfg.pse_configs_edited_json = [df.reset_index().to_dict(orient="records") for df in
-                                   st.session_state.df_opt_config_edited]
-    cfg.pse_configs_original_json = [df.reset_index().to_dict(orient="records") for df in
-                                     st.session_state.df_opt_config_original]
+    persist_setup_table('pse_configs_json', st.session_state.df_opt_config)
+    persist_setup_table('pse_configs_edited_json', st.session_state.df_opt_config_edited)
+    persist_setup_table('pse_configs_original_json', st.session_state.df_opt_config_original)
 
     st.write("""
     ### Simulated Scattering Background
@@ -404,9 +383,9 @@ with (((((st.expander('Setup')))))):
         ### Shorthand Summary
         """)
         df_summary = summarize_optimization_parameter_settings()
-        df_summary = df_summary.replace(
-            [float('inf'), float('-inf')], '').fillna('').astype(str).replace({'nan': '', 'None': ''}
-                                                                              )
+        df_summary, _ = st.session_state['pse_setup_tracker'].derive(
+            'summary_strings', lambda: df_summary.replace([float('inf'), float('-inf')], '').fillna('').astype(
+                str).replace({'nan': '', 'None': ''}), df_summary)
         st.write(df_summary)
 
 # prepare fit directory
@@ -466,6 +445,61 @@ kwargs_entropy_gp = {
     'jupyter_clear_output': False
 }
 
+st.write("""
+## Grid Screening
+""")
+st.write('Evaluates the information gain of every point of the optimization grid. The Fisher information '
+         'screening needs seconds for thousands of points, the best candidates can then be verified by simulated '
+         'Levenberg-Marquardt fits in parallel. Points evaluated before are taken from the cache.')
+col_opt_7, col_opt_8, col_opt_9 = st.columns([1, 1, 1])
+col_opt_7.number_input('worker processes (0 = all cores)', min_value=0, value=cfg.pse_grid_workers, step=1,
+                       key='pse_grid_workers')
+cfg.pse_grid_workers = st.session_state.pse_grid_workers
+col_opt_8.number_input('candidates to verify by fits', min_value=1, value=10, step=1, key='pse_grid_candidates')
+num_grid_points = design_grid.num_points(design_grid.grid_axes(df_summary))
+col_opt_9.metric('grid points', num_grid_points)
+
+
+def screen_grid(method, subset=None):
+    progress_bar = st.progress(0.0, text='Evaluating grid')
+    return design_grid.evaluate_grid(
+        df_summary, st.session_state['pse_configurations'], Path(user_sans_model_dir) / cfg.pse_model_name,
+        datafile_names, cfg.pse_qmin, cfg.pse_qmax, t_total=cfg.pse_tfix or None, method=method, subset=subset,
+        workers=cfg.pse_grid_workers, disk_dir=caching.cache_dir(user_sans_fit_dir, design_grid.GRID_CACHE),
+        on_progress=lambda done, total: progress_bar.progress(done / max(total, 1), text=str(done) + ' of ' +
+                                                              str(total) + ' points')
+    )
+
+
+# results refer to grid positions and are dropped once the grid changes
+grid_digest = caching.digest(df_summary, st.session_state['pse_configurations'], cfg.pse_qmin, cfg.pse_qmax,
+                             cfg.pse_tfix)
+if st.session_state.get('pse_grid_digest') != grid_digest:
+    st.session_state.pop('pse_grid_result', None)
+    st.session_state['pse_grid_digest'] = grid_digest
+
+col_opt_10, col_opt_11 = st.columns([1, 1])
+if col_opt_10.button('Fisher Screening'):
+    df_grid = screen_grid('fisher')
+    st.session_state['pse_grid_result'] = df_grid.rename(columns={'gain': 'gain (Fisher)'})
+if col_opt_11.button('Verify Candidates by Fits', disabled='pse_grid_result' not in st.session_state):
+    df_grid = st.session_state['pse_grid_result']
+    candidates = df_grid.nlargest(st.session_state.pse_grid_candidates, 'gain (Fisher)').index
+    df_fit = screen_grid('fit', subset=list(candidates))
+    st.session_state['pse_grid_result'] = df_grid.drop(columns=['gain (fit)', 'error (fit)'], errors='ignore').join(
+        df_fit[['gain', 'error']].rename(columns={'gain': 'gain (fit)', 'error': 'error (fit)'}))
+if 'pse_grid_result' in st.session_state:
+    df_grid = st.session_state['pse_grid_result']
+    axis_columns = [column for column in df_grid.columns
+                    if not column.startswith(('gain', 'error')) and column != 'cached']
+    num_failed = int(df_grid.filter(like='error').notna().any(axis=1).sum())
+    if num_failed:
+        st.warning(str(num_failed) + ' of ' + str(len(df_grid)) + ' grid points failed, see the error columns.')
+    st.dataframe(df_grid.sort_values('gain (Fisher)', ascending=False), hide_index=True)
+    if len(axis_columns) == 1:
+        # single axis: gain along the axis
+        st.line_chart(df_grid, x=axis_columns[0], y=[c for c in df_grid.columns if c.startswith('gain')])
+
 st.write("""
 ## Phase Space Exploration
 """)
@@ -1,14 +1,17 @@
-import matplotlib.pyplot as plt
 import numpy
 import os
 from pathlib import Path
-import pickle
 import streamlit as st
-from sasmodels.data import load_data
-import tensorflow as tf
 import time
+from sans_app.support import datafiles
+from sans_app.support import ml_serving
+from sans_app.support.lazy import lazy_import
 
+plt = lazy_import('matplotlib.pyplot')
 
+
+# the whole tab, including single-file prediction, batch classification and the sidecar-backed data loading, is
+# disabled until development is finished; batch classification is covered by the tests of ml_serving meanwhile
 st.info('Tab currently under development.')
 st.stop()
 
@@ -21,6 +24,7 @@ if not os.path.isdir('temp'):
 
 user_ml_model_dir = str(st.session_state['user_ml_model_dir'])
 user_sans_file_dir = str(st.session_state['user_sans_file_dir'])
+user_sans_temp_dir = str(st.session_state['user_sans_temp_dir'])
 default_model_dir = os.path.join(str(Path(__file__).parent.parent.parent), 'ml_models')
 tb_output = ['No SANS File Loaded']
 
@@ -35,34 +39,7 @@ def update_background_input_auto(Q, Iq, dI, dQ, qmin, qmax):
 # Functionality
 @st.cache_data
 def auto_background(Q, Iq, dI, dQ, qmin, qmax):
-    Iq_backg = numpy.where(Q <= qmin, Iq[Q <= qmin][-1], Iq)
-    Iq_backg = numpy.where(Q >= qmax, Iq[Q >= qmax][0], Iq_backg)
-
-    # average of last n points that is within the error bar of the n-1 th point
-    background = None
-    for i in range(-5, -30, -1):
-        background_new = numpy.average(Iq_backg[i:])
-        if numpy.abs(Iq_backg[i - 1] - background_new) > 2 * dI[i - 1]:
-            break
-        background = background_new
-    return background
-
-
-@st.cache_data
-def load_ml_model(path, model):
-    dirname = os.path.join(path, model)
-    tb_output = ''
-    try:
-        sans_models = fnLoadObject(os.path.join(dirname, 'sans_models.dat'))
-        par_names = fnLoadObject(os.path.join(dirname, 'par_names.dat'))
-        # Load model for prediction. Compile = False avoids supplying the custom loss function.
-        ml_model = tf.keras.models.load_model(dirname, compile=False)
-    except (IOError, ValueError) as e:
-        tb_output = 'Could not load ML model. ' + str(e)
-        ml_model = None
-        sans_models = None
-        par_names = None
-    return sans_models, par_names, ml_model, tb_output
+    return ml_serving.auto_background(Q, Iq, dI, qmin, qmax)
 
 
 @st.cache_data
@@ -70,11 +47,7 @@ def load_SANS_data(uploaded_file):
     try:
         with open(os.path.join(user_sans_file_dir, uploaded_file.name), "wb") as f:
             f.write(uploaded_file.getbuffer())
-        ds = load_data(os.path.join(user_sans_file_dir, uploaded_file.name))
-        Q = ds.x
-        Iq = ds.y
-        dI = ds.dy
-        dQ = ds.dx
+        Q, Iq, dI, dQ = datafiles.read_columns(os.path.join(user_sans_file_dir, uploaded_file.name))
         tb_output = " "
     except IOError:
         Q = Iq = dI = dQ = None
@@ -83,12 +56,6 @@ def load_SANS_data(uploaded_file):
     return Q, Iq, dI, dQ, tb_output, uploaded_file
 
 
-def fnLoadObject(sFileName):
-    with open(sFileName, 'rb') as file:
-        load_object = pickle.load(file)
-    return load_object
-
-
 @st.cache_data
 def plot_SANS(Q, Iq, dI, dQ, background, qmin, qmax):
     time.sleep(1)
@@ -127,51 +94,8 @@ def plot_SANS(Q, Iq, dI, dQ, background, qmin, qmax):
 
 @st.cache_data
 def predict(Q, Iq, dI, dQ, background, solvent_sld, ml_model_name, qmin, qmax):
-
-    # truncate data to index range
-    Iq_pred = numpy.where(Q <= qmin, Iq[Q <= qmin][-1], Iq)
-    Iq_pred = numpy.where(Q >= qmax, Iq[Q >= qmax][0], Iq_pred)
-
-    Iq_pred = Iq_pred - background
-    Iq_pred = numpy.log10(numpy.abs(Iq_pred))
-
-    # interpolation of SANS data to hardcoded grid
-    qmin = 0.01
-    qmax = 0.8
-    numpoints = int((numpy.log10(qmax) - numpy.log10(qmin)) * 60)
-    qvec = numpy.logspace(numpy.log10(qmin), numpy.log10(qmax), num=numpoints, endpoint=True)
-    qvec = qvec[:105]
-
-    intensity = numpy.interp(qvec, Q, Iq_pred)
-    intensity = intensity[numpy.newaxis, :]
-    intensity = tf.convert_to_tensor(intensity, dtype=tf.float32)
-
-    sup = numpy.array([background, solvent_sld]).astype('float32')
-    sup = sup[numpy.newaxis, :]
-
-    y_pred = ml_model.predict([intensity, sup])
-
-    tb_output = ["---Classification---"]
-    for i, model in enumerate(sans_models):
-        pstr = f'{y_pred[-1][0][i]:.2f}' + ' ' + model
-        tb_output.append(pstr)
-    tb_output.append("")
-
-    tb_output.append("---Regression---")
-    for i in range(len(y_pred) - 1):
-        pstr = 'Model: ' + sans_models[i]
-        tb_output.append(pstr)
-        for j in range(len(par_names[i])):
-            parname = par_names[i][j]
-            if 'sld' in parname:
-                correction = 0.1
-            else:
-                correction = 1
-            pstr = parname + ' ' + f'{y_pred[i][0][j] * correction:.4f}'
-            tb_output.append(pstr)
-        tb_output.append("")
-
-    return tb_output
+    y_pred = ml_serving.predict_curves(predictor, [(Q, Iq, background, qmin, qmax)], solvent_sld)
+    return ml_serving.format_prediction(y_pred, 0, sans_models, par_names)
 
 
 # -------- GUI ------------------
@@ -207,7 +131,7 @@ ml_model_name = col2.selectbox("ML model", combined_model_list)
 # identify in which folder the selected model resides
 if ml_model_name in model_list2:
     model_path = model_path2
-sans_models, par_names, ml_model, tb_output = load_ml_model(model_path, ml_model_name)
+sans_models, par_names, predictor, tb_output = ml_serving.load_ml_model(model_path, ml_model_name)
 if tb_output != '':
     st.error(tb_output)
     st.stop()
@@ -221,4 +145,30 @@ for element in tb_output:
 col2.text(tout)
 st.divider()
 
-
+st.write("""
+# Batch Classification
+""")
+file_list = sorted(p.name for p in Path(user_sans_file_dir).iterdir() if p.is_file() and not p.name.startswith('.'))
+batch_files = st.multiselect('SANS files', file_list, default=file_list, key='ml_batch_files')
+batch_sld = st.number_input('Solvent SLD', format='%f', step=0.1, value=6.4, key='ml_batch_sld')
+col7, col8 = st.columns([1, 1])
+# empty inputs use the full Q-range of each file
+batch_qmin = col7.number_input('Q min', value=None, format='%f', key='ml_batch_qmin')
+batch_qmax = col8.number_input('Q max', value=None, format='%f', key='ml_batch_qmax')
+if st.button('Classify', disabled=not batch_files):
+    with st.spinner('Classifying ' + str(len(batch_files)) + ' files ...'):
+        df_batch = ml_serving.classify_files(predictor, [Path(user_sans_file_dir) / f for f in batch_files],
+                                             sans_models, par_names, batch_sld, qmin=batch_qmin, qmax=batch_qmax)
+        # result files are only written when a classification ran, not on every rerun
+        written = ml_serving.write_results(df_batch, Path(user_sans_temp_dir) / 'ml_predictions')
+        st.session_state['ml_batch_results'] = (ml_model_name, df_batch, written)
+
+if 'ml_batch_results' in st.session_state:
+    batch_model_name, df_batch, written = st.session_state['ml_batch_results']
+    st.write('ML model: ' + batch_model_name)
+    st.dataframe(df_batch, hide_index=True)
+    col5, col6 = st.columns([1, 1])
+    for column, path in zip([col5, col6], written):
+        with open(path, 'rb') as file:
+            column.download_button(label='Download ' + path.suffix[1:].upper(), data=file, file_name=path.name,
+                                   key='ml_batch_download' + path.suffix)
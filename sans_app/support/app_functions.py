@@ -1,20 +1,88 @@
 from __future__ import annotations
 
-import hashlib
 import os
 from PIL import Image
 import pandas
 from pathlib import Path
-from sasmodels.data import load_data
-from scattertools.support import molstat
-from scattertools.support import api_sasview
+import pickle
 import shutil
 import streamlit as st
-import subprocess
-import threading
 from typing import Optional, Dict, Any
 
+from sans_app.support import archive
+from sans_app.support import batch_fit
+from sans_app.support import caching
 from sans_app.support import configuration
+from sans_app.support import datafiles
+from sans_app.support import fit_jobs
+from sans_app.support.lazy import lazy_import
+
+molstat = lazy_import('scattertools.support.molstat')
+api_sasview = lazy_import('scattertools.support.api_sasview')
+
+# results of process_runfile keyed by fit directory, mirrored to RUNFILE_CACHE_FILE in that directory
+_runfile_cache: Dict[str, Dict[str, Any]] = {}
+RUNFILE_CACHE_FILE = '.runfile_cache.pkl'
+
+
+class _LazyFitObject:
+    """
+    Stands in for a molstat.CMolStat of an already prepared fit directory. The fit object, and with it the bumps
+    problem, is only constructed on first attribute access.
+    """
+    def __init__(self, fit_dir: Path, runfile: str):
+        self._fit_dir = fit_dir
+        self._runfile = runfile
+        self._fitobj = None
+
+    def __getattr__(self, name):
+        # private and special names are never delegated; copy and pickle look them up before __init__ has run
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if self._fitobj is None:
+            os.chdir(self._fit_dir)
+            self._fitobj = molstat.CMolStat(
+                fitsource="SASView",
+                spath=self._fit_dir,
+                mcmcpath="MCMC",
+                runfile=self._runfile,
+                state=None,
+                problem=None,
+            )
+        return getattr(self._fitobj, name)
+
+
+def _load_runfile_cache(fit_dir: Path) -> Optional[Dict[str, Any]]:
+    entry = _runfile_cache.get(str(fit_dir))
+    if entry is None and (fit_dir / RUNFILE_CACHE_FILE).is_file():
+        try:
+            with open(fit_dir / RUNFILE_CACHE_FILE, 'rb') as f:
+                entry = pickle.load(f)
+        except (IOError, pickle.UnpicklingError, EOFError, AttributeError):
+            entry = None
+        _runfile_cache[str(fit_dir)] = entry
+    return entry
+
+
+def _save_runfile_cache(fit_dir: Path, entry: Dict[str, Any]) -> None:
+    _runfile_cache[str(fit_dir)] = entry
+    try:
+        with open(fit_dir / RUNFILE_CACHE_FILE, 'wb') as f:
+            pickle.dump(entry, f)
+    except IOError:
+        pass
+
+
+def _source_signature(runfile: Path, file_dir: Path, datafile_names) -> tuple:
+    return ((caching.stat_signature(runfile),) +
+            tuple(caching.stat_signature(file_dir / fname) for fname in datafile_names))
+
+
+def _source_digest(runfile: Path, file_dir: Path, datafile_names) -> tuple:
+    return ((caching.file_digest(runfile),) +
+            tuple(caching.file_digest(file_dir / fname) if (file_dir / fname).is_file() else None
+                  for fname in datafile_names))
+
 
 def process_runfile(model_name, model_dir, file_dir, fit_dir, force=True,
                     correct_data_paths=False):
@@ -23,6 +91,11 @@ def process_runfile(model_name, model_dir, file_dir, fit_dir, force=True,
     and the script file to this directory from model_dir and file_dir, respectively. All other contents from the fit_dir
     are deleted.
 
+    The results are cached per fit_dir and keyed by the content of the script and the data files. As long as neither
+    changed (judged by mtime and size), the cached parameters are returned without rehashing, without touching the
+    fit directory, and with a fit object that is only constructed when used. Files with a new mtime or size are
+    rehashed, and the cache stays valid if their content is unchanged.
+
     :param model_name: (str) The namem of the model, including file extension.
     :param model_dir: (str or Path-like) The directory of the model.
     :param file_dir: (str or Path-like) The directory of the data files.
@@ -32,42 +105,51 @@ def process_runfile(model_name, model_dir, file_dir, fit_dir, force=True,
     :return: (Pandas dataframe) of all parameters, (list) of all parameter names, (list) of all data filenames,
              (bumps problem) an instance of the fit object
     """
-
-    def _file_hash(path: Path) -> str:
-        h = hashlib.sha256()
-        with path.open("rb") as f:
-            for block in iter(lambda: f.read(1024 * 1024), b""):
-                h.update(block)
-        return h.hexdigest()
-
     file_dir = Path(file_dir).expanduser().resolve()
     model_dir = Path(model_dir).expanduser().resolve()
     fit_dir = Path(fit_dir).expanduser().resolve()
     runfile = model_dir / model_name
     runfile_dest = fit_dir / model_name
 
+    # warm path: script and data files unchanged since the fit directory was last prepared
+    entry = _load_runfile_cache(fit_dir)
+    warm = (entry is not None and entry['runfile'] == str(runfile) and entry['file_dir'] == str(file_dir)
+            and runfile_dest.is_file())
+    if warm:
+        signature = _source_signature(runfile, file_dir, entry['datafile_names'])
+        if entry['signature'] != signature:
+            # touched or copied files with unchanged content keep the warm path, the digest decides
+            warm = entry.get('digest') == _source_digest(runfile, file_dir, entry['datafile_names'])
+            if warm:
+                _save_runfile_cache(fit_dir, dict(entry, signature=signature))
+    if warm:
+        os.chdir(fit_dir)
+        return (entry['df_pars'].copy(), list(entry['li_allpars']), list(entry['datafile_names']),
+                _LazyFitObject(fit_dir, runfile.name))
+
     # extract name of data files from runfile
-    datafile_names = api_sasview.extract_data_filenames_from_runfile(runfile=str(runfile))
+    datafile_names_raw = api_sasview.extract_data_filenames_from_runfile(runfile=str(runfile))
     # strip any long path from filename and retain only the basename, write back to file
-    datafile_names = [Path(file).name for file in datafile_names]
+    datafile_names = [Path(file).name for file in datafile_names_raw]
     datafile_paths = [str(file_dir / Path(file).name) for file in datafile_names]
     # This modifies the original file enforcing a SANS app constraint that the data file and the script are in the same
     # folder
-    if correct_data_paths:
+    if correct_data_paths and list(datafile_names_raw) != datafile_names:
         api_sasview.write_data_filenames_to_runfile(runfile=str(runfile), filelist=datafile_names)
 
-    already_prepared = False
-    # check if model script has already been copied and is unchanged
-    if runfile_dest.is_file() and _file_hash(runfile) == _file_hash(runfile_dest):
-        # same for each data file
+    # check if model script has already been copied and is unchanged, same for each data file
+    already_prepared = runfile_dest.is_file() and caching.file_digest(runfile) == caching.file_digest(runfile_dest)
+    if already_prepared:
         for fname in datafile_names:
             if (file_dir / fname).is_file():
-                if not (fit_dir / fname).is_file() and _file_hash(file_dir / fname) == _file_hash(fit_dir / fname):
+                if (not (fit_dir / fname).is_file() or
+                        caching.file_digest(file_dir / fname) != caching.file_digest(fit_dir / fname)):
+                    already_prepared = False
                     break
             # no source data file is o.k., but then a dummy file of the same name should be present
             elif not (fit_dir / fname).is_file():
+                already_prepared = False
                 break
-        already_prepared = True
 
     if not already_prepared:
         if not force:
@@ -75,7 +157,9 @@ def process_runfile(model_name, model_dir, file_dir, fit_dir, force=True,
                 st.warning("Optimization folder is not empty. Please archive and clear contents.")
                 st.stop()
 
-        molstat.prepare_fit_directory(fitdir=str(fit_dir), runfile=str(runfile), datafile_names=datafile_paths)
+        # fit jobs, batches and caches are stored below the fit directory and must survive its re-initialization
+        fit_jobs.prepare_fit_directory(fit_dir, runfile, keep=[fit_jobs.JOB_DIR_NAME, batch_fit.BATCH_DIR_NAME,
+                                                               caching.CACHE_DIR_NAME])
         # if datafiles exist in user filedir, use those; otherwise create dummy files
         for filename in datafile_paths:
             if Path(filename).is_file():
@@ -97,6 +181,16 @@ def process_runfile(model_name, model_dir, file_dir, fit_dir, force=True,
     df_pars = pandas.DataFrame.from_dict(fitobj.fnLoadParameters())
     li_allpars = fitobj.fnGetAllParameterNames(model=0)
 
+    _save_runfile_cache(fit_dir, {
+        'runfile': str(runfile),
+        'file_dir': str(file_dir),
+        'signature': _source_signature(runfile, file_dir, datafile_names),
+        'digest': _source_digest(runfile, file_dir, datafile_names),
+        'df_pars': df_pars.copy(),
+        'li_allpars': list(li_allpars),
+        'datafile_names': list(datafile_names),
+    })
+
     return df_pars, li_allpars, datafile_names, fitobj
 
 
@@ -115,23 +209,16 @@ def load_SANS_data(uploaded_file, file_save_dir):
     return ds, tb_output, uploaded_file
 
 
-@st.cache_data
 def load_sans_file(file_name, file_dir):
+    """
+    Loads a SANS data file through the binary sidecar cache shared by all pages, see datafiles.read_columns().
+
+    :return: (Pandas dataframe) Q, I, dI, dQ or None, (str) error message or '', (str) file name or None
+    """
     try:
-        dso = load_data(os.path.join(file_dir, file_name))
-        Q = dso.x
-        Iq = dso.y
-        dI = dso.dy
-        dQ = dso.dx
-        ds = pandas.DataFrame(
-            {'Q': Q,
-             'I': Iq,
-             'dI': dI,
-             'dQ': dQ
-             }
-        )
+        ds = datafiles.load_frame(os.path.join(file_dir, file_name))
         tb_output = ""
-    except (IOError, TypeError) as exc:
+    except (IOError, TypeError, ValueError) as exc:
         ds = None
         tb_output = "Invalid SANS data file. " + str(exc)
         file_name = None
@@ -150,10 +237,12 @@ def load_sans_files(filelist, file_dir):
 
 
 def run_fit(fitdir=None, runfile=None, datafile_names=None, datafile_names_uploaded=None, file_dir=None, model_dir=None,
-            burn=1000, steps=200):
-    # save current working directory
-    olddir = os.getcwd()
+            burn=1000, steps=200, rhat_stop=0.0, mapper='serial', workers=0, warm_start=False):
+    """
+    Checks that all data files of the model are available and queues the fit. Returns without waiting for the fit.
 
+    :return: (str) the job ID, or None if the fit could not be queued
+    """
     # check if all data files are in place
     breakflag = False
     for file in datafile_names:
@@ -167,51 +256,87 @@ def run_fit(fitdir=None, runfile=None, datafile_names=None, datafile_names_uploa
                 breakflag = True
 
     if breakflag:
-        return
+        return None
 
     datafpaths = [os.path.join(file_dir, file) for file in datafile_names]
-    molstat.prepare_fit_directory(fitdir=fitdir, runfile=os.path.join(model_dir, runfile), datafile_names=datafpaths)
-
-    st.info("Starting the fit ...")
-    runfile = os.path.splitext(runfile)[0]
-    os.chdir(fitdir)
-    with open('run_fit.py', 'w') as file:
-        file.write('from scattertools.support import molstat\n')
-        file.write('\n')
-        file.write("if __name__ == '__main__':\n")
-        file.write('    fitobj = molstat.CMolStat(\n')
-        file.write('        fitsource="SASView",\n')
-        file.write('        spath="' + fitdir + '",\n')
-        file.write('        mcmcpath="MCMC",\n')
-        file.write('        runfile="' + runfile + '",\n')
-        file.write('        state=None,\n')
-        file.write('        problem=None,\n')
-        file.write('    )\n')
-        file.write('\n')
-        file.write('    fitobj.Interactor.fnRunMCMC(' + str(burn) + ', ' + str(steps) + ', batch=False)\n')
-        file.write('\n')
-
-    # bumps uses multithreading, which collides with Streamlits requirement to register the thread context
-    subprocess.run(['python', 'run_fit.py'])
+    job_id = fit_jobs.submit_fit(fitdir, os.path.join(model_dir, runfile), datafpaths, burn=burn, steps=steps,
+                                 rhat_stop=rhat_stop, mapper=mapper, workers=workers,
+                                 warm_start=warm_start)
+    st.info('Fit ' + job_id + ' queued.')
+    return job_id
 
-    fitobj = molstat.CMolStat(
-        fitsource="SASView",
-        spath=fitdir,
-        mcmcpath="MCMC",
-        runfile=runfile,
-        state=None,
-        problem=None,
-    )
 
-    st.info("Analyzing the fit ...")
-    fitobj.fnRestoreFit()
-    results = fitobj.fnAnalyzeStatFile(fConfidence=-1)
+def show_fit_progress(progress):
+    """
+    Displays a progress report of a running or finished fit: steps, acceptance rate, convergence and the online
+    posterior summary.
+    """
+    if progress is None:
+        return
+    fraction = min(1.0, progress['step'] / max(progress['total_steps'], 1))
+    text = progress['phase'] + ' step ' + str(progress['step']) + ' of ' + str(progress['total_steps'])
+    if progress['converged']:
+        text += ', converged'
+    elif progress['stopped']:
+        text += ', stopped'
+    st.progress(fraction, text=text)
+
+    def _fmt(value, fmt):
+        return '-' if value is None else format(value, fmt)
+
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric('acceptance', _fmt(progress['acceptance'], '.1%'))
+    col2.metric('best χ²', _fmt(progress['best_chisq'], '.4g'))
+    col3.metric('max R-hat', _fmt(progress['max_rhat'], '.3f'))
+    col4.metric('elapsed', _fmt(progress['elapsed'], '.0f') + ' s')
+    if progress['posterior']:
+        st.dataframe(pandas.DataFrame(progress['posterior']).T)
+
+
+def show_fit_job(fitdir, job_id, temp_dir):
+    """
+    Displays status, console output and, once finished, the results of a fit job.
+    """
+    job = fit_jobs.get_job(fitdir, job_id)
+    if job is None:
+        st.warning('Fit ' + job_id + ' not found.')
+        return
+
+    status = job['status']
+    st.write('Status: **' + status + '**')
+    if status in ('queued', 'running'):
+        col1, col2 = st.columns([1, 1])
+        col1.button('Cancel Fit', on_click=fit_jobs.cancel_job, args=[fitdir, job_id], key='cancel_' + job_id)
+        if status == 'running':
+            col2.button('Stop and Analyze', on_click=fit_jobs.stop_job, args=[fitdir, job_id], key='stop_' + job_id,
+                        disabled=job.get('stop_requested', False))
+    show_fit_progress(fit_jobs.get_progress(fitdir, job_id))
+    log = fit_jobs.read_log(fitdir, job_id)
+    if log:
+        st.code(log, language=None)
+    if status != 'done':
+        if status == 'failed' and 'error' in job:
+            st.error(job['error'])
+        return
+
+    results = fit_jobs.load_results(fitdir, job_id)
     st.write('Results:')
     st.write(results)
-    for file in os.listdir("MCMC"):
-        if file.endswith(".png"):
-            image = Image.open(os.path.join('MCMC', file))
-            st.image(image)
+    mcmc_dir = fit_jobs.job_dir(fitdir, job_id) / fit_jobs.JOB_FIT_DIR / 'MCMC'
+    if mcmc_dir.is_dir():
+        for file in sorted(os.listdir(mcmc_dir)):
+            if file.endswith(".png"):
+                image = Image.open(mcmc_dir / file)
+                st.image(image)
 
-    os.chdir(olddir)
-    return
+    # zip fit folder for download, the archive is only rebuilt when the fit folder changed
+    archive_path = archive.build_archive(fit_jobs.job_dir(fitdir, job_id) / fit_jobs.JOB_FIT_DIR,
+                                         Path(temp_dir) / ('fit_' + job_id + '.zip'))
+    with open(archive_path, "rb") as file:
+        st.download_button(
+            label='Download  Fit',
+            data=file,
+            file_name='fit.zip',
+            mime='application/zip',
+            key='download_' + job_id
+        )
@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import json
+import os
+from pathlib import Path
+import shutil
+from typing import Dict, List, Optional, Tuple
+import uuid
+import zipfile
+
+# Files with these suffixes are compressed already and stored as they are.
+STORED_SUFFIXES = ('.gz', '.bz2', '.xz', '.zst', '.zip', '.npz', '.png', '.jpg', '.jpeg', '.gif', '.pdf')
+# Above this size files are compressed with the fastest setting, MCMC chains easily reach hundreds of MB.
+LARGE_FILE = 8 * 2 ** 20
+CHUNK_SIZE = 2 ** 20
+MANIFEST_SUFFIX = '.manifest.json'
+
+
+def _scan(src_dir: Path) -> Dict[str, Tuple[int, int]]:
+    """
+    :return: (dict) relative posix path -> (mtime_ns, size) of all files below src_dir
+    """
+    files = {}
+    for root, dirs, names in os.walk(src_dir):
+        dirs.sort()
+        for name in sorted(names):
+            path = Path(root) / name
+            stat = path.stat()
+            files[path.relative_to(src_dir).as_posix()] = (stat.st_mtime_ns, stat.st_size)
+    return files
+
+
+def _compression(name: str, size: int) -> Tuple[int, Optional[int]]:
+    """
+    :return: (tuple) zipfile compression method and level for a file
+    """
+    if name.lower().endswith(STORED_SUFFIXES):
+        return zipfile.ZIP_STORED, None
+    # available from Python 3.14 on
+    zstd = getattr(zipfile, 'ZIP_ZSTANDARD', None)
+    if zstd is not None:
+        return zstd, 1 if size > LARGE_FILE else 3
+    return zipfile.ZIP_DEFLATED, 1 if size > LARGE_FILE else 6
+
+
+def _add_files(zf: zipfile.ZipFile, src_dir: Path, names: List[str]) -> None:
+    for name in names:
+        path = src_dir / name
+        method, level = _compression(name, path.stat().st_size)
+        info = zipfile.ZipInfo.from_file(path, arcname=name)
+        info.compress_type = method
+        if level is not None:
+            # public attribute from Python 3.13 on
+            setattr(info, 'compress_level' if hasattr(info, 'compress_level') else '_compresslevel', level)
+        # copy in chunks, so that large chain files are never held in memory; force_zip64 since sizes are unknown
+        # to the zip header in advance
+        with open(path, 'rb') as src, zf.open(info, 'w', force_zip64=True) as dst:
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+
+
+def _read_manifest(path: Path) -> Dict[str, List[int]]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def build_archive(src_dir, archive_path) -> Path:
+    """
+    Zips a directory for download. A manifest next to the archive records the files it contains. If no file changed
+    since the last call, the archive is reused; if files were only added, they are appended. Only changed or deleted
+    files cause a full rebuild, which is written to a temporary file and swapped in atomically.
+
+    :param src_dir: (str or Path-like) the directory to archive
+    :param archive_path: (str or Path-like) the zip file
+    :return: (Path) the zip file
+    """
+    src_dir = Path(src_dir)
+    archive_path = Path(archive_path)
+    manifest_path = archive_path.with_name(archive_path.name + MANIFEST_SUFFIX)
+    files = _scan(src_dir)
+    manifest = _read_manifest(manifest_path) if archive_path.is_file() else {}
+    manifest = {name: tuple(entry) for name, entry in manifest.items()}
+
+    if manifest and manifest == files:
+        return archive_path
+
+    unchanged = all(files.get(name) == entry for name, entry in manifest.items())
+    if manifest and unchanged:
+        try:
+            with zipfile.ZipFile(archive_path, 'a') as zf:
+                _add_files(zf, src_dir, [name for name in files if name not in manifest])
+        except Exception:
+            # the archive may be incomplete, rebuild it on the next call
+            archive_path.unlink(missing_ok=True)
+            raise
+    else:
+        tmp = archive_path.with_name(archive_path.name + '.' + uuid.uuid4().hex + '.tmp')
+        try:
+            with zipfile.ZipFile(tmp, 'w') as zf:
+                _add_files(zf, src_dir, list(files))
+            os.replace(tmp, archive_path)
+        finally:
+            if tmp.exists():
+                tmp.unlink()
+
+    tmp = manifest_path.with_name(manifest_path.name + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(files, f)
+    os.replace(tmp, manifest_path)
+    return archive_path
@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+import json
+import os
+from pathlib import Path
+import shutil
+import time
+from typing import Any, Dict, List, Optional
+import uuid
+
+import pandas
+
+from sans_app.support import fit_jobs
+from sans_app.support.lazy import lazy_import
+
+api_sasview = lazy_import('scattertools.support.api_sasview')
+
+# Batch fits live below the user fit directory. Each batch folder holds the batch state and one copy of the model
+# script per data file, with the data file name substituted. The fits themselves are regular fit jobs.
+BATCH_DIR_NAME = 'batches'
+BATCH_STATE_FILE = 'batch.json'
+# status of a batch item whose fit was never queued, e.g. after a failure while submitting the batch
+UNSUBMITTED = 'not submitted'
+
+
+def batch_root(fit_dir) -> Path:
+    return Path(fit_dir).expanduser().resolve() / BATCH_DIR_NAME
+
+
+def match_files(file_dir, pattern: str) -> List[Path]:
+    """
+    :return: (list) the data files in file_dir matching a glob pattern, without hidden files
+    """
+    return sorted(p for p in Path(file_dir).glob(pattern) if p.is_file() and not p.name.startswith('.'))
+
+
+def submit_batch(fit_dir, model_name: str, model_dir, file_dir, pattern: str, **fit_options) -> str:
+    """
+    Fits one model script to every data file matching pattern. The first data file named in the script is replaced
+    by each matching file in turn, further data files of the script stay the same for all fits. All fits are queued
+    at once and run in parallel on the fit slots of the server.
+
+    :param fit_dir: (str or Path-like) The user fit directory.
+    :param model_name: (str) The name of the model script, including file extension.
+    :param model_dir: (str or Path-like) The directory of the model script.
+    :param file_dir: (str or Path-like) The directory of the data files.
+    :param pattern: (str) glob pattern of the data files, e.g. 'sample_T*.ABS'
+    :param fit_options: options of fit_jobs.submit_fit, e.g. burn, steps, fitter
+    :return: (str) the batch ID
+    """
+    runfile = Path(model_dir) / model_name
+    files = match_files(file_dir, pattern)
+    if not files:
+        raise ValueError('No data files match ' + pattern + '.')
+    datafile_names = [Path(f).name for f in api_sasview.extract_data_filenames_from_runfile(runfile=str(runfile))]
+    if not datafile_names:
+        raise ValueError('Model ' + model_name + ' does not load any data file.')
+
+    batch_id = time.strftime('%Y%m%d-%H%M%S') + '-' + uuid.uuid4().hex[:6]
+    bdir = batch_root(fit_dir) / batch_id
+    bdir.mkdir(parents=True)
+    # the batch state exists before the first fit is queued and is updated with every job, so that no queued fit is
+    # left without its batch
+    state = dict(batch_id=batch_id, model=model_name, pattern=pattern, submitted=time.time(),
+                 items=[{'file': path.name, 'job_id': None} for path in files], **fit_options)
+    _write_state(bdir, state)
+    try:
+        for i, path in enumerate(files):
+            # one model script per data file, in a folder of its own since the script name must not change
+            script = bdir / (str(i).zfill(3) + '_' + path.stem) / model_name
+            script.parent.mkdir(parents=True)
+            shutil.copyfile(runfile, script)
+            filelist = [path.name] + datafile_names[1:]
+            api_sasview.write_data_filenames_to_runfile(runfile=str(script), filelist=filelist)
+            datafile_paths = [str(Path(file_dir) / name) for name in filelist]
+            state['items'][i]['job_id'] = fit_jobs.submit_fit(fit_dir, script, datafile_paths, **fit_options)
+            _write_state(bdir, state)
+    except Exception as exc:
+        state['error'] = str(exc)
+        _write_state(bdir, state)
+        raise
+    return batch_id
+
+
+def _write_state(bdir: Path, state: Dict[str, Any]) -> None:
+    tmp = bdir / (BATCH_STATE_FILE + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp, bdir / BATCH_STATE_FILE)
+
+
+def get_batch(fit_dir, batch_id: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(batch_root(fit_dir) / batch_id / BATCH_STATE_FILE) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def list_batches(fit_dir) -> List[Dict[str, Any]]:
+    """
+    :return: (list) states of all batches found in fit_dir, newest first
+    """
+    root = batch_root(fit_dir)
+    if not root.is_dir():
+        return []
+    batches = [get_batch(fit_dir, p.name) for p in root.iterdir() if (p / BATCH_STATE_FILE).is_file()]
+    return sorted((b for b in batches if b is not None), key=lambda b: b.get('submitted', 0), reverse=True)
+
+
+def cancel_batch(fit_dir, batch_id: str) -> None:
+    batch = get_batch(fit_dir, batch_id)
+    if batch is None:
+        return
+    for item in batch['items']:
+        if item['job_id'] is not None:
+            fit_jobs.cancel_job(fit_dir, item['job_id'])
+
+
+def batch_table(fit_dir, batch_id: str) -> pandas.DataFrame:
+    """
+    Gathers the fits of a batch into one table with a row per data file. Finished fits contribute the best value
+    and the uncertainty of every parameter, see fit_jobs.fit_summary().
+
+    :return: (Pandas dataframe) columns file, status, chisq, and per parameter '<name>' and '<name> err'; files
+             whose fit was never queued have the status UNSUBMITTED
+    """
+    batch = get_batch(fit_dir, batch_id)
+    if batch is None:
+        return pandas.DataFrame()
+    rows = []
+    for item in batch['items']:
+        if item['job_id'] is None:
+            rows.append({'file': item['file'], 'status': UNSUBMITTED})
+            continue
+        job = fit_jobs.get_job(fit_dir, item['job_id']) or {}
+        row = {'file': item['file'], 'status': job.get('status', 'missing')}
+        progress = fit_jobs.get_progress(fit_dir, item['job_id']) or {}
+        row['chisq'] = progress.get('best_chisq')
+        for label, entry in (fit_jobs.fit_summary(fit_dir, item['job_id']) or {}).items():
+            row[label] = entry['best']
+            row[label + ' err'] = entry['std']
+        rows.append(row)
+    return pandas.DataFrame(rows)
@@ -0,0 +1,224 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+import hashlib
+import json
+import os
+from pathlib import Path
+import threading
+from typing import Any, Dict, Optional
+import uuid
+
+import numpy
+import pandas
+
+# name of the cache folder inside the gitignored SANS_fit folder of an experiment
+CACHE_DIR_NAME = '.cache'
+
+
+def digest(*parts: Any) -> str:
+    """
+    Stable SHA-256 digest of a mix of strings, bytes, numbers, numpy arrays, Pandas objects, and (nested) lists and
+    dictionaries thereof.
+
+    :return: (str) hex digest
+    """
+    h = hashlib.sha256()
+
+    def _update(part):
+        if isinstance(part, bytes):
+            h.update(part)
+        elif isinstance(part, numpy.ndarray):
+            h.update(str(part.dtype).encode())
+            h.update(str(part.shape).encode())
+            h.update(numpy.ascontiguousarray(part).tobytes())
+        elif isinstance(part, (pandas.DataFrame, pandas.Series)):
+            h.update(part.to_json(orient='split', double_precision=15).encode())
+        elif isinstance(part, dict):
+            h.update(b'{')
+            for key in sorted(part, key=str):
+                _update(str(key))
+                _update(part[key])
+            h.update(b'}')
+        elif isinstance(part, (list, tuple)):
+            h.update(b'[')
+            for item in part:
+                _update(item)
+            h.update(b']')
+        else:
+            h.update(json.dumps(part, default=str).encode())
+        h.update(b'\x00')
+
+    for p in parts:
+        _update(p)
+    return h.hexdigest()
+
+
+# digests of files keyed by resolved path, together with the (mtime, size) signature they were computed for
+_digest_memo: Dict[str, tuple] = {}
+
+
+def stat_signature(path) -> Optional[tuple]:
+    """
+    :return: (tuple) mtime and size of a file, None if it does not exist
+    """
+    try:
+        stat = Path(path).stat()
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def file_digest(path) -> str:
+    """
+    SHA-256 digest of a file's content. The digest is only recomputed when the file's mtime or size changed since the
+    last call.
+
+    :param path: (str or Path-like) the file
+    :return: (str) hex digest
+    """
+    path = Path(path)
+    key = str(path.resolve())
+    signature = stat_signature(path)
+    memo = _digest_memo.get(key)
+    if memo is not None and memo[0] == signature:
+        return memo[1]
+    h = hashlib.sha256()
+    with path.open("rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    _digest_memo[key] = (signature, h.hexdigest())
+    return h.hexdigest()
+
+
+def cache_dir(fit_dir, name: str) -> Path:
+    """
+    :return: (Path) the cache folder for name below the user fit directory, created if necessary
+    """
+    path = Path(fit_dir).expanduser().resolve() / CACHE_DIR_NAME / name
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+class ArrayCache:
+    """
+    Bounded LRU cache of dictionaries of numpy arrays. The memory tier evicts least recently used entries once their
+    combined size exceeds max_bytes. An optional disk tier stores entries as .npz files in a directory that is passed
+    per call, so that one process-wide cache can serve several experiments. Each disk directory is bounded by
+    max_disk_bytes; put() deletes the least recently used .npz files of a directory once it grows beyond that.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 2 ** 20, max_disk_bytes: int = 1024 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.nbytes = 0
+        self._entries: OrderedDict[str, Dict[str, numpy.ndarray]] = OrderedDict()
+        self._lock = threading.Lock()
+        # estimated size of the .npz files per disk directory, counted once and then updated by put()
+        self._disk_bytes: Dict[str, int] = {}
+
+    @staticmethod
+    def _size(value: Dict[str, numpy.ndarray]) -> int:
+        return sum(a.nbytes for a in value.values())
+
+    def _insert(self, key: str, value: Dict[str, numpy.ndarray]) -> None:
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._size(self._entries.pop(key))
+            self._entries[key] = value
+            self.nbytes += self._size(value)
+            while self.nbytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= self._size(evicted)
+
+    def get(self, key: str, disk_dir=None) -> Optional[Dict[str, numpy.ndarray]]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                return value
+        if disk_dir is None:
+            return None
+        path = Path(disk_dir) / (key + '.npz')
+        try:
+            with numpy.load(path, allow_pickle=False) as npz:
+                value = {name: npz[name] for name in npz.files}
+            # the modification time orders the disk entries for pruning
+            os.utime(path)
+        except (IOError, ValueError):
+            return None
+        self._insert(key, value)
+        return value
+
+    @staticmethod
+    def _disk_entries(disk_dir: Path):
+        """
+        :param disk_dir: (Path) disk tier directory
+        :return: (list) (mtime, size, path) of the stored .npz files, oldest first; temporary files are skipped
+        """
+        entries = []
+        for path in disk_dir.glob('*.npz'):
+            if path.name.endswith('.tmp.npz'):
+                continue
+            try:
+                stat = path.stat()
+            except IOError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort(key=lambda entry: entry[0])
+        return entries
+
+    def _prune_disk(self, disk_dir: Path, added: int) -> None:
+        """
+        Deletes the least recently used .npz files of disk_dir until it holds at most max_disk_bytes.
+
+        :param disk_dir: (Path) disk tier directory
+        :param added: (int) size of the file just written
+        :return: no return value
+        """
+        dkey = str(disk_dir)
+        with self._lock:
+            usage = self._disk_bytes.get(dkey)
+            if usage is not None:
+                usage += added
+                self._disk_bytes[dkey] = usage
+                if usage <= self.max_disk_bytes:
+                    return
+        entries = self._disk_entries(disk_dir)
+        usage = sum(entry[1] for entry in entries)
+        # never delete the newest entry, which was just written
+        for _, size, path in entries[:-1]:
+            if usage <= self.max_disk_bytes:
+                break
+            try:
+                path.unlink()
+            except IOError:
+                continue
+            usage -= size
+        with self._lock:
+            self._disk_bytes[dkey] = usage
+
+    def put(self, key: str, value: Dict[str, numpy.ndarray], disk_dir=None) -> None:
+        value = {name: numpy.asarray(a) for name, a in value.items()}
+        self._insert(key, value)
+        if disk_dir is None:
+            return
+        path = Path(disk_dir) / (key + '.npz')
+        tmp = path.with_name(path.stem + '.' + uuid.uuid4().hex + '.tmp.npz')
+        try:
+            numpy.savez(tmp, **value)
+            os.replace(tmp, path)
+        except IOError:
+            if tmp.exists():
+                tmp.unlink()
+            return
+        try:
+            added = path.stat().st_size
+        except IOError:
+            return
+        self._prune_disk(Path(disk_dir), added)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
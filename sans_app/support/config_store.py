@@ -0,0 +1,148 @@
+from __future__ import annotations
+
+import json
+import os
+from pathlib import Path
+import threading
+from typing import Any, Dict, List
+import uuid
+
+import pandas
+
+from sans_app.support import caching
+
+# Instrument configurations are JSON files with one record per setting, columns 'setting' and 'value'.
+CONFIG_SUFFIX = '.json'
+
+
+class _Entry:
+    def __init__(self, signature, frame: pandas.DataFrame):
+        self.signature = signature
+        self.frame = frame
+        # parsed records for change detection, independent of the formatting of the file and of the dtypes that
+        # read_json infers, e.g. 4.0 is read back as 4
+        self.records = json.loads(frame.to_json(orient='records'))
+        self.configuration = frame.set_index('setting').T.to_dict('records')[0]
+
+
+class ConfigStore:
+    """
+    Parsed index of the instrument configurations of one folder, shared by the pages of a process. Files are only
+    parsed again when their mtime or size changed, and only written when their content really changes. Writes go to a
+    temporary file that is swapped in atomically.
+    """
+
+    def __init__(self, config_dir):
+        self.config_dir = Path(config_dir)
+        self._entries: Dict[str, _Entry] = {}
+        self._lock = threading.Lock()
+
+    def names(self) -> List[str]:
+        """
+        :return: (list) sorted names of the configuration files
+        """
+        try:
+            return sorted(entry.name for entry in os.scandir(self.config_dir)
+                          if entry.is_file() and entry.name.endswith(CONFIG_SUFFIX) and not entry.name.startswith('.'))
+        except FileNotFoundError:
+            return []
+
+    def _entry(self, name: str) -> _Entry:
+        path = self.config_dir / name
+        signature = caching.stat_signature(path)
+        if signature is None:
+            with self._lock:
+                self._entries.pop(name, None)
+            raise FileNotFoundError(str(path))
+        with self._lock:
+            entry = self._entries.get(name)
+        if entry is not None and entry.signature == signature:
+            return entry
+        entry = _Entry(signature, pandas.read_json(path, orient='records'))
+        with self._lock:
+            self._entries[name] = entry
+        return entry
+
+    def frame(self, name: str) -> pandas.DataFrame:
+        """
+        :return: (Pandas dataframe) a copy of the configuration with columns setting and value
+        """
+        return self._entry(name).frame.copy(deep=True)
+
+    def configuration(self, name: str) -> Dict[str, Any]:
+        """
+        :return: (dict) setting -> value, the form expected by fnSimulateData and the PSE
+        """
+        return dict(self._entry(name).configuration)
+
+    def configurations(self, names: List[str]) -> List[Dict[str, Any]]:
+        return [self.configuration(name) for name in names]
+
+    def _write(self, name: str, data: bytes) -> None:
+        path = self.config_dir / name
+        tmp = path.with_name('.' + name + '.' + uuid.uuid4().hex + '.tmp')
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        finally:
+            if tmp.exists():
+                tmp.unlink()
+
+    def save(self, name: str, df: pandas.DataFrame) -> bool:
+        """
+        Writes a configuration if it differs from the stored one.
+
+        :param name: (str) file name of the configuration
+        :param df: (Pandas dataframe) the configuration with columns setting and value
+        :return: (bool) whether the file was written
+        """
+        text = df.to_json(orient='records')
+        try:
+            if self._entry(name).records == json.loads(text):
+                return False
+        except (FileNotFoundError, ValueError):
+            pass
+        self._write(name, text.encode())
+        entry = _Entry(caching.stat_signature(self.config_dir / name), df.copy(deep=True))
+        with self._lock:
+            self._entries[name] = entry
+        return True
+
+    def write_bytes(self, name: str, data: bytes) -> None:
+        """
+        Stores an uploaded configuration file as it is.
+        """
+        self._write(name, data)
+
+    def copy(self, source: str, name: str) -> None:
+        with open(self.config_dir / source, 'rb') as f:
+            self._write(name, f.read())
+
+    def delete(self, name: str) -> bool:
+        """
+        :return: (bool) whether the configuration existed
+        """
+        with self._lock:
+            self._entries.pop(name, None)
+        try:
+            os.remove(self.config_dir / name)
+        except FileNotFoundError:
+            return False
+        return True
+
+
+_stores: Dict[str, ConfigStore] = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(config_dir) -> ConfigStore:
+    """
+    :return: (ConfigStore) the process-wide store of a configuration folder
+    """
+    key = str(Path(config_dir).expanduser().resolve())
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            store = _stores[key] = ConfigStore(key)
+        return store
@@ -1,8 +1,16 @@
 from __future__ import annotations
 
-from dataclasses import dataclass, field
+import atexit
+import copy
+from dataclasses import dataclass, field, fields
+import json
+import os
 from pathlib import Path
-from typing import ClassVar, Any
+import threading
+import time
+from typing import ClassVar, Any, Dict, Optional, Set, Tuple
+import uuid
+import weakref
 
 from roadmap_datamanager.configuration import BaseConfig, load_config, save_config
 from pse.configuration import DataManagerConfig as PSEConfig
@@ -13,6 +21,9 @@ class DataManagerConfig(PSEConfig):
     CONFIG_APP_NAME: ClassVar[str] = "sans_app"
     CONFIG_APP_AUTHOR: ClassVar[str] = "streamlit"
     CONFIG_FILENAME: ClassVar[str] = "config.json"
+    # large tables of the Experimental Optimization page, stored in a sidecar file next to the configuration
+    SIDECAR_FIELDS: ClassVar[tuple] = ('pse_parameters_edited_json', 'pse_configs_json', 'pse_configs_edited_json',
+                                       'pse_configs_original_json')
 
     # Models and Fit configuration
     fit_model_name: str = field(
@@ -27,12 +38,39 @@ class DataManagerConfig(PSEConfig):
         default=100,
         metadata={"config_groups": ["fit"]}
     )
+    fit_rhat_stop: float = field(
+        default=0.0,
+        metadata={"config_groups": ["fit"]}
+    )
+    # parallel evaluation of DREAM populations: 'serial', 'thread' or 'process', 0 workers shares the cores evenly
+    # between the concurrently running fits
+    fit_mapper: str = field(
+        default='process',
+        metadata={"config_groups": ["fit"]}
+    )
+    fit_workers: int = field(
+        default=0,
+        metadata={"config_groups": ["fit"]}
+    )
+    # seed fits from earlier results of the same model and use a shorter burn-in, opt-in since it changes the sampling
+    fit_warm_start: bool = field(
+        default=False,
+        metadata={"config_groups": ["fit"]}
+    )
+    fit_batch_pattern: str = field(
+        default='*',
+        metadata={"config_groups": ["fit"]}
+    )
 
     # Simulation and Comparison configuration
     sim_config_name: str = field(
         default='',
         metadata={"config_groups": ["sim"]}
     )
+    sim_disk_cache: bool = field(
+        default=True,
+        metadata={"config_groups": ["sim"]}
+    )
 
     # Experimental Optimization configuration
     pse_model_name: str = field(
@@ -88,24 +126,239 @@ class DataManagerConfig(PSEConfig):
         default=100,
         metadata={"config_groups": ["pse"]}
     )
+    # worker processes of the grid screening, 0 uses all cores
+    pse_grid_workers: int = field(
+        default=0,
+        metadata={"config_groups": ["pse"]}
+    )
+
+    def save(self, *args, **kwargs):
+        """
+        Persists the configuration through the debounced writer of this module, see save_persistent_cfg().
+        """
+        if args or kwargs:
+            return super().save(*args, **kwargs)
+        return save_persistent_cfg(self)
+
+
+# Writes of the persistent configuration are coalesced within this window. Only fields that changed since the last
+# write are considered, the sidecar and the main file are only rewritten if any of their own fields changed.
+SAVE_DEBOUNCE = 1.0
+SIDECAR_SUFFIX = '.pse'
+
+
+def _json_default(value):
+    # numpy scalars from dataframe records
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+
+def _dumps(value) -> str:
+    return json.dumps(value, sort_keys=True, default=_json_default)
+
+
+def _sidecar_path(path: Path) -> Path:
+    return path.with_name(path.stem + SIDECAR_SUFFIX + path.suffix)
+
+
+def _snapshot(cfg) -> Dict[str, str]:
+    return {f.name: _dumps(getattr(cfg, f.name)) for f in fields(cfg)}
+
+
+def _main_snapshot(cfg) -> Dict[str, str]:
+    sidecar_fields = set(type(cfg).SIDECAR_FIELDS)
+    return {name: text for name, text in _snapshot(cfg).items() if name not in sidecar_fields}
+
+
+# path and fields of the configuration file as last written by this process
+_main_written: Optional[Tuple[Path, Dict[str, str]]] = None
+
+
+class _ConfigWriter:
+    """
+    Write-behind persistence of one app configuration object, i.e. of one session. The serialized value of every
+    field at the last write is kept, and every save compares all fields against it, so that in-place changes of list
+    and dictionary fields are detected as well. A save only causes I/O if a field really changed. Writes within
+    SAVE_DEBOUNCE of the previous one are deferred to a timer, which writes the latest state once the window has
+    passed.
+    """
+
+    def __init__(self, cfg):
+        self._cfg = weakref.ref(cfg)
+        self.path: Optional[Path] = None
+        self._written: Dict[str, str] = {}
+        self._last_write = 0.0
+        self._timer: Optional[threading.Timer] = None
+        # strong reference to the configuration while a deferred write is pending, so that it outlives the timer
+        self._pending = None
+        self._lock = threading.RLock()
+
+    def _changes(self, cfg) -> Set[str]:
+        return {name for name, text in _snapshot(cfg).items() if self._written.get(name) != text}
+
+    def save(self, force: bool = False) -> Optional[Path]:
+        with self._lock:
+            cfg = self._cfg()
+            if cfg is None or (self.path is not None and not self._changes(cfg)):
+                return self.path
+            wait = self._last_write + SAVE_DEBOUNCE - time.monotonic()
+            if force or wait <= 0 or self.path is None:
+                return self.flush()
+            if self._timer is None:
+                self._pending = cfg
+                self._timer = threading.Timer(wait, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+            return self.path
+
+    def flush(self) -> Optional[Path]:
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            cfg = self._cfg()
+            self._pending = None
+            if cfg is None:
+                return self.path
+            snapshot = _snapshot(cfg)
+            dirty = {name for name, text in snapshot.items() if self._written.get(name) != text}
+            if not dirty and self.path is not None:
+                return self.path
+            sidecar_fields = set(type(cfg).SIDECAR_FIELDS)
+            if self.path is None or dirty - sidecar_fields:
+                self.path = self._write_main(cfg)
+            if dirty & sidecar_fields:
+                self._write_sidecar(cfg)
+            self._written = snapshot
+            self._last_write = time.monotonic()
+            return self.path
+
+    @staticmethod
+    def _write_main(cfg) -> Path:
+        global _main_written
+        cls = type(cfg)
+        filename = getattr(cls, "CONFIG_FILENAME", "config.json")
+        # the sidecar fields are written with their defaults, a shallow copy avoids touching the live object
+        stripped = copy.copy(cfg)
+        for f in fields(cls):
+            if f.name in cls.SIDECAR_FIELDS:
+                setattr(stripped, f.name, f.default_factory())
+        # write to a unique temporary name and swap it in, so that readers never see a partially written file and
+        # concurrent sessions do not write into each other's temporary file
+        tmp_name = filename + '.' + uuid.uuid4().hex + '.tmp'
+        tmp = save_config(
+            stripped,
+            env_var=getattr(cls, "CONFIG_ENV_VAR", None),
+            app_name=cls.CONFIG_APP_NAME,
+            app_author=cls.CONFIG_APP_AUTHOR,
+            filename=tmp_name,
+        )
+        tmp = Path(tmp)
+        if tmp.name != tmp_name:
+            # the environment variable names the file, which was written in place
+            path = tmp
+        else:
+            path = tmp.with_name(filename)
+            os.replace(tmp, path)
+        _main_written = (path, _main_snapshot(cfg))
+        return path
+
+    def _write_sidecar(self, cfg) -> None:
+        sidecar = _sidecar_path(self.path)
+        tmp = sidecar.with_name(sidecar.name + '.' + uuid.uuid4().hex + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({name: getattr(cfg, name) for name in type(cfg).SIDECAR_FIELDS}, f, default=_json_default)
+        os.replace(tmp, sidecar)
+
+    def attach(self, cfg) -> None:
+        """
+        Adopts the configuration just loaded from disk. Its tables are replaced by those of the sidecar file. A
+        configuration written before the sidecar existed keeps its tables, which are migrated to a new sidecar.
+        """
+        with self._lock:
+            # the file already holds what was loaded if this process wrote exactly these fields last
+            if _main_written is not None and _main_written[1] == _main_snapshot(cfg):
+                self.path = _main_written[0]
+            else:
+                self.path = self._write_main(cfg)
+            try:
+                with open(_sidecar_path(self.path)) as f:
+                    tables = json.load(f)
+            except (IOError, ValueError):
+                tables = None
+            if tables is None:
+                self._write_sidecar(cfg)
+            else:
+                for name in type(cfg).SIDECAR_FIELDS:
+                    if name in tables:
+                        setattr(cfg, name, tables[name])
+            self._written = _snapshot(cfg)
+            self._last_write = time.monotonic()
+
+
+# one writer per configuration object, kept outside of the object so that nothing but its fields is serialized
+_writers: Dict[int, _ConfigWriter] = {}
+_writers_lock = threading.Lock()
+
+
+def _writer(cfg) -> _ConfigWriter:
+    with _writers_lock:
+        writer = _writers.get(id(cfg))
+        if writer is None or writer._cfg() is not cfg:
+            writer = _writers[id(cfg)] = _ConfigWriter(cfg)
+            # drop the writer with the session's configuration; a pending write keeps the configuration alive until
+            # its timer has written it, and flush_all writes what is left at exit
+            weakref.finalize(cfg, _release, id(cfg), writer)
+        return writer
+
+
+def _release(key: int, writer: _ConfigWriter) -> None:
+    with _writers_lock:
+        if _writers.get(key) is writer:
+            del _writers[key]
+
+
+@atexit.register
+def flush_all() -> None:
+    """
+    Writes deferred changes of all app configurations now.
+    """
+    with _writers_lock:
+        writers = list(_writers.values())
+    for writer in writers:
+        writer.flush()
 
 
 def load_persistent_cfg() -> DataManagerConfig:
     config_cls = DataManagerConfig
-    return load_config(
+    cfg = load_config(
         config_cls,
         env_var=getattr(config_cls, "CONFIG_ENV_VAR", None),
         app_name=config_cls.CONFIG_APP_NAME,
         app_author=config_cls.CONFIG_APP_AUTHOR,
         filename=getattr(config_cls, "CONFIG_FILENAME", "config.json"),
     )
+    _writer(cfg).attach(cfg)
+    return cfg
+
+
+def save_persistent_cfg(data: Any, force: bool = False) -> Path:
+    """
+    Persists the app configuration. Nothing is written if no field changed since the last write, and writes within
+    SAVE_DEBOUNCE seconds of the previous one are deferred and coalesced. The tables in SIDECAR_FIELDS go to a
+    separate file, so that changes of other fields do not rewrite them and vice versa. Both files are replaced
+    atomically.
+
+    :param data: (DataManagerConfig) the configuration
+    :param force: (bool) write pending changes immediately
+    :return: (Path) the configuration file
+    """
+    return _writer(data).save(force=force)
+
 
-def save_persistent_cfg(data: Any) -> Path:
-    cls = type(data)
-    return save_config(
-        data,
-        env_var=getattr(cls, "CONFIG_ENV_VAR", None),
-        app_name=cls.CONFIG_APP_NAME,
-        app_author=cls.CONFIG_APP_AUTHOR,
-        filename=getattr(cls, "CONFIG_FILENAME", "config.json"),
-    )
\ No newline at end of file
+def flush_persistent_cfg(data: Any) -> Optional[Path]:
+    """
+    Writes deferred changes of an app configuration now.
+    """
+    return _writer(data).flush()
@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+import os
+from pathlib import Path
+import re
+import uuid
+
+import numpy
+import pandas
+
+from sans_app.support import caching
+from sans_app.support.lazy import lazy_import
+
+sasdata = lazy_import('sasmodels.data')
+
+# Parsed SANS data files are kept as float64 arrays of shape (4, n) with the rows Q, I, dI, dQ in a hidden folder next
+# to the data files. The sidecar name contains the content digest of the data file, so that edited or replaced files
+# are parsed again.
+SIDECAR_DIR = '.sans_cache'
+COLUMNS = ('Q', 'I', 'dI', 'dQ')
+DIGEST_LENGTH = 16
+
+
+def _sidecar_path(path: Path) -> Path:
+    return path.parent / SIDECAR_DIR / (path.name + '.' + caching.file_digest(path)[:DIGEST_LENGTH] + '.npy')
+
+
+def _sidecar_pattern(path: Path):
+    """
+    :return: (compiled regex) matching exactly the sidecar names of a data file, not those of a.dat.1 for a.dat
+    """
+    return re.compile(re.escape(path.name) + r'\.[0-9a-f]{' + str(DIGEST_LENGTH) + r'}\.npy')
+
+
+def _parse(path: Path) -> numpy.ndarray:
+    ds = sasdata.load_data(str(path))
+    n = len(ds.x)
+    columns = []
+    for values in (ds.x, ds.y, ds.dy, ds.dx):
+        columns.append(numpy.zeros(n) if values is None else numpy.asarray(values, dtype=numpy.float64))
+    return numpy.vstack(columns)
+
+
+def _write_sidecar(path: Path, sidecar: Path, data: numpy.ndarray) -> None:
+    sidecar_dir = sidecar.parent
+    if not sidecar_dir.is_dir():
+        sidecar_dir.mkdir()
+        # keep the cache out of version control of the data folder
+        with open(sidecar_dir / '.gitignore', 'w') as f:
+            f.write('*\n')
+    # sidecars of previous versions of this file
+    pattern = _sidecar_pattern(path)
+    for stale in sidecar_dir.iterdir():
+        if stale != sidecar and pattern.fullmatch(stale.name):
+            stale.unlink()
+    tmp = sidecar.with_name(sidecar.name + '.' + uuid.uuid4().hex + '.tmp')
+    with open(tmp, 'wb') as f:
+        numpy.save(f, data)
+    os.replace(tmp, sidecar)
+
+
+def read_columns(path) -> numpy.ndarray:
+    """
+    Reads a SANS data file (.ABS, .sub, .dat, ...) through its binary sidecar. The text file is only parsed when no
+    sidecar for its current content exists. Missing dI or dQ columns are returned as zeros.
+
+    :param path: (str or Path-like) the data file
+    :return: (numpy array) read-only memory map of shape (4, n) with the rows Q, I, dI, dQ
+    """
+    path = Path(path)
+    sidecar = _sidecar_path(path)
+    if not sidecar.is_file():
+        data = _parse(path)
+        try:
+            _write_sidecar(path, sidecar, data)
+        except OSError:
+            # read-only data folder, serve the parsed data
+            return data
+    return numpy.load(sidecar, mmap_mode='r')
+
+
+def load_frame(path) -> pandas.DataFrame:
+    """
+    :return: (Pandas dataframe) with the columns Q, I, dI, dQ of a SANS data file, a writable copy of the sidecar
+             memory map
+    """
+    data = read_columns(path)
+    return pandas.DataFrame({column: numpy.array(data[i]) for i, column in enumerate(COLUMNS)})
@@ -0,0 +1,400 @@
+from __future__ import annotations
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import copy
+import itertools
+import math
+import multiprocessing
+import multiprocessing.util
+import os
+from pathlib import Path
+import shutil
+import tempfile
+import threading
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+import numpy
+import pandas
+
+from sans_app.support import caching
+from sans_app.support import simulation
+from sans_app.support.lazy import lazy_import
+
+api_sasview = lazy_import('scattertools.support.api_sasview')
+
+# cache folder of the information gains of evaluated design points
+GRID_CACHE = 'design_grid'
+# iterations of the Levenberg-Marquardt fit of a simulated design point
+LM_STEPS = 200
+
+# information gains of design points, one entry per point, see point_key()
+gain_cache = caching.ArrayCache(max_bytes=16 * 2 ** 20)
+
+
+# ------------ design grid -------------
+
+def _number(value) -> Optional[float]:
+    """
+    :return: (float) a value of the shorthand summary, which holds numbers or their string representation, None for
+             empty entries
+    """
+    if value is None or (isinstance(value, str) and value.strip() in ('', 'None', 'nan')):
+        return None
+    value = float(value)
+    return None if math.isnan(value) else value
+
+
+def grid_axes(df_summary: pandas.DataFrame) -> List[Dict[str, Any]]:
+    """
+    Extracts the axes of the design grid from the shorthand summary of page 4, the rows with l_opt, u_opt and
+    step_opt.
+
+    :return: (list) per axis a dictionary with the summary row index 'row', 'name' and the grid 'values'
+    """
+    axes = []
+    for index, row in df_summary.iterrows():
+        lower, upper, step = _number(row['l_opt']), _number(row['u_opt']), _number(row['step_opt'])
+        if lower is None or upper is None or not step:
+            continue
+        values = numpy.arange(lower, upper + 0.5 * step, step)
+        name = row['parameter'] if row['config.'] in ('*', '-') else row['parameter'] + ' [' + row['config.'] + ']'
+        axes.append({'row': index, 'name': name, 'values': values})
+    return axes
+
+
+def design_points(axes: List[Dict[str, Any]]) -> numpy.ndarray:
+    """
+    :return: (numpy array) all combinations of axis values, one row per design point
+    """
+    if not axes:
+        return numpy.empty((1, 0))
+    return numpy.array(list(itertools.product(*[axis['values'] for axis in axes])), dtype=float)
+
+
+def num_points(axes: List[Dict[str, Any]]) -> int:
+    """
+    :return: (int) number of design points, without building them, see design_points()
+    """
+    return math.prod(len(axis['values']) for axis in axes)
+
+
+def apply_point(df_summary: pandas.DataFrame, configurations: List[Dict[str, Any]], axes, point) -> tuple:
+    """
+    Resolves the model parameter values and instrument configurations of one design point. Design values of model
+    parameters flagged as relative (types without 'f') are fractions of the fit range.
+
+    :return: (dict) parameter -> value, (list) configurations with the design settings applied
+    """
+    design = {axis['row']: float(value) for axis, value in zip(axes, point)}
+    values = {}
+    configurations = copy.deepcopy(configurations)
+    for index, row in df_summary.iterrows():
+        if index in design:
+            value = design[index]
+        else:
+            try:
+                value = _number(row['value'])
+            except ValueError:
+                # non-numeric instrument setting
+                value = row['value']
+        if row['type'] == 'n':
+            targets = range(len(configurations)) if row['config.'] == '*' else [int(row['config.'])]
+            for i in targets:
+                configurations[i][row['parameter']] = value
+            continue
+        if index in design and not row['type'].startswith('f'):
+            lower, upper = _number(row['l_fit']), _number(row['u_fit'])
+            value = lower + value * (upper - lower)
+        values[row['parameter']] = value
+    return values, configurations
+
+
+def information_parameters(df_summary: pandas.DataFrame) -> Dict[str, float]:
+    """
+    :return: (dict) parameter -> width of the fit range, for all parameters that contribute to the information content
+    """
+    widths = {}
+    for _, row in df_summary.iterrows():
+        if row['type'] in ('d', 'fd'):
+            widths[row['parameter']] = _number(row['u_fit']) - _number(row['l_fit'])
+    return widths
+
+
+def information_gain(cov: numpy.ndarray, labels: Sequence[str], widths: Dict[str, float]) -> float:
+    """
+    Information gain in bits of a Gaussian posterior over a uniform prior on the fit ranges. Nuisance parameters are
+    marginalized, which for a Gaussian means dropping their rows and columns of the covariance matrix.
+
+    :param cov: (numpy array) posterior covariance of all fit parameters
+    :param labels: (list) fit parameter labels in the order of cov
+    :param widths: (dict) fit range widths of the information parameters, see information_parameters()
+    :return: (float) prior entropy minus posterior entropy, nan for a singular covariance
+    """
+    names = [name for name in widths if name in labels]
+    idx = [list(labels).index(name) for name in names]
+    sign, logdet = numpy.linalg.slogdet(2 * math.pi * math.e * cov[numpy.ix_(idx, idx)])
+    if sign <= 0:
+        return float('nan')
+    prior = sum(math.log2(widths[name]) for name in names)
+    return prior - 0.5 * logdet / math.log(2)
+
+
+def point_key(model_digest: str, values, configurations, qmin, qmax, t_total, method: str) -> str:
+    return caching.digest('design', model_digest, values, configurations, float(qmin), float(qmax),
+                          float(t_total or 0), method)
+
+
+# ------------ worker processes -------------
+
+# per worker process: working directory and fit object per model, see _working_dir()
+_worker_state: Dict[str, tuple] = {}
+
+
+def _working_dir(source: Dict[str, Any]) -> tuple:
+    """
+    Prepares a private copy of the model script in a worker, pointed at simulated data files, once per worker and
+    model.
+    """
+    from scattertools.support import molstat
+
+    state = _worker_state.get(source['model_digest'])
+    if state is not None:
+        return state
+    wdir = Path(tempfile.mkdtemp(prefix='sans_design_'))
+    # worker processes end through os._exit, which skips atexit handlers
+    multiprocessing.util.Finalize(None, shutil.rmtree, args=(str(wdir),), kwargs={'ignore_errors': True},
+                                  exitpriority=10)
+    runfile = wdir / source['runfile_name']
+    shutil.copyfile(source['runfile'], runfile)
+    api_sasview.write_data_filenames_to_runfile(runfile=str(runfile), filelist=source['sim_files'])
+    for name in source['sim_files']:
+        api_sasview.write_dummy_sans_file(str(wdir / name))
+    with simulation.working_directory(wdir):
+        fitobj = molstat.CMolStat(fitsource="SASView", spath=str(wdir), mcmcpath="MCMC",
+                                  runfile=source['runfile_name'], state=None, problem=None)
+    _worker_state[source['model_digest']] = (wdir, fitobj)
+    return wdir, fitobj
+
+
+def _fit_point(source: Dict[str, Any], values: Dict[str, float], configurations, qmin, qmax, t_total,
+               widths: Dict[str, float]) -> float:
+    """
+    Simulates the data of one design point, fits them with Levenberg-Marquardt starting at the true values, and
+    returns the information gain of the fit covariance. Runs in a worker process.
+    """
+    from bumps import fitproblem, fitters
+
+    wdir, fitobj = _working_dir(source)
+    simpar = pandas.DataFrame({'par': list(values), 'value': list(values.values())})
+    dataset_configurations = [configurations] * len(source['sim_files'])
+    with simulation.working_directory(wdir):
+        liData = fitobj.fnSimulateData(basefilename='sim.dat', liConfigurations=dataset_configurations, qmin=qmin,
+                                       qmax=qmax, t_total=t_total, simpar=simpar, average=True)
+        for name, data in zip(source['sim_files'], liData):
+            simulation.write_sans_file(data[1], wdir / name)
+        problem = fitproblem.load_problem(str(wdir / source['runfile_name']))
+    labels = list(problem.labels())
+    p = numpy.asarray(problem.getp(), dtype=float)
+    for name, value in values.items():
+        if name in labels:
+            p[labels.index(name)] = value
+    problem.setp(p)
+    driver = fitters.FitDriver(fitclass=fitters.LevenbergMarquardtFit, problem=problem, monitors=[], steps=LM_STEPS)
+    driver.clip()
+    x, _ = driver.fit()
+    problem.setp(x)
+    return information_gain(driver.cov(), labels, widths)
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+
+
+def _get_pool(workers: int) -> ProcessPoolExecutor:
+    """
+    Returns the process-wide pool of design point evaluators. Its workers keep their prepared models between grid
+    evaluations.
+    """
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers != workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False, cancel_futures=True)
+            # spawn instead of fork, since the Streamlit server process runs many threads
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+            _pool_workers = workers
+    return _pool
+
+
+def _reset_pool() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+# ------------ Fisher information -------------
+
+# finite-difference step of the Jacobian, relative to the fit range of a parameter
+JACOBIAN_STEP = 1e-4
+
+
+def _fisher_gains(source: Dict[str, Any], tasks: List[tuple], reference: Dict[str, float], qmin, qmax, t_total,
+                  widths: Dict[str, float]) -> List[float]:
+    """
+    Information gains of design points from the Fisher information of the model at the design values, without
+    simulating and fitting data. Points are grouped by instrument geometry. Per group, one fnSimulateData call at the
+    reference values provides Q-grid, resolution and counting statistics, and the intensities and finite-difference
+    Jacobians of all points of the group are evaluated in a single batch. Uncertainties are scaled to each point's
+    intensity and counting time.
+
+    :param tasks: (list) per design point (parameter values, configurations), see apply_point()
+    :param reference: (dict) parameter values of the summary without design values
+    :return: (list) information gain per design point
+    """
+    wdir, fitobj = _working_dir(source)
+    problem = simulation.get_problem(wdir, source['runfile_name'], source['sim_files'])
+    labels = list(problem.labels())
+    lower, upper = numpy.asarray(problem.bounds(), dtype=float)
+    width = numpy.where(numpy.isfinite(upper - lower), upper - lower, 1.0)
+
+    def parameter_sets(rows):
+        return pandas.DataFrame([{name: value for name, value in values.items() if name in labels}
+                                 for values in rows])
+
+    groups = {}
+    for n, (values, configurations) in enumerate(tasks):
+        key = caching.digest([simulation.geometry(configuration) for configuration in configurations])
+        groups.setdefault(key, []).append(n)
+
+    gains = [float('nan')] * len(tasks)
+    num_datasets = len(source['sim_files'])
+    p_ref = simulation.parameter_matrix(problem, parameter_sets([reference]))
+    simpar = pandas.DataFrame({'par': list(reference), 'value': list(reference.values())})
+    for indices in groups.values():
+        configurations_ref = tasks[indices[0]][1]
+        # the server process serves other sessions, its working directory is restored after each simulation
+        with simulation.working_directory(wdir):
+            template = simulation.instrument_templates(fitobj, [[configurations_ref] * num_datasets], qmin, qmax,
+                                                       simpar, average=True, t_total=t_total,
+                                                       model_key=source['model_digest'])[0]
+        resolutions = [simulation.cached_resolution(df['Q'].to_numpy(dtype=float), df['dQ'].to_numpy(dtype=float))
+                       for df in template]
+        p = simulation.parameter_matrix(problem, parameter_sets([tasks[n][0] for n in indices]))
+        h = JACOBIAN_STEP * width
+        num, k = p.shape
+        stack = numpy.vstack([p_ref, p] + [p + h[j] * numpy.eye(k)[j] for j in range(k)])
+        theory = simulation.evaluate_theory(problem, resolutions, stack)
+
+        scale_ref = simulation.counting_scale(configurations_ref, t_total)
+        scale = numpy.array([simulation.counting_scale(tasks[n][1], t_total) for n in indices])
+        fisher = numpy.zeros((num, k, k))
+        for d, df in enumerate(template):
+            I_ref = theory[d][0]
+            I = theory[d][1:1 + num]
+            jacobian = (theory[d][1 + num:].reshape(k, num, -1) - I[None]) / h[:, None, None]
+            ratio = numpy.divide(I, I_ref, out=numpy.ones_like(I), where=(I_ref > 0) & (I > 0))
+            dI = df['dI'].to_numpy(dtype=float) * numpy.sqrt(ratio * scale_ref / scale[:, None])
+            weight = numpy.divide(1.0, dI ** 2, out=numpy.zeros_like(dI), where=dI > 0)
+            fisher += numpy.einsum('inq,jnq,nq->nij', jacobian, jacobian, weight)
+        for i, n in enumerate(indices):
+            gains[n] = information_gain(numpy.linalg.pinv(fisher[i]), labels, widths)
+    return gains
+
+
+# ------------ evaluation -------------
+
+def evaluate_grid(df_summary: pandas.DataFrame, configurations: List[Dict[str, Any]], runfile, datafile_names,
+                  qmin: float, qmax: float, t_total: Optional[float] = None, method: str = 'fit',
+                  subset: Optional[Sequence[int]] = None, workers: int = 0, disk_dir=None,
+                  on_progress: Optional[Callable[[int, int], None]] = None) -> pandas.DataFrame:
+    """
+    Evaluates the information gain of the points of the design grid given by the shorthand summary. With method
+    'fit', points are simulated and fitted in parallel in a pool of worker processes. With method 'fisher', the gains
+    follow from the Fisher information of the model in the server process, which is orders of magnitude faster and
+    meant for screening, see _fisher_gains(). Gains are memoized by the method and the resolved parameter values,
+    configurations, Q-range and counting time of a point, so that reruns and refined grids only evaluate new points.
+
+    :param df_summary: (Pandas dataframe) shorthand summary of page 4
+    :param configurations: (list) configuration dictionaries of the selected instrument configurations
+    :param runfile: (str or Path-like) the model script
+    :param datafile_names: (list) data file names referenced by the model script, for the number of datasets
+    :param qmin: (float) lower Q limit
+    :param qmax: (float) upper Q limit
+    :param t_total: (float or None) total counting time, None uses the times of the configurations
+    :param method: (str) 'fit' or 'fisher'
+    :param subset: (list) indices of the grid points to evaluate, None for all
+    :param workers: (int) worker processes, 0 uses all cores
+    :param disk_dir: (str or Path-like) optional persistent tier of the memo, see caching.ArrayCache
+    :param on_progress: (callable) called with the number of finished and of all points
+    :return: (Pandas dataframe) one row per evaluated design point, indexed by the point's position in the grid, with
+             a column per grid axis, 'gain' in bits, 'cached' and 'error', the exception of a failed evaluation or None
+    """
+    runfile = Path(runfile)
+    axes = grid_axes(df_summary)
+    points = design_points(axes)
+    widths = information_parameters(df_summary)
+    num = len(datafile_names)
+    source = {
+        'runfile': str(runfile),
+        'runfile_name': runfile.name,
+        'model_digest': caching.file_digest(runfile),
+        'sim_files': ['sim.dat'] if num == 1 else ['sim' + str(i) + '.dat' for i in range(num)],
+    }
+
+    indices = list(range(len(points)) if subset is None else subset)
+    gains = numpy.full(len(points), numpy.nan)
+    cached = numpy.zeros(len(points), dtype=bool)
+    errors = numpy.full(len(points), None, dtype=object)
+    pending = {}
+    for n in indices:
+        values, point_configurations = apply_point(df_summary, configurations, axes, points[n])
+        key = point_key(source['model_digest'], values, point_configurations, qmin, qmax, t_total, method)
+        entry = gain_cache.get(key, disk_dir=disk_dir)
+        if entry is not None:
+            gains[n] = float(entry['gain'][0])
+            cached[n] = True
+        else:
+            pending[n] = (key, values, point_configurations)
+
+    done = int(cached.sum())
+    if on_progress is not None:
+        on_progress(done, len(indices))
+    if pending and method == 'fisher':
+        reference, _ = apply_point(df_summary, configurations, [], [])
+        tasks = [(values, point_configurations) for key, values, point_configurations in pending.values()]
+        for n, gain in zip(pending, _fisher_gains(source, tasks, reference, qmin, qmax, t_total, widths)):
+            gains[n] = gain
+            gain_cache.put(pending[n][0], {'gain': numpy.array([gain])}, disk_dir=disk_dir)
+        if on_progress is not None:
+            on_progress(len(indices), len(indices))
+    elif pending:
+        pool = _get_pool(workers or os.cpu_count() or 1)
+        futures = {pool.submit(_fit_point, source, values, point_configurations, qmin, qmax, t_total, widths): n
+                   for n, (key, values, point_configurations) in pending.items()}
+        try:
+            for future in as_completed(futures):
+                n = futures[future]
+                done += 1
+                try:
+                    gains[n] = future.result()
+                    gain_cache.put(pending[n][0], {'gain': numpy.array([gains[n]])}, disk_dir=disk_dir)
+                except BrokenProcessPool:
+                    raise
+                except Exception as exc:
+                    # a failed fit leaves the point without a gain, it is evaluated again on the next run
+                    errors[n] = type(exc).__name__ + ': ' + str(exc)
+                if on_progress is not None:
+                    on_progress(done, len(indices))
+        except BrokenProcessPool:
+            _reset_pool()
+            raise
+
+    df = pandas.DataFrame(points[indices], columns=[axis['name'] for axis in axes], index=indices)
+    df['gain'] = gains[indices]
+    df['cached'] = cached[indices]
+    df['error'] = errors[indices]
+    return df
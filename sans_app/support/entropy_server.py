@@ -0,0 +1,202 @@
+from __future__ import annotations
+
+import atexit
+from contextlib import closing
+from dataclasses import dataclass, field
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, List, Optional, Set
+
+# Entropy (PSE) servers shared by all sessions of this app process. Sessions lease a server, servers are started on
+# demand up to MAX_SERVERS and shut down after they had no sessions for SERVER_IDLE_TIMEOUT seconds.
+MAX_SERVERS = int(os.environ.get('SANS_APP_PSE_SERVERS', 1))
+SESSIONS_PER_SERVER = int(os.environ.get('SANS_APP_PSE_SESSIONS_PER_SERVER', 8))
+# seconds between two heartbeats of an open optimization page, see touch()
+HEARTBEAT_INTERVAL = 60
+# Streamlit does not report the end of a session, a lease ends once its page missed a few heartbeats
+SESSION_TIMEOUT = float(os.environ.get('SANS_APP_PSE_SESSION_TIMEOUT', 5 * HEARTBEAT_INTERVAL))
+SERVER_IDLE_TIMEOUT = float(os.environ.get('SANS_APP_PSE_IDLE_TIMEOUT', 600))
+_REAPER_INTERVAL = 30
+
+
+@dataclass
+class _Server:
+    port: int
+    process: subprocess.Popen
+    sessions: Set[str] = field(default_factory=set)
+    idle_since: float = field(default_factory=time.time)
+    cpu_time: Optional[float] = None
+
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def busy(self) -> Optional[bool]:
+        """
+        Whether the server is running an optimization, i.e. has child processes or used CPU time since the last call.
+        An idle server only waits for requests. Requires /proc, None if this cannot be determined.
+        """
+        pid = self.process.pid
+        try:
+            with open('/proc/' + str(pid) + '/stat') as f:
+                # the command name may contain blanks, fields after it are positional
+                stat = f.read().rsplit(')', 1)[1].split()
+            children = False
+            for task in os.listdir('/proc/' + str(pid) + '/task'):
+                with open('/proc/' + str(pid) + '/task/' + task + '/children') as f:
+                    children = children or bool(f.read().strip())
+        except (OSError, IndexError):
+            return None
+        # utime, stime, cutime and cstime in clock ticks
+        cpu_time = sum(int(value) for value in stat[11:15]) / os.sysconf('SC_CLK_TCK')
+        previous, self.cpu_time = self.cpu_time, cpu_time
+        return children or (previous is not None and cpu_time > previous)
+
+
+_servers: List[_Server] = []
+# session id -> (server, last heartbeat)
+_leases: Dict[str, tuple] = {}
+_lock = threading.Lock()
+_reaper: Optional[threading.Thread] = None
+
+
+def _free_port() -> int:
+    with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
+        s.bind(('', 0))  # Bind to a free port provided by the host.
+        return s.getsockname()[1]  # Return the port number assigned.
+
+
+def _start_server() -> _Server:
+    port = _free_port()
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-c",
+            (
+                "import sys; "
+                "from scattertools.infotheory.entropy import Entropy_server; "
+                "Entropy_server().run(int(sys.argv[1]))"
+            ),
+            str(port),
+        ],
+        stdout=None,
+        stderr=None,
+    )
+    server = _Server(port=port, process=process)
+    _servers.append(server)
+    return server
+
+
+def _stop_server(server: _Server) -> None:
+    if server in _servers:
+        _servers.remove(server)
+    if server.alive():
+        server.process.terminate()
+        try:
+            server.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            server.process.kill()
+
+
+def _release(session_id: str) -> None:
+    lease = _leases.pop(session_id, None)
+    if lease is not None:
+        server = lease[0]
+        server.sessions.discard(session_id)
+        if not server.sessions:
+            server.idle_since = time.time()
+
+
+def _reap() -> None:
+    while True:
+        time.sleep(_REAPER_INTERVAL)
+        now = time.time()
+        with _lock:
+            # servers running an optimization keep their sessions and are never stopped, whatever the heartbeat age;
+            # where this is unknown the heartbeat decides alone
+            busy = {id(server) for server in _servers if server.alive() and server.busy()}
+            for session_id, (server, heartbeat) in list(_leases.items()):
+                if not server.alive() or (now - heartbeat > SESSION_TIMEOUT and id(server) not in busy):
+                    _release(session_id)
+            for server in list(_servers):
+                if id(server) in busy:
+                    server.idle_since = now
+                elif not server.alive() or (not server.sessions and now - server.idle_since > SERVER_IDLE_TIMEOUT):
+                    _stop_server(server)
+
+
+def acquire(session_id: str) -> int:
+    """
+    Leases an Entropy server to a session and returns its port. Repeated calls by the same session return the same
+    server and count as a heartbeat. Dead servers are replaced transparently.
+
+    :param session_id: (str) unique identifier of the Streamlit session
+    :return: (int) port of the server
+    """
+    global _reaper
+    with _lock:
+        if _reaper is None:
+            _reaper = threading.Thread(target=_reap, name='pse_server_reaper', daemon=True)
+            _reaper.start()
+
+        lease = _leases.get(session_id)
+        if lease is not None and lease[0].alive():
+            _leases[session_id] = (lease[0], time.time())
+            return lease[0].port
+        _release(session_id)
+
+        for server in [s for s in _servers if not s.alive()]:
+            _stop_server(server)
+        candidates = sorted(_servers, key=lambda s: len(s.sessions))
+        if candidates and (len(candidates[0].sessions) < SESSIONS_PER_SERVER or len(_servers) >= MAX_SERVERS):
+            server = candidates[0]
+        else:
+            server = _start_server()
+        server.sessions.add(session_id)
+        _leases[session_id] = (server, time.time())
+        return server.port
+
+
+def touch(session_id: str) -> bool:
+    """
+    Refreshes the heartbeat of a lease without a page rerun, e.g. from a fragment.
+
+    :param session_id: (str) unique identifier of the Streamlit session
+    :return: (bool) False if the session has no lease on a live server and must call acquire()
+    """
+    with _lock:
+        lease = _leases.get(session_id)
+        if lease is None or not lease[0].alive():
+            return False
+        _leases[session_id] = (lease[0], time.time())
+        return True
+
+
+def server_process(session_id: str) -> Optional[subprocess.Popen]:
+    """
+    :param session_id: (str) unique identifier of the Streamlit session
+    :return: (subprocess.Popen) process of the server leased to the session, None without a lease
+    """
+    with _lock:
+        lease = _leases.get(session_id)
+        return None if lease is None else lease[0].process
+
+
+def release(session_id: str) -> None:
+    """
+    Ends the lease of a session. The server keeps running for other sessions until it has been idle for
+    SERVER_IDLE_TIMEOUT seconds.
+    """
+    with _lock:
+        _release(session_id)
+
+
+@atexit.register
+def shutdown() -> None:
+    with _lock:
+        _leases.clear()
+        for server in list(_servers):
+            _stop_server(server)
@@ -0,0 +1,509 @@
+from __future__ import annotations
+
+import atexit
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import multiprocessing
+import multiprocessing.util
+import os
+from pathlib import Path
+import pickle
+import sys
+import threading
+import time
+import traceback
+import weakref
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy
+
+from sans_app.support import caching
+from sans_app.support import warm_start
+
+# bumps fitters available to fit requests
+FITTERS = {'dream': 'DreamFit', 'lm': 'LevenbergMarquardtFit'}
+# how a fit evaluates the likelihood of the points of a DREAM population
+MAPPERS = ('serial', 'thread', 'process')
+# number of loaded fit problems a worker keeps, so that alternately refitting a few models stays warm
+PROBLEM_CACHE_SIZE = int(os.environ.get('SANS_APP_ENGINE_PROBLEMS', 4))
+MCMC_DIR = 'MCMC'
+# seconds between two progress reports of a running fit
+REPORT_INTERVAL = 1.0
+# fraction of the requested MCMC steps that is sampled before a fit may stop early on convergence
+MIN_STEPS_FRACTION = 0.2
+
+
+class FitError(RuntimeError):
+    pass
+
+
+# ------------ worker process -------------
+
+@contextlib.contextmanager
+def _redirect_output(path):
+    """
+    Redirects the file descriptors of stdout and stderr of the worker to a log file, which also captures the output
+    of compiled kernels and of bumps' console monitor.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = os.dup(1), os.dup(2)
+    with open(path, 'ab', buffering=0) as log:
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        try:
+            yield
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved[0], 1)
+            os.dup2(saved[1], 2)
+            os.close(saved[0])
+            os.close(saved[1])
+
+
+def _problem_key(fit_dir: Path) -> str:
+    files = sorted(p for p in fit_dir.iterdir() if p.is_file())
+    return caching.digest([(p.name, caching.file_digest(p)) for p in files])
+
+
+def _load_problem(problems: OrderedDict, fit_dir: Path, runfile: str):
+    """
+    Returns the fit problem for the model script and data files in fit_dir, reset to its initial parameter values.
+    Problems are cached by the content of the fit directory, so their sasmodels kernels are only compiled once.
+    """
+    from bumps import fitproblem
+
+    key = _problem_key(fit_dir)
+    entry = problems.pop(key, None)
+    if entry is None:
+        print('Loading model ' + runfile + ' ...', flush=True)
+        problem = fitproblem.load_problem(str(fit_dir / (runfile + '.py')))
+        entry = (problem, problem.getp().copy())
+    problems[key] = entry
+    while len(problems) > PROBLEM_CACHE_SIZE:
+        problems.popitem(last=False)
+    problem, p0 = entry
+    problem.setp(p0)
+    return problem
+
+
+class _ProgressMonitor:
+    """
+    bumps monitor of a worker. It tracks the acceptance rate and best chi-squared of the fit, accumulates online
+    posterior statistics of the DREAM chains after burn-in, and sends progress reports to the server. Called without
+    arguments, it serves as the abort test of the fit driver, which ends the fit early on request of the server or once
+    the Gelman-Rubin statistic of all parameters is below rhat_stop.
+    """
+
+    def __init__(self, conn, problem, burn: int, steps: int, rhat_stop: float = 0.0):
+        self.conn = conn
+        self.labels = problem.labels()
+        self.dof = max(problem.dof, 1)
+        self.burn = burn
+        self.steps = steps
+        self.rhat_stop = rhat_stop
+        self.min_samples = max(10, int(steps * MIN_STEPS_FRACTION))
+        self.start = time.time()
+        self.last_report = 0.0
+        self.step = 0
+        self.best = numpy.inf
+        self.best_point = None
+        self.stop_requested = False
+        self.converged = False
+        self.accepted = 0
+        self.proposed = 0
+        self.last_points = None
+        # Welford accumulators per chain and parameter of the samples after burn-in
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+    def config_history(self, history):
+        history.requires(step=1, point=1, value=1, population_points=1, population_values=1)
+
+    def __call__(self, history=None):
+        if history is None:
+            return self.stop_requested or self.converged
+        self.step = history.step[0]
+        self._update_best(history.point[0], history.value[0])
+        points = getattr(history, 'population_points', None)
+        if points is not None and len(points):
+            population = numpy.asarray(points[0], dtype=float)
+            self._update(population)
+            values = numpy.asarray(history.population_values[0])
+            self._update_best(population[numpy.argmin(values)], numpy.min(values))
+        while self.conn.poll():
+            if self.conn.recv() == 'stop':
+                self.stop_requested = True
+        if time.time() - self.last_report >= REPORT_INTERVAL:
+            self.report()
+
+    def _update_best(self, point, value):
+        if value < self.best:
+            self.best = value
+            self.best_point = numpy.array(point, dtype=float)
+
+    def _update(self, population):
+        if self.last_points is not None and self.last_points.shape == population.shape:
+            moved = numpy.any(population != self.last_points, axis=1)
+            self.accepted += int(moved.sum())
+            self.proposed += len(moved)
+        self.last_points = population.copy()
+        if self.step <= self.burn:
+            return
+        if self.mean is None:
+            self.mean = numpy.zeros_like(population)
+            self.m2 = numpy.zeros_like(population)
+        self.count += 1
+        delta = population - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (population - self.mean)
+        if self.rhat_stop > 0 and self.count >= self.min_samples:
+            rhat = self.rhat()
+            self.converged = rhat is not None and bool(numpy.all(rhat < self.rhat_stop))
+
+    def rhat(self) -> Optional[numpy.ndarray]:
+        """
+        :return: (numpy array) Gelman-Rubin potential scale reduction per parameter, None before enough samples
+        """
+        n = self.count
+        if n < 2 or self.mean.shape[0] < 2:
+            return None
+        within = (self.m2 / (n - 1)).mean(axis=0)
+        between = n * self.mean.var(axis=0, ddof=1)
+        pooled = (n - 1) / n * within + between / n
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            return numpy.where(within > 0, numpy.sqrt(pooled / within), 1.0)
+
+    def posterior(self) -> Optional[Dict[str, Dict[str, float]]]:
+        """
+        :return: (dict) mean, standard deviation and R-hat per parameter of the samples after burn-in
+        """
+        if self.count < 2:
+            return None
+        chains = self.mean.shape[0]
+        mean = self.mean.mean(axis=0)
+        var = (self.m2.sum(axis=0) + self.count * ((self.mean - mean) ** 2).sum(axis=0)) / (self.count * chains - 1)
+        rhat = self.rhat()
+        return {label: {'mean': float(mean[i]), 'std': float(numpy.sqrt(var[i])),
+                        'rhat': float(rhat[i]) if rhat is not None else float('nan')}
+                for i, label in enumerate(self.labels)}
+
+    def report(self, final: bool = False) -> None:
+        rhat = self.rhat() if self.count else None
+        self.conn.send(('progress', {
+            'step': int(self.step),
+            'total_steps': self.burn + self.steps,
+            'burn': self.burn,
+            'phase': 'burn' if self.step <= self.burn else 'sampling',
+            'elapsed': time.time() - self.start,
+            'acceptance': self.accepted / self.proposed if self.proposed else None,
+            'best_chisq': 2 * float(self.best) / self.dof if numpy.isfinite(self.best) else None,
+            'best_point': (dict(zip(self.labels, self.best_point.tolist())) if self.best_point is not None
+                           else None),
+            'max_rhat': float(numpy.max(rhat)) if rhat is not None else None,
+            'samples': self.count,
+            'posterior': self.posterior(),
+            'converged': self.converged,
+            'stopped': self.stop_requested,
+            'final': final,
+        }))
+        self.last_report = time.time()
+
+
+def _start_mapper(problem, kind: str, workers: int):
+    """
+    Starts the evaluation mapper of a fit. The process mapper is bumps' multiprocessing pool. The thread mapper gives
+    every thread its own copy of the problem, since evaluating a problem sets its parameters; the compiled sasmodels
+    kernels release the GIL, so threads scale as well.
+
+    :return: mapper and the function that stops it
+    """
+    from bumps.mapper import MPMapper, SerialMapper
+
+    if kind != 'serial' and workers > 1:
+        try:
+            blob = pickle.dumps(problem)
+        except Exception as exc:
+            print('The model cannot be evaluated in parallel (' + str(exc) + '), running serially.', flush=True)
+        else:
+            if kind == 'process':
+                return MPMapper.start_mapper(problem, None, cpus=workers), MPMapper.stop_mapper
+            pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='sans_fit_eval')
+            local = threading.local()
+
+            def nllf(p):
+                if not hasattr(local, 'problem'):
+                    local.problem = pickle.loads(blob)
+                return local.problem.nllf(p)
+
+            def mapper(points):
+                return numpy.array(list(pool.map(nllf, points)))
+
+            return mapper, lambda m: pool.shutdown(wait=False)
+    return SerialMapper.start_mapper(problem, None), SerialMapper.stop_mapper
+
+
+def _fit(problems: OrderedDict, request: Dict[str, Any], conn) -> Any:
+    from bumps import fitters
+    from bumps.cli import save_best
+    from scattertools.support import molstat
+
+    fit_dir = Path(request['fit_dir'])
+    runfile = request['runfile']
+    # run scripts load their data files with relative paths
+    os.chdir(fit_dir)
+    problem = _load_problem(problems, fit_dir, runfile)
+
+    burn = request['burn']
+    seed = None
+    store_dir = request['warm_start_dir']
+    if store_dir is not None:
+        model_digest = caching.file_digest(fit_dir / (runfile + '.py'))
+        data_digest = caching.digest([(p.name, caching.file_digest(p)) for p in sorted(fit_dir.iterdir())
+                                      if p.is_file() and p.name != runfile + '.py'])
+        seed = warm_start.find(store_dir, model_digest, data_digest, problem.labels())
+        if seed is not None:
+            problem.setp(seed['best'])
+            burn = warm_start.warm_burn(burn, seed['match'])
+            print('Warm start from a previous fit (' + seed['match'] + ' match), burn-in of ' + str(burn) + ' steps.',
+                  flush=True)
+
+    (fit_dir / MCMC_DIR).mkdir(exist_ok=True)
+    problem.output_path = os.path.join(MCMC_DIR, runfile)
+    fitclass = getattr(fitters, FITTERS[request['fitter']])
+    if request['fitter'] == 'dream':
+        options = dict(burn=burn, steps=request['steps'])
+        if seed is not None:
+            # start the population in a small ball around the seed instead of sampling the full parameter ranges
+            options['init'] = 'eps'
+    else:
+        options = dict(steps=request['steps'])
+    monitor = _ProgressMonitor(conn, problem, burn, request['steps'], request['rhat_stop'])
+    mapper, stop_mapper = _start_mapper(problem, request['mapper'], request['workers'])
+    try:
+        driver = fitters.FitDriver(fitclass=fitclass, problem=problem, mapper=mapper, abort_test=monitor,
+                                   monitors=[fitters.ConsoleMonitor(problem), monitor], **options)
+        driver.clip()
+        x, fx = driver.fit()
+    finally:
+        stop_mapper(mapper)
+    if monitor.converged or monitor.stop_requested:
+        print('Fit stopped after ' + str(monitor.step) + ' steps' +
+              (', all parameters converged.' if monitor.converged else ' on request.'), flush=True)
+    monitor.report(final=True)
+    # writes the parameter file, the fit state and the plots the same way the bumps command line does
+    save_best(driver, problem, x)
+    if store_dir is not None:
+        warm_start.save(store_dir, model_digest, data_digest, problem.labels(), x)
+
+    if request['fitter'] != 'dream':
+        return {label: {'best': value, 'std': err}
+                for label, value, err in zip(problem.labels(), x, driver.stderr())}
+
+    print('Analyzing the fit ...', flush=True)
+    fitobj = molstat.CMolStat(
+        fitsource="SASView",
+        spath=str(fit_dir),
+        mcmcpath=MCMC_DIR,
+        runfile=runfile,
+        state=None,
+        problem=problem,
+    )
+    fitobj.fnRestoreFit()
+    return fitobj.fnAnalyzeStatFile(fConfidence=-1)
+
+
+def _serve(conn) -> None:
+    """
+    Main loop of a worker process. Requests are dictionaries, None ends the worker. While a fit runs, the worker sends
+    ('progress', report) messages and accepts 'stop'. Every request is answered with ('done', results) or
+    ('error', message).
+    """
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+    sys.stdout.reconfigure(line_buffering=True)
+    problems = OrderedDict()
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        if request == 'stop':
+            # arrived after the fit had finished
+            continue
+        with _redirect_output(request['log']):
+            try:
+                reply = ('done', _fit(problems, request, conn))
+            except Exception as exc:
+                traceback.print_exc()
+                reply = ('error', ''.join(traceback.format_exception_only(type(exc), exc)).strip())
+        conn.send(reply)
+
+
+# ------------ server side -------------
+
+class FitEngine:
+    """
+    Handle of a fit worker process. The worker imports bumps, sasmodels and scattertools once and keeps the fit
+    problems it loaded, including their compiled kernels, for the following requests. bumps uses multithreading, which
+    collides with Streamlit's requirement to register the thread context, hence the fits run outside of the server
+    process.
+    """
+
+    def __init__(self):
+        self._process = None
+        self._conn = None
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        # set by cancel() until the current or next fit has ended; _cancel_lock orders it against the start of a fit
+        self._cancelled = False
+        self._cancel_lock = threading.Lock()
+        _engines.add(self)
+
+    def _start(self) -> None:
+        # spawn instead of fork, since the Streamlit server process runs many threads
+        ctx = multiprocessing.get_context('spawn')
+        self._conn, child_conn = ctx.Pipe()
+        # not a daemon, so that the worker can run a process pool for the fit itself
+        self._process = ctx.Process(target=_serve, args=(child_conn,), name='sans_fit_engine')
+        self._process.start()
+        child_conn.close()
+
+    @property
+    def alive(self) -> bool:
+        return self._process is not None and self._process.is_alive()
+
+    @property
+    def pid(self) -> Optional[int]:
+        return self._process.pid if self._process is not None else None
+
+    def fit(self, fit_dir, runfile: str, log_path, burn: int = 1000, steps: int = 200, fitter: str = 'dream',
+            rhat_stop: float = 0.0, mapper: str = 'serial', workers: int = 1, warm_start_dir=None,
+            on_progress: Optional[Callable[[Dict[str, Any]], None]] = None) -> Any:
+        """
+        Fits the model script in fit_dir and blocks until the fit is finished. Fit results are written to
+        fit_dir/MCMC as by the bumps command line.
+
+        :param fit_dir: (str or Path-like) prepared fit directory with the model script and its data files
+        :param runfile: (str) model script name without the .py extension
+        :param log_path: (str or Path-like) file that receives the console output of the fit
+        :param burn: (int) MCMC burn-in steps
+        :param steps: (int) MCMC steps, or iterations of the LM fit
+        :param fitter: (str) 'dream' or 'lm'
+        :param rhat_stop: (float) stop the MCMC once the Gelman-Rubin statistic of all parameters is below this value,
+                          0 disables early stopping
+        :param mapper: (str) 'serial', 'thread' or 'process' evaluation of the DREAM population
+        :param workers: (int) number of threads or processes of a parallel mapper
+        :param warm_start_dir: (str or Path-like) result store to seed the fit from and to save its result to, see
+                               warm_start.find(), None for a cold start
+        :param on_progress: (callable) called in the calling thread with each progress report of the fit
+        :return: posterior statistics from CMolStat.fnAnalyzeStatFile for DREAM fits, best values and standard
+                 errors per parameter for LM fits
+        """
+        if fitter not in FITTERS:
+            raise ValueError('Unknown fitter ' + fitter + '.')
+        if mapper not in MAPPERS:
+            raise ValueError('Unknown mapper ' + mapper + '.')
+        request = dict(fit_dir=str(fit_dir), runfile=runfile, log=str(log_path), burn=int(burn), steps=int(steps),
+                       fitter=fitter, rhat_stop=float(rhat_stop), mapper=mapper, workers=max(1, int(workers)),
+                       warm_start_dir=str(warm_start_dir) if warm_start_dir is not None else None)
+        with self._lock:
+            try:
+                with self._cancel_lock:
+                    # a fit cancelled before its worker received the request never starts
+                    if self._cancelled:
+                        raise FitError('Fit cancelled before it started.')
+                    if not self.alive:
+                        self._start()
+                    with self._send_lock:
+                        self._conn.send(request)
+                status, payload = self._conn.recv()
+                while status == 'progress':
+                    if on_progress is not None:
+                        on_progress(payload)
+                    status, payload = self._conn.recv()
+            except (EOFError, OSError):
+                # the worker went away, e.g. through cancel()
+                self._process.join()
+                exitcode = self._process.exitcode
+                self._process = None
+                raise FitError('Fit worker exited with code ' + str(exitcode) + '.')
+            finally:
+                self._cancelled = False
+        if status == 'error':
+            raise FitError(payload)
+        return payload
+
+    def stop(self) -> None:
+        """
+        Ends the running fit after the current step. Unlike cancel(), the fit is analyzed and its results are kept.
+        """
+        if not self.alive:
+            return
+        with self._send_lock:
+            try:
+                self._conn.send('stop')
+            except OSError:
+                pass
+
+    def cancel(self) -> None:
+        """
+        Aborts the running fit by terminating the worker, or the fit about to start on this engine before it starts.
+        The next fit starts a fresh worker.
+        """
+        with self._cancel_lock:
+            self._cancelled = True
+            process = self._process
+            if process is not None and process.is_alive():
+                process.terminate()
+
+    def shutdown(self, timeout: float = 5.0) -> None:
+        if not self.alive:
+            return
+        try:
+            self._conn.send(None)
+        except OSError:
+            pass
+        self._process.join(timeout)
+        if self._process.is_alive():
+            self._process.terminate()
+
+
+# all workers of this server process and those that are idle, shared by all sessions
+_engines: weakref.WeakSet = weakref.WeakSet()
+_idle: List[FitEngine] = []
+_idle_lock = threading.Lock()
+
+
+def acquire() -> FitEngine:
+    """
+    :return: (FitEngine) an idle warm worker, or a new one that is started with its first fit
+    """
+    with _idle_lock:
+        while _idle:
+            engine = _idle.pop()
+            if engine.alive:
+                return engine
+    return FitEngine()
+
+
+def release(engine: FitEngine) -> None:
+    engine._cancelled = False
+    with _idle_lock:
+        if engine.alive:
+            _idle.append(engine)
+
+
+# registered after the exit handler of multiprocessing.util, which joins all workers and would otherwise wait for
+# running fits
+@atexit.register
+def shutdown() -> None:
+    with _idle_lock:
+        _idle.clear()
+    for engine in list(_engines):
+        engine.cancel()
+        engine.shutdown()
@@ -0,0 +1,335 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+from pathlib import Path
+import pickle
+import shutil
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional
+import uuid
+
+from sans_app.support import caching
+from sans_app.support import fit_engine
+
+# Fit jobs live in their own subfolders below the user fit directory. Every job folder contains the persisted job
+# state, the console log of the fit, and the actual fit directory.
+JOB_DIR_NAME = 'jobs'
+JOB_STATE_FILE = 'job.json'
+JOB_LOG_FILE = 'fit.log'
+JOB_RESULTS_FILE = 'results.pkl'
+JOB_PROGRESS_FILE = 'progress.json'
+# cache folder of the fit results that later fits start from
+WARM_START_CACHE = 'warm_start'
+JOB_FIT_DIR = 'fit'
+
+# upper limit of fits that run simultaneously on this machine, shared by all sessions of the app
+MAX_CONCURRENT_FITS = int(os.environ.get('SANS_APP_MAX_FITS', max(1, (os.cpu_count() or 2) // 2)))
+
+# cores available to the parallel likelihood evaluation of one fit when the number of workers is not configured
+DEFAULT_FIT_WORKERS = max(1, (os.cpu_count() or 1) // MAX_CONCURRENT_FITS)
+
+FINISHED_STATES = ('done', 'failed', 'cancelled', 'interrupted')
+# results of finished jobs kept in memory, older ones are read from their results file again
+RESULTS_CACHE_SIZE = 8
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+_state_lock = threading.Lock()
+# jobs known to this server process, job_id -> fit engine running the job (None while queued)
+_active: Dict[str, Optional[fit_engine.FitEngine]] = {}
+# results of the most recently finished or loaded jobs, least recently used first
+_results: OrderedDict[str, Any] = OrderedDict()
+_results_lock = threading.Lock()
+# latest progress report of the running jobs of this server process, finished jobs are read from their progress file
+_progress: Dict[str, Dict[str, Any]] = {}
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    """
+    Returns the process-wide executor. Each of its worker threads drives exactly one fit engine, which caps the
+    number of concurrently running fits at MAX_CONCURRENT_FITS.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_FITS, thread_name_prefix='sans_fit')
+    return _executor
+
+
+def job_root(fit_dir) -> Path:
+    return Path(fit_dir).expanduser().resolve() / JOB_DIR_NAME
+
+
+def job_dir(fit_dir, job_id: str) -> Path:
+    return job_root(fit_dir) / job_id
+
+
+def prepare_fit_directory(fit_dir, runfile, datafile_paths: Iterable = (), keep: Iterable[str] = ()) -> None:
+    """
+    Empties fit_dir except for the entries named in keep and copies the runfile and all existing data files into it.
+
+    :param fit_dir: (str or Path-like) The directory in which the fit problem will be initialized.
+    :param runfile: (str or Path-like) Full path of the model script.
+    :param datafile_paths: (list) Full paths of the data files. Files that do not exist are skipped.
+    :param keep: (list) Names of top-level entries in fit_dir that survive the cleanup.
+    :return: no return value
+    """
+    fit_dir = Path(fit_dir)
+    keep = set(keep)
+    fit_dir.mkdir(parents=True, exist_ok=True)
+    for entry in fit_dir.iterdir():
+        if entry.name in keep:
+            continue
+        if entry.is_dir() and not entry.is_symlink():
+            shutil.rmtree(entry)
+        else:
+            entry.unlink()
+    shutil.copyfile(runfile, fit_dir / Path(runfile).name)
+    for path in datafile_paths:
+        if Path(path).is_file():
+            shutil.copyfile(path, fit_dir / Path(path).name)
+
+
+def _write_state(jdir: Path, **updates) -> Dict[str, Any]:
+    """
+    Updates the persisted job state. The file is replaced atomically so that readers never see a partial write.
+    """
+    with _state_lock:
+        state = _read_state(jdir) or {}
+        state.update(updates)
+        state['updated'] = time.time()
+        tmp = jdir / (JOB_STATE_FILE + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp, jdir / JOB_STATE_FILE)
+    return state
+
+
+def _read_state(jdir: Path) -> Optional[Dict[str, Any]]:
+    try:
+        with open(jdir / JOB_STATE_FILE) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def _write_progress(jdir: Path, job_id: str, report: Dict[str, Any]) -> None:
+    _progress[job_id] = report
+    tmp = jdir / (JOB_PROGRESS_FILE + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(report, f)
+    os.replace(tmp, jdir / JOB_PROGRESS_FILE)
+
+
+def _remember_results(job_id: str, results: Any) -> None:
+    with _results_lock:
+        _results[job_id] = results
+        _results.move_to_end(job_id)
+        while len(_results) > RESULTS_CACHE_SIZE:
+            _results.popitem(last=False)
+
+
+def _run_job(fit_dir, job_id: str) -> None:
+    jdir = job_dir(fit_dir, job_id)
+    state = _read_state(jdir)
+    if state is None or state.get('status') == 'cancelled':
+        _active.pop(job_id, None)
+        return
+
+    fdir = jdir / JOB_FIT_DIR
+    engine = fit_engine.acquire()
+    try:
+        _write_state(jdir, status='running', started=time.time())
+        prepare_fit_directory(fdir, state['runfile_path'], state['datafile_paths'])
+        _active[job_id] = engine
+        if (_read_state(jdir) or {}).get('status') == 'cancelled':
+            return
+        results = engine.fit(fdir, os.path.splitext(state['runfile'])[0], jdir / JOB_LOG_FILE, burn=state['burn'],
+                             steps=state['steps'], fitter=state.get('fitter', 'dream'),
+                             rhat_stop=state.get('rhat_stop', 0.0), mapper=state.get('mapper', 'serial'),
+                             workers=state.get('workers', 1),
+                             warm_start_dir=caching.cache_dir(fit_dir, WARM_START_CACHE) if state.get('warm_start')
+                             else None,
+                             on_progress=lambda report: _write_progress(jdir, job_id, report))
+        with open(fdir / JOB_RESULTS_FILE, 'wb') as f:
+            pickle.dump(results, f)
+        _remember_results(job_id, results)
+        if (_read_state(jdir) or {}).get('status') != 'cancelled':
+            _write_state(jdir, status='done', finished=time.time())
+    except Exception as exc:
+        if (_read_state(jdir) or {}).get('status') != 'cancelled':
+            _write_state(jdir, status='failed', finished=time.time(), error=str(exc))
+    finally:
+        # unregistered before the engine goes back to the pool, so that a late cancel_job() cannot hit the next fit
+        _active.pop(job_id, None)
+        fit_engine.release(engine)
+        # the last report is on disk
+        _progress.pop(job_id, None)
+
+
+def submit_fit(fit_dir, runfile_path, datafile_paths: List[str], burn: int = 1000, steps: int = 200,
+               fitter: str = 'dream', rhat_stop: float = 0.0, mapper: str = 'serial', workers: int = 0,
+               warm_start: bool = False) -> str:
+    """
+    Queues an MCMC fit and returns immediately. The fit runs in an isolated directory below fit_dir/jobs.
+
+    :param fit_dir: (str or Path-like) The user fit directory.
+    :param runfile_path: (str or Path-like) Full path of the model script.
+    :param datafile_paths: (list) Full paths of the data files used by the model script.
+    :param burn: (int) MCMC burn-in steps.
+    :param steps: (int) MCMC steps, or iterations of an LM fit.
+    :param fitter: (str) 'dream' for an MCMC fit or 'lm' for a Levenberg-Marquardt fit.
+    :param rhat_stop: (float) Gelman-Rubin threshold below which the MCMC stops early, 0 runs all steps.
+    :param mapper: (str) 'serial', 'thread' or 'process' evaluation of the DREAM population.
+    :param workers: (int) threads or processes of a parallel mapper, 0 shares the cores evenly between the fit slots.
+    :param warm_start: (bool) Start from the closest earlier result of this model with a shorter burn-in, and store
+                       the result for later fits.
+    :return: (str) the job ID
+    """
+    job_id = time.strftime('%Y%m%d-%H%M%S') + '-' + uuid.uuid4().hex[:6]
+    jdir = job_dir(fit_dir, job_id)
+    jdir.mkdir(parents=True)
+    # registered before its state file exists, so that get_job() never reports the new job as interrupted
+    _active[job_id] = None
+    _write_state(
+        jdir,
+        job_id=job_id,
+        status='queued',
+        submitted=time.time(),
+        runfile=Path(runfile_path).name,
+        runfile_path=str(runfile_path),
+        datafile_paths=[str(p) for p in datafile_paths],
+        burn=int(burn),
+        steps=int(steps),
+        fitter=fitter,
+        rhat_stop=float(rhat_stop),
+        mapper=mapper,
+        workers=int(workers) or DEFAULT_FIT_WORKERS,
+        warm_start=bool(warm_start),
+    )
+    _get_executor().submit(_run_job, fit_dir, job_id)
+    return job_id
+
+
+def cancel_job(fit_dir, job_id: str) -> None:
+    jdir = job_dir(fit_dir, job_id)
+    state = _read_state(jdir)
+    if state is None or state.get('status') in FINISHED_STATES:
+        return
+    _write_state(jdir, status='cancelled', finished=time.time())
+    engine = _active.get(job_id)
+    if engine is not None:
+        engine.cancel()
+
+
+def stop_job(fit_dir, job_id: str) -> None:
+    """
+    Ends a running fit early. In contrast to cancel_job, the samples drawn so far are analyzed and kept.
+    """
+    jdir = job_dir(fit_dir, job_id)
+    state = _read_state(jdir)
+    engine = _active.get(job_id)
+    if state is None or state.get('status') != 'running' or engine is None:
+        return
+    _write_state(jdir, stop_requested=True)
+    engine.stop()
+
+
+def get_job(fit_dir, job_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Returns the persisted state of a job. Jobs that were queued or running when their server process went away are
+    reported as interrupted.
+    """
+    jdir = job_dir(fit_dir, job_id)
+    state = _read_state(jdir)
+    if state is None:
+        return None
+    if state.get('status') not in FINISHED_STATES and job_id not in _active:
+        state = _write_state(jdir, status='interrupted')
+    return state
+
+
+def list_jobs(fit_dir) -> List[Dict[str, Any]]:
+    """
+    :return: (list) states of all jobs found in fit_dir, newest first
+    """
+    root = job_root(fit_dir)
+    if not root.is_dir():
+        return []
+    jobs = [get_job(fit_dir, p.name) for p in root.iterdir() if (p / JOB_STATE_FILE).is_file()]
+    return sorted((j for j in jobs if j is not None), key=lambda j: j.get('submitted', 0), reverse=True)
+
+
+def running_jobs() -> int:
+    return sum(1 for p in _active.values() if p is not None)
+
+
+def queued_jobs() -> int:
+    return sum(1 for p in _active.values() if p is None)
+
+
+def read_log(fit_dir, job_id: str, lines: int = 20) -> str:
+    """
+    :return: (str) the last lines of the fit console output
+    """
+    path = job_dir(fit_dir, job_id) / JOB_LOG_FILE
+    if not path.is_file():
+        return ''
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - 200 * lines))
+        tail = f.read().decode(errors='replace')
+    # bumps rewrites its progress line with carriage returns
+    tail = tail.replace('\r', '\n')
+    return '\n'.join(tail.splitlines()[-lines:])
+
+
+def get_progress(fit_dir, job_id: str) -> Optional[Dict[str, Any]]:
+    """
+    :return: (dict) the latest progress report of a fit, see fit_engine._ProgressMonitor.report(), None before the
+             first report
+    """
+    if job_id in _progress:
+        return _progress[job_id]
+    try:
+        with open(job_dir(fit_dir, job_id) / JOB_PROGRESS_FILE) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def fit_summary(fit_dir, job_id: str) -> Optional[Dict[str, Dict[str, float]]]:
+    """
+    Best value and uncertainty per parameter of a finished fit, in the same form for DREAM and LM fits. For DREAM
+    fits, the best point is the best population member and the uncertainty the posterior standard deviation.
+
+    :return: (dict) parameter -> {'best': value, 'std': uncertainty}, None if the fit did not finish
+    """
+    state = get_job(fit_dir, job_id)
+    if state is None or state['status'] != 'done':
+        return None
+    if state.get('fitter', 'dream') != 'dream':
+        return load_results(fit_dir, job_id)
+    progress = get_progress(fit_dir, job_id) or {}
+    best = progress.get('best_point') or {}
+    posterior = progress.get('posterior') or {}
+    return {label: {'best': value, 'std': posterior.get(label, {}).get('std', float('nan'))}
+            for label, value in best.items()}
+
+
+def load_results(fit_dir, job_id: str) -> Optional[Any]:
+    with _results_lock:
+        if job_id in _results:
+            _results.move_to_end(job_id)
+            return _results[job_id]
+    path = job_dir(fit_dir, job_id) / JOB_FIT_DIR / JOB_RESULTS_FILE
+    if not path.is_file():
+        return None
+    with open(path, 'rb') as f:
+        results = pickle.load(f)
+    _remember_results(job_id, results)
+    return results
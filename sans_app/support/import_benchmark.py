@@ -0,0 +1,100 @@
+"""
+Reports the import cost of each Streamlit page of the app.
+
+Every page is analyzed for its module-level imports, which are then timed in a fresh interpreter in the order they
+appear in the page. Modules bound through lazy.lazy_import() are timed as well, but reported as deferred, since a page
+only pays for them on the code paths that use them.
+
+Usage: python -m sans_app.support.import_benchmark [--repeat N]
+"""
+from __future__ import annotations
+
+import argparse
+import ast
+import json
+from pathlib import Path
+import subprocess
+import sys
+from typing import List, Tuple
+
+APP_DIR = Path(__file__).parent.parent
+
+_TIMER = '''
+import json, sys, time
+result = []
+for name in sys.argv[1:]:
+    start = time.perf_counter()
+    try:
+        module, _, attr = name.partition(':')
+        # 'module:name' stands for 'from module import name', which also imports submodules
+        __import__(module, fromlist=[attr] if attr else [])
+        error = ''
+    except Exception as exc:
+        error = type(exc).__name__
+    result.append([name, time.perf_counter() - start, error])
+print(json.dumps(result))
+'''
+
+
+def page_imports(path: Path) -> List[Tuple[str, str]]:
+    """
+    :return: (list) (module name or 'module:name' for from-imports, 'eager' or 'lazy') of the module-level imports
+             of a page script
+    """
+    tree = ast.parse(path.read_text())
+    imports = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            imports += [(alias.name, 'eager') for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module and node.level == 0:
+            imports += [(node.module + ':' + alias.name, 'eager') for alias in node.names]
+        elif isinstance(node, ast.Assign) and isinstance(node.value, ast.Call):
+            func = node.value.func
+            name = func.attr if isinstance(func, ast.Attribute) else getattr(func, 'id', '')
+            if name == 'lazy_import' and node.value.args and isinstance(node.value.args[0], ast.Constant):
+                imports.append((node.value.args[0].value, 'lazy'))
+    return imports
+
+
+def time_imports(modules: List[str]) -> List[Tuple[str, float, str]]:
+    output = subprocess.run([sys.executable, '-c', _TIMER] + modules, capture_output=True, text=True,
+                            cwd=APP_DIR.parent)
+    return [tuple(entry) for entry in json.loads(output.stdout)]
+
+
+def benchmark(repeat: int = 1):
+    """
+    :return: (list) per page (page name, eager seconds, deferred seconds, list of (module, kind, seconds, error))
+    """
+    pages = [APP_DIR / 'main.py'] + sorted((APP_DIR / 'pages').glob('*.py'))
+    report = []
+    for page in pages:
+        imports = page_imports(page)
+        # eager imports first, as on page load, then what the lazy bindings would cost on top of them
+        order = [m for m, kind in imports if kind == 'eager'] + [m for m, kind in imports if kind == 'lazy']
+        kinds = dict((m, kind) for m, kind in imports)
+        best = {}
+        for _ in range(repeat):
+            for name, seconds, error in time_imports(order):
+                if name not in best or seconds < best[name][0]:
+                    best[name] = (seconds, error)
+        rows = [(name, kinds[name], best[name][0], best[name][1]) for name in order]
+        eager = sum(r[2] for r in rows if r[1] == 'eager')
+        deferred = sum(r[2] for r in rows if r[1] == 'lazy')
+        report.append((page.name, eager, deferred, rows))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=1, help='runs per page, the fastest is reported')
+    args = parser.parse_args()
+
+    for page, eager, deferred, rows in benchmark(args.repeat):
+        print(page + f'  page load {eager:.3f} s, deferred {deferred:.3f} s')
+        for name, kind, seconds, error in rows:
+            print(f'    {kind:6s} {seconds:8.3f} s  {name}' + ('  (' + error + ')' if error else ''))
+
+
+if __name__ == '__main__':
+    main()
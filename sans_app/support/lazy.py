@@ -0,0 +1,54 @@
+from __future__ import annotations
+
+import importlib
+import sys
+import time
+import types
+from typing import Dict
+
+# seconds spent importing each lazily bound module, recorded on first use
+import_times: Dict[str, float] = {}
+
+
+class LazyModule(types.ModuleType):
+    """
+    Placeholder for a module that is imported on first attribute access. Unlike importlib.util.LazyLoader, creating
+    the placeholder does not import any parent package.
+    """
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.__dict__['_lazy_module'] = None
+
+    def _load(self) -> types.ModuleType:
+        module = self.__dict__['_lazy_module']
+        if module is None:
+            start = time.perf_counter()
+            module = importlib.import_module(self.__name__)
+            import_times.setdefault(self.__name__, time.perf_counter() - start)
+            self.__dict__['_lazy_module'] = module
+        return module
+
+    def __getattr__(self, item):
+        return getattr(self._load(), item)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = 'loaded' if self.__dict__['_lazy_module'] is not None else 'not loaded'
+        return '<lazy module ' + repr(self.__name__) + ' (' + state + ')>'
+
+
+def lazy_import(name: str) -> types.ModuleType:
+    """
+    Binds a module without importing it. Heavy dependencies of the pages (scattertools, sasmodels, bumps, plotly,
+    tensorflow) are only imported when a code path actually uses them.
+
+    :param name: (str) full module name, e.g. 'scattertools.support.molstat'
+    :return: the module if it is already imported, otherwise a LazyModule placeholder
+    """
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    return LazyModule(name)
@@ -0,0 +1,342 @@
+from __future__ import annotations
+
+from concurrent.futures import Future, ThreadPoolExecutor
+import os
+from pathlib import Path
+import pickle
+import queue
+import threading
+from typing import List, Optional, Sequence, Tuple
+
+import numpy
+import pandas
+import streamlit as st
+
+from sans_app.support import datafiles
+from sans_app.support.lazy import lazy_import
+
+tf = lazy_import('tensorflow')
+
+# q-grid the ML models were trained on
+ML_QMIN = 0.01
+ML_QMAX = 0.8
+ML_NUMPOINTS = 105
+
+
+def model_qgrid() -> numpy.ndarray:
+    numpoints = int((numpy.log10(ML_QMAX) - numpy.log10(ML_QMIN)) * 60)
+    qvec = numpy.logspace(numpy.log10(ML_QMIN), numpy.log10(ML_QMAX), num=numpoints, endpoint=True)
+    return qvec[:ML_NUMPOINTS]
+
+
+def prepare_input(Q, Iq, background, qmin, qmax) -> numpy.ndarray:
+    """
+    Clamps a SANS curve to the selected Q-range, subtracts the background, and interpolates the logarithm of the
+    intensity onto the model q-grid.
+
+    :return: (numpy array) model input of length ML_NUMPOINTS
+    """
+    Iq_pred = numpy.where(Q <= qmin, Iq[Q <= qmin][-1], Iq)
+    Iq_pred = numpy.where(Q >= qmax, Iq[Q >= qmax][0], Iq_pred)
+    Iq_pred = Iq_pred - background
+    Iq_pred = numpy.log10(numpy.abs(Iq_pred))
+    return numpy.interp(model_qgrid(), Q, Iq_pred)
+
+
+def _clamp(Q, Iq, qmin, qmax):
+    """
+    Replaces intensities below qmin and above qmax by the values at the respective limits, row by row.
+    """
+    n = Q.shape[-1]
+    rows = numpy.arange(len(Q))
+    if qmin is not None:
+        qmin = numpy.broadcast_to(numpy.asarray(qmin, dtype=float), (len(Q),))[:, numpy.newaxis]
+        below = Q <= qmin
+        lower = numpy.clip(below.sum(axis=1) - 1, 0, n - 1)
+        Iq = numpy.where(below, Iq[rows, lower][:, numpy.newaxis], Iq)
+    if qmax is not None:
+        qmax = numpy.broadcast_to(numpy.asarray(qmax, dtype=float), (len(Q),))[:, numpy.newaxis]
+        above = Q >= qmax
+        upper = numpy.clip((~above).sum(axis=1), 0, n - 1)
+        Iq = numpy.where(above, Iq[rows, upper][:, numpy.newaxis], Iq)
+    return Iq
+
+
+def auto_background(Q, Iq, dI, qmin=None, qmax=None, min_tail=5, max_tail=30, sigma=2.0):
+    """
+    Estimates the incoherent background from the high-Q end of SANS curves. Starting with the last min_tail points,
+    the averaged tail grows towards lower Q as long as the next point lies within sigma error bars of the current
+    average, up to max_tail - 1 points. All tail averages come from one reverse cumulative sum.
+
+    Q, Iq and dI are either 1-D for a single curve, or 2-D (curves x points) for many curves of a common length.
+    Leading NaN entries pad shorter curves and end the tail.
+
+    :param qmin: (float, array or None) intensities below qmin are replaced by the value at qmin
+    :param qmax: (float, array or None) intensities above qmax are replaced by the value at qmax
+    :param min_tail: (int) number of points of the smallest tail
+    :param max_tail: (int) upper limit (exclusive) of the number of points of the tail
+    :param sigma: (float) acceptance threshold in units of the error bar of the next point
+    :return: (float or None) for a single curve, (numpy array) with NaN where undetermined for many curves
+    """
+    Iq = numpy.asarray(Iq, dtype=float)
+    single = Iq.ndim == 1
+    Q = numpy.atleast_2d(numpy.asarray(Q, dtype=float))
+    Iq = numpy.atleast_2d(Iq)
+    dI = numpy.atleast_2d(numpy.asarray(dI, dtype=float))
+    if qmin is not None or qmax is not None:
+        Iq = _clamp(Q, Iq, qmin, qmax)
+
+    max_tail = min(max_tail, Iq.shape[1])
+    background = numpy.full(len(Iq), numpy.nan)
+    if max_tail > min_tail:
+        rev_I = Iq[:, ::-1]
+        rev_dI = dI[:, ::-1]
+        # means[:, k - 1] is the average of the last k points
+        means = numpy.cumsum(rev_I[:, :max_tail], axis=1) / numpy.arange(1, max_tail + 1)
+        tails = numpy.arange(min_tail, max_tail)
+        candidates = means[:, tails - 1]
+        with numpy.errstate(invalid='ignore'):
+            reject = numpy.abs(rev_I[:, tails] - candidates) > sigma * rev_dI[:, tails]
+        reject |= numpy.isnan(rev_I[:, tails])
+        accepted = numpy.where(reject.any(axis=1), reject.argmax(axis=1), len(tails))
+        rows = numpy.arange(len(Iq))
+        background = numpy.where(accepted > 0, candidates[rows, numpy.maximum(accepted - 1, 0)], numpy.nan)
+
+    if single:
+        return None if numpy.isnan(background[0]) else float(background[0])
+    return background
+
+
+def tail_stack(curves: Sequence[tuple], length: int = 30) -> Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+    """
+    Stacks the high-Q tails of curves of different lengths into NaN-padded arrays for auto_background().
+
+    :param curves: (list) of (Q, Iq, dI)
+    :return: Q, Iq, dI arrays of shape curves x length
+    """
+    stacked = numpy.full((3, len(curves), length), numpy.nan)
+    for i, curve in enumerate(curves):
+        for j in range(3):
+            tail = numpy.asarray(curve[j], dtype=float)[-length:]
+            stacked[j, i, length - len(tail):] = tail
+    return stacked[0], stacked[1], stacked[2]
+
+
+def _load_object(file_name):
+    with open(file_name, 'rb') as file:
+        return pickle.load(file)
+
+
+class BatchPredictor:
+    """
+    Serves one Keras model. Requests from concurrent sessions are collected for up to max_delay seconds, or until
+    max_batch curves are queued, and evaluated in a single forward pass on a dedicated thread.
+    """
+
+    def __init__(self, ml_model, max_batch: int = 256, max_delay: float = 0.01):
+        self.ml_model = ml_model
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue: queue.Queue = queue.Queue()
+        self._thread = threading.Thread(target=self._serve, name='ml_predictor', daemon=True)
+        self._thread.start()
+
+    def predict(self, intensities: numpy.ndarray, sup: numpy.ndarray) -> List[numpy.ndarray]:
+        """
+        Evaluates the model directly for a batch of curves.
+
+        :param intensities: (numpy array) N x ML_NUMPOINTS model inputs, see prepare_input()
+        :param sup: (numpy array) N x 2 supplementary inputs (background, solvent SLD)
+        :return: (list) model outputs, each with N rows; the regression outputs per SANS model first, the
+                 classification last
+        """
+        future = self.submit(intensities, sup)
+        return future.result()
+
+    def submit(self, intensities: numpy.ndarray, sup: numpy.ndarray) -> Future:
+        future = Future()
+        intensities = numpy.atleast_2d(numpy.asarray(intensities, dtype='float32'))
+        sup = numpy.atleast_2d(numpy.asarray(sup, dtype='float32'))
+        self._queue.put((intensities, sup, future))
+        return future
+
+    def _serve(self):
+        while True:
+            requests = [self._queue.get()]
+            size = len(requests[0][0])
+            while size < self.max_batch:
+                try:
+                    request = self._queue.get(timeout=self.max_delay)
+                except queue.Empty:
+                    break
+                requests.append(request)
+                size += len(request[0])
+
+            intensities = numpy.concatenate([r[0] for r in requests])
+            sup = numpy.concatenate([r[1] for r in requests])
+            try:
+                y_pred = self.ml_model.predict([intensities, sup], batch_size=max(len(intensities), 1), verbose=0)
+                if not isinstance(y_pred, (list, tuple)):
+                    y_pred = [y_pred]
+                start = 0
+                for r_intensities, _, future in requests:
+                    stop = start + len(r_intensities)
+                    future.set_result([numpy.asarray(y[start:stop]) for y in y_pred])
+                    start = stop
+            except Exception as exc:
+                for _, _, future in requests:
+                    future.set_exception(exc)
+
+
+@st.cache_resource(show_spinner=False)
+def load_ml_model(path, model) -> Tuple[Optional[list], Optional[list], Optional[BatchPredictor], str]:
+    """
+    Loads an ML model (Keras SavedModel plus pickled model and parameter names) once per server process.
+
+    :return: (list) SANS model names, (list) parameter names per SANS model, (BatchPredictor) the served model,
+             (str) error message or ''
+    """
+    dirname = os.path.join(path, model)
+    tb_output = ''
+    try:
+        sans_models = _load_object(os.path.join(dirname, 'sans_models.dat'))
+        par_names = _load_object(os.path.join(dirname, 'par_names.dat'))
+        # Load model for prediction. Compile = False avoids supplying the custom loss function.
+        predictor = BatchPredictor(tf.keras.models.load_model(dirname, compile=False))
+    except (IOError, ValueError) as e:
+        tb_output = 'Could not load ML model. ' + str(e)
+        predictor = None
+        sans_models = None
+        par_names = None
+    return sans_models, par_names, predictor, tb_output
+
+
+def predict_curves(predictor: BatchPredictor, curves: Sequence[tuple], solvent_sld) -> List[numpy.ndarray]:
+    """
+    Classifies many SANS curves with one forward pass.
+
+    :param predictor: (BatchPredictor) the served model
+    :param curves: (list) of (Q, Iq, background, qmin, qmax)
+    :param solvent_sld: (float or list) solvent SLD for all or per curve
+    :return: (list) model outputs with one row per curve
+    """
+    intensities = numpy.array([prepare_input(*curve) for curve in curves])
+    sld = numpy.broadcast_to(numpy.asarray(solvent_sld, dtype=float), (len(curves),))
+    sup = numpy.column_stack([[curve[2] for curve in curves], sld])
+    return predictor.predict(intensities, sup)
+
+
+def format_prediction(y_pred, n, sans_models, par_names) -> List[str]:
+    """
+    :return: (list) text lines with the classification and regression results of curve n
+    """
+    tb_output = ["---Classification---"]
+    for i, model in enumerate(sans_models):
+        pstr = f'{y_pred[-1][n][i]:.2f}' + ' ' + model
+        tb_output.append(pstr)
+    tb_output.append("")
+
+    tb_output.append("---Regression---")
+    for i in range(len(y_pred) - 1):
+        pstr = 'Model: ' + sans_models[i]
+        tb_output.append(pstr)
+        for j in range(len(par_names[i])):
+            parname = par_names[i][j]
+            if 'sld' in parname:
+                correction = 0.1
+            else:
+                correction = 1
+            pstr = parname + ' ' + f'{y_pred[i][n][j] * correction:.4f}'
+            tb_output.append(pstr)
+        tb_output.append("")
+    return tb_output
+
+
+def read_curve(path):
+    """
+    :return: (tuple) Q, I, dI arrays of a SANS data file
+    """
+    data = datafiles.read_columns(path)
+    return data[0], data[1], data[2]
+
+
+def classify_files(predictor: BatchPredictor, paths: Sequence, sans_models, par_names, solvent_sld,
+                   qmin: Optional[float] = None, qmax: Optional[float] = None,
+                   max_workers: Optional[int] = None) -> pandas.DataFrame:
+    """
+    Classifies many SANS data files. Files are loaded on a thread pool, the backgrounds of all files are estimated in
+    one vectorized call, and all curves are evaluated in one forward pass. As for a single file, intensities outside
+    the Q-range are replaced by the values at its limits, for the background estimate and for the prediction.
+
+    :param predictor: (BatchPredictor) the served model
+    :param paths: (list) paths of the SANS data files
+    :param sans_models: (list) SANS model names of the ML model
+    :param par_names: (list) parameter names per SANS model
+    :param solvent_sld: (float) solvent SLD used for all files
+    :param qmin: (float or None) lower limit of the Q-range of all files, None for the first Q of each file
+    :param qmax: (float or None) upper limit of the Q-range of all files, None for the last Q of each file
+    :param max_workers: (int or None) number of loader threads
+    :return: (Pandas dataframe) one row per file with background, per-model probabilities, regressed parameters and
+             a possible loading error
+    """
+    raw = []
+    rows = []
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ml_loader') as executor:
+        futures = [executor.submit(read_curve, path) for path in paths]
+        for path, future in zip(paths, futures):
+            row = {'file': Path(path).name, 'background': numpy.nan, 'error': ''}
+            try:
+                raw.append(future.result())
+                loaded = True
+            except Exception as exc:
+                row['error'] = type(exc).__name__ + ': ' + str(exc)
+                loaded = False
+            rows.append((row, loaded))
+
+    # the Q-range of each file, limited to its data, and the intensities clamped to it; after clamping only the tails
+    # matter for the background of all files at once
+    limits = [(float(Q[0]) if qmin is None else max(qmin, float(Q[0])),
+               float(Q[-1]) if qmax is None else min(qmax, float(Q[-1]))) for Q, _, _ in raw]
+    clamped = [(Q, _clamp(Q[numpy.newaxis], Iq[numpy.newaxis], lo, hi)[0], dI)
+               for (Q, Iq, dI), (lo, hi) in zip(raw, limits)]
+    backgrounds = auto_background(*tail_stack(clamped)) if raw else numpy.empty(0)
+    backgrounds = numpy.nan_to_num(backgrounds, nan=0.0)
+    curves = [(Q, Iq, float(b), lo, hi) for (Q, Iq, _), b, (lo, hi) in zip(raw, backgrounds, limits)]
+    n = 0
+    for row, loaded in rows:
+        if loaded:
+            row['background'] = curves[n][2]
+            n += 1
+
+    y_pred = predict_curves(predictor, curves, solvent_sld) if curves else []
+    table = []
+    n = 0
+    for row, loaded in rows:
+        if loaded:
+            for i, model in enumerate(sans_models):
+                row['p_' + model] = float(y_pred[-1][n][i])
+            for i in range(len(y_pred) - 1):
+                for j, parname in enumerate(par_names[i]):
+                    correction = 0.1 if 'sld' in parname else 1
+                    row[sans_models[i] + ':' + parname] = float(y_pred[i][n][j] * correction)
+            n += 1
+        table.append(row)
+    return pandas.DataFrame(table)
+
+
+def write_results(df: pandas.DataFrame, basename) -> List[Path]:
+    """
+    Writes a results table as CSV and, if a Parquet engine is installed, as Parquet.
+
+    :param basename: (str or Path-like) output path without extension
+    :return: (list) paths of the written files
+    """
+    basename = Path(basename)
+    written = [basename.with_suffix('.csv')]
+    df.to_csv(written[0], index=False)
+    try:
+        df.to_parquet(basename.with_suffix('.parquet'), index=False)
+        written.append(basename.with_suffix('.parquet'))
+    except ImportError:
+        pass
+    return written
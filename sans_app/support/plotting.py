@@ -0,0 +1,134 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+import threading
+from typing import Any, Dict, List, Sequence, Tuple
+
+import numpy
+import pandas
+
+from sans_app.support import caching
+from sans_app.support.lazy import lazy_import
+
+go = lazy_import('plotly.graph_objects')
+
+# Figures of SANS curves on log-log axes. Traces are WebGL (Scattergl) and decimated to at most MAX_POINTS points
+# equidistant in log(Q), which is below the resolution of the plot. Trace payloads are cached by the content of their
+# dataset, and figures by the traces they consist of, so reruns that do not change any dataset reuse the same figure
+# object instead of recomputing quotients and rebuilding the plotly JSON.
+MAX_POINTS = 500
+TRACE_CACHE_SIZE = 256
+FIGURE_CACHE_SIZE = 16
+
+# the quantities shown by comparison_figures(), with their y-axis titles
+QUANTITIES = (('I', 'Intensity (1/cm)'), ('dI/I', 'dI / I'), ('dQ/Q', 'dQ / Q'))
+
+_trace_cache: OrderedDict[str, Dict[str, dict]] = OrderedDict()
+_figure_cache: OrderedDict[str, Any] = OrderedDict()
+_lock = threading.Lock()
+
+
+def _remember(cache: OrderedDict, key: str, value, size: int):
+    with _lock:
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > size:
+            cache.popitem(last=False)
+    return value
+
+
+def _recall(cache: OrderedDict, key: str):
+    with _lock:
+        value = cache.get(key)
+        if value is not None:
+            cache.move_to_end(key)
+        return value
+
+
+def decimate(Q: numpy.ndarray, max_points: int = MAX_POINTS) -> numpy.ndarray:
+    """
+    Selects at most max_points points, one per bin of a grid equidistant in log(Q). Points with Q <= 0 cannot be shown
+    on a log axis and are dropped.
+
+    :param Q: (numpy array) momentum transfer values in any order
+    :param max_points: (int) upper limit of the number of points
+    :return: (numpy array) indices of the selected points, sorted by Q
+    """
+    Q = numpy.asarray(Q, dtype=float)
+    order = numpy.argsort(Q, kind='stable')
+    order = order[Q[order] > 0]
+    if len(order) <= max_points:
+        return order
+    logq = numpy.log(Q[order])
+    edges = numpy.linspace(logq[0], logq[-1], max_points + 1)
+    # first point of every occupied bin
+    bins = numpy.clip(numpy.searchsorted(edges, logq, side='right') - 1, 0, max_points - 1)
+    first = numpy.flatnonzero(numpy.diff(bins, prepend=-1))
+    return order[first]
+
+
+def _quotient(a: numpy.ndarray, b: numpy.ndarray) -> numpy.ndarray:
+    return numpy.divide(a, b, out=numpy.zeros_like(a), where=b != 0)
+
+
+def dataset_traces(df: pandas.DataFrame, name: str, max_points: int = MAX_POINTS) -> Dict[str, dict]:
+    """
+    Scattergl trace payloads of one dataset for every quantity in QUANTITIES, cached by the content of the dataset.
+
+    :param df: (Pandas dataframe) dataset with columns Q, I, dI, dQ
+    :param name: (str) legend entry
+    :return: (dict) quantity -> trace dictionary
+    """
+    arrays = {column: df[column].to_numpy(dtype=float) for column in ('Q', 'I', 'dI', 'dQ')}
+    key = caching.digest('traces', arrays, name, int(max_points))
+    traces = _recall(_trace_cache, key)
+    if traces is not None:
+        return traces
+    keep = decimate(arrays['Q'], max_points)
+    Q, I, dI, dQ = (arrays[column][keep] for column in ('Q', 'I', 'dI', 'dQ'))
+    common = {'type': 'scattergl', 'mode': 'markers', 'name': name, 'x': Q}
+    traces = {
+        'I': dict(common, y=I, error_y={'type': 'data', 'array': dI, 'visible': True}),
+        'dI/I': dict(common, y=_quotient(dI, I)),
+        'dQ/Q': dict(common, y=_quotient(dQ, Q)),
+    }
+    traces['key'] = key
+    return _remember(_trace_cache, key, traces, TRACE_CACHE_SIZE)
+
+
+def sans_figure(traces: Sequence[dict], y_title: str, trace_keys: Sequence[str] = ()):
+    """
+    :param traces: (list) trace dictionaries, see dataset_traces()
+    :param y_title: (str) title of the y-axis
+    :param trace_keys: (list) cache keys of the datasets of the traces; the figure is cached if given
+    :return: (plotly Figure) with log-log axes
+    """
+    key = caching.digest('figure', list(trace_keys), y_title) if trace_keys else None
+    fig = _recall(_figure_cache, key) if key is not None else None
+    if fig is not None:
+        return fig
+    fig = go.Figure(data=[go.Scattergl(**{k: v for k, v in trace.items() if k != 'type'}) for trace in traces])
+    fig.update_xaxes(type="log", ticks='inside', showgrid=True, showline=True, linewidth=2, mirror=True,
+                     title_text='Momentum transfer (1/Å)')
+    fig.update_yaxes(type="log", ticks='inside', showgrid=True, showline=True, linewidth=2, mirror=True,
+                     title_text=y_title)
+    if traces:
+        fig['data'][0]['showlegend'] = True
+    if key is not None:
+        _remember(_figure_cache, key, fig, FIGURE_CACHE_SIZE)
+    return fig
+
+
+def comparison_figures(graphs: Sequence[Tuple[pandas.DataFrame, str]],
+                       max_points: int = MAX_POINTS) -> List[Any]:
+    """
+    Builds the intensity, dI/I and dQ/Q figures of a list of datasets.
+
+    :param graphs: (list) (dataset, legend entry) pairs
+    :param max_points: (int) points per trace, see decimate()
+    :return: (list) one plotly Figure per entry of QUANTITIES
+    """
+    per_dataset = [dataset_traces(df, name, max_points) for df, name in graphs]
+    keys = [traces['key'] for traces in per_dataset]
+    return [sans_figure([traces[quantity] for traces in per_dataset], y_title, keys)
+            for quantity, y_title in QUANTITIES]
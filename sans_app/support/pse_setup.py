@@ -0,0 +1,226 @@
+from __future__ import annotations
+
+import hashlib
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy
+import pandas
+
+from sans_app.support import caching
+
+# Columns of the shorthand summary of the optimization setup, which is passed to the PSE as exp_par.
+SUMMARY_COLUMNS = ['type', 'dataset', 'config.', 'parameter', 'value', 'l_fit', 'u_fit', 'l_opt', 'u_opt',
+                   'step_opt']
+OPT_COLUMNS = ['lower_opt', 'upper_opt', 'step_opt']
+
+
+def table_digest(*parts: Any) -> str:
+    """
+    Fast content digest of Pandas objects, with anything else hashed by caching.digest(). Dataframes are hashed
+    column-wise by Pandas, which avoids the JSON serialization of caching.digest() on every rerun.
+
+    :return: (str) hex digest
+    """
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, (pandas.DataFrame, pandas.Series)):
+            labels = part.columns.tolist() if isinstance(part, pandas.DataFrame) else part.name
+            h.update(repr((part.index.tolist(), labels)).encode())
+            try:
+                h.update(pandas.util.hash_pandas_object(part, index=False).to_numpy().tobytes())
+            except TypeError:
+                # unhashable cells, e.g. lists
+                h.update(caching.digest(part).encode())
+        else:
+            h.update(caching.digest(part).encode())
+        h.update(b'\x00')
+    return h.hexdigest()
+
+
+class SetupTracker:
+    """
+    Dirty tracking for the tables of the optimization setup. Values derived from tables, such as summary rows or the
+    JSON records stored in the app configuration, are kept together with the digest of their inputs and only rebuilt
+    once the inputs change.
+    """
+
+    def __init__(self):
+        self._entries: Dict[Any, Tuple[str, Any]] = {}
+
+    def derive(self, key, build: Callable[[], Any], *inputs: Any) -> Tuple[Any, bool]:
+        """
+        :param key: (hashable) name of the derived value
+        :param build: (callable) computes the value from the inputs
+        :param inputs: the inputs of build, see table_digest()
+        :return: (tuple) the value and whether it was rebuilt
+        """
+        token = table_digest(*inputs)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == token:
+            return entry[1], False
+        value = build()
+        self._entries[key] = (token, value)
+        return value, True
+
+    def digest(self, key) -> Optional[str]:
+        """
+        :return: (str) the input digest of a derived value, None if it was never derived
+        """
+        entry = self._entries.get(key)
+        return None if entry is None else entry[0]
+
+
+def to_records(df: pandas.DataFrame) -> List[Dict[str, Any]]:
+    """
+    :return: (list) the rows of an indexed setup table as dictionaries, the format of the pse_*_json configuration
+             fields
+    """
+    return df.reset_index().to_dict(orient='records')
+
+
+def _rows_equal(a: pandas.DataFrame, b: pandas.DataFrame) -> pandas.Series:
+    return ((a == b) | (a.isna() & b.isna())).all(axis=1)
+
+
+def propagate_shared(configs: List[pandas.DataFrame], originals: List[pandas.DataFrame],
+                     targets: Optional[Iterable[int]] = None) -> List[int]:
+    """
+    Applies the settings shared in the first configuration to consecutive configurations. Rows shared in the first
+    configuration are copied, rows that were unshared again are restored from the original configuration. All rows
+    of a configuration are compared and assigned at once.
+
+    :param configs: (list) the edited configuration dataframes, indexed by setting, modified in place
+    :param originals: (list) the configuration dataframes as loaded
+    :param targets: (iterable) indices of the configurations to update, all but the first if None
+    :return: (list) indices of the configurations that changed
+    """
+    changed = []
+    if len(configs) < 2 or 'shared' not in configs[0].columns:
+        return changed
+    df0 = configs[0]
+    shared0 = df0['shared'].fillna(False).astype(bool)
+    for j in (range(1, len(configs)) if targets is None else targets):
+        if j < 1 or j >= len(configs):
+            continue
+        dfj = configs[j]
+        common = dfj.index.intersection(df0.index)
+        if common.empty:
+            continue
+        columns = dfj.columns.intersection(df0.columns)
+        first = df0.loc[common, columns]
+        current = dfj.loc[common, columns]
+        is_shared = shared0.loc[common]
+        was_shared = dfj.loc[common, 'shared'].fillna(False).astype(bool)
+        take = is_shared & ~_rows_equal(current, first)
+        restore = ~is_shared & was_shared
+        if not take.any() and not restore.any():
+            continue
+        dfj = dfj.copy()
+        if take.any():
+            dfj.loc[take.index[take], columns] = first.loc[take.index[take]]
+        if restore.any():
+            rows = restore.index[restore]
+            dfj.loc[rows, columns] = originals[j].loc[rows, columns]
+        configs[j] = dfj
+        changed.append(j)
+    return changed
+
+
+def parameter_rows(df_pars: pandas.DataFrame, df_background: pandas.DataFrame) -> pandas.DataFrame:
+    """
+    Summary rows of the model parameters.
+
+    :param df_pars: (Pandas dataframe) the edited model parameters, indexed by parameter name
+    :param df_background: (Pandas dataframe) the background table with the columns dataset, source and sink
+    :return: (Pandas dataframe) with SUMMARY_COLUMNS
+    """
+    index = df_pars.index
+    partype = pandas.Series(numpy.where(df_pars['type'] == 'information', 'd', 'i'), index=index, dtype=object)
+    partype = partype.where(df_pars['relative'].astype(bool), 'f' + partype)
+
+    def _lookup(column):
+        table = df_background.dropna(subset=[column]).drop_duplicates(column)
+        return pandas.Series(table['dataset'].astype(str).to_numpy(), index=table[column].to_numpy())
+
+    source, sink = _lookup('source'), _lookup('sink')
+    in_source = index.isin(source.index)
+    in_sink = index.isin(sink.index) & ~in_source
+    dataset = pandas.Series('-', index=index, dtype=object)
+    dataset[in_sink] = 'b' + sink.reindex(index[in_sink]).to_numpy()
+    dataset[in_source] = source.reindex(index[in_source]).to_numpy()
+
+    optimize = df_pars['optimize'].astype(bool)
+    opt = df_pars[OPT_COLUMNS].astype(str).astype(object).where(optimize, None)
+    return pandas.DataFrame({
+        'type': partype,
+        'dataset': dataset,
+        'config.': numpy.where(in_source | in_sink, '*', '-'),
+        'parameter': index.to_numpy(),
+        'value': df_pars['value'].to_numpy(),
+        'l_fit': df_pars['lowerlimit'].to_numpy(),
+        'u_fit': df_pars['upperlimit'].to_numpy(),
+        'l_opt': opt['lower_opt'],
+        'u_opt': opt['upper_opt'],
+        'step_opt': opt['step_opt'],
+    }, index=index, columns=SUMMARY_COLUMNS).astype(object)
+
+
+def configuration_rows(config: pandas.DataFrame, position: int, shared: pandas.Series,
+                       num_config: int) -> pandas.DataFrame:
+    """
+    Summary rows of one instrument configuration.
+
+    :param config: (Pandas dataframe) the edited configuration, indexed by setting
+    :param position: (int) position of the configuration in the selection
+    :param shared: (Pandas series) the shared column of the first configuration
+    :param num_config: (int) number of selected configurations
+    :return: (Pandas dataframe) with SUMMARY_COLUMNS
+    """
+    index = config.index
+    if num_config == 1:
+        is_shared = numpy.isin(index, shared.index)
+    else:
+        is_shared = shared.reindex(index).fillna(False).astype(bool).to_numpy()
+    optimize = config['optimize'].astype(bool)
+    fit = pandas.Series(0., index=index, dtype=object).where(optimize, None)
+    opt = config[OPT_COLUMNS].astype(object).where(optimize, None)
+    return pandas.DataFrame({
+        'type': 'n',
+        'dataset': '*',
+        'config.': numpy.where(is_shared, '*', str(position)),
+        'parameter': index.to_numpy(),
+        'value': config['value'].to_numpy(),
+        'l_fit': fit,
+        'u_fit': fit,
+        'l_opt': opt['lower_opt'],
+        'u_opt': opt['upper_opt'],
+        'step_opt': opt['step_opt'],
+    }, index=index, columns=SUMMARY_COLUMNS).astype(object)
+
+
+def summarize(tracker: SetupTracker, df_pars: pandas.DataFrame, df_background: pandas.DataFrame,
+              configs: List[pandas.DataFrame]) -> pandas.DataFrame:
+    """
+    Builds the shorthand summary of the optimization setup. The rows of the model parameters and of every
+    configuration are derived separately, only blocks whose tables changed since the last call are rebuilt.
+
+    :param tracker: (SetupTracker) dirty tracking of the session
+    :param df_pars: (Pandas dataframe) the edited model parameters
+    :param df_background: (Pandas dataframe) the background table
+    :param configs: (list) the edited configuration dataframes
+    :return: (Pandas dataframe) the summary with SUMMARY_COLUMNS, shared configuration settings only once
+    """
+    shared = configs[0]['shared'] if 'shared' in configs[0].columns else pandas.Series(True, index=configs[0].index)
+    blocks = [tracker.derive(('summary', 'parameters'), lambda: parameter_rows(df_pars, df_background), df_pars,
+                             df_background)[0]]
+    for i, config in enumerate(configs):
+        blocks.append(tracker.derive(('summary', i), lambda: configuration_rows(config, i, shared, len(configs)),
+                                     config, shared, len(configs))[0])
+
+    def _combine():
+        df_summary = pandas.concat(blocks, ignore_index=True).infer_objects()
+        # remove shared configuration parameters that end up being exact duplicate rows
+        return df_summary.drop_duplicates()
+
+    return tracker.derive(('summary', 'all'), _combine, *[tracker.digest(('summary', 'parameters'))] +
+                          [tracker.digest(('summary', i)) for i in range(len(configs))])[0]
@@ -0,0 +1,343 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+import contextlib
+import os
+from pathlib import Path
+import threading
+from typing import Any, Dict, List, Sequence
+
+import numpy
+import pandas
+
+from sans_app.support import caching
+from sans_app.support.lazy import lazy_import
+
+fitproblem = lazy_import('bumps.fitproblem')
+direct_model = lazy_import('sasmodels.direct_model')
+resolution = lazy_import('sasmodels.resolution')
+
+# bumps problems keyed by runfile path, valid for the digest of the runfile and its data files
+_problem_cache: Dict[str, tuple] = {}
+# a problem is shared by all sessions of the process; evaluations set its parameters and hold its lock meanwhile
+_problem_locks: Dict[int, threading.RLock] = {}
+_problem_locks_lock = threading.Lock()
+
+# instrument settings that only scale the counting statistics, not the Q-grid or the resolution
+COUNTING_FIELDS = ('time', 'neutron_flux')
+# resolution objects kept per process, each holds the smearing weights of its Q-grid
+RESOLUTION_CACHE_SIZE = 64
+
+
+@contextlib.contextmanager
+def working_directory(path):
+    """
+    Changes the working directory for the duration of the context and restores the previous one, also on errors.
+    Run scripts and fnSimulateData resolve data files relative to it.
+    """
+    olddir = os.getcwd()
+    os.chdir(path)
+    try:
+        yield Path(path)
+    finally:
+        os.chdir(olddir)
+
+
+def get_problem(fit_dir, runfile, datafile_names: Sequence[str] = ()):
+    """
+    Loads the bumps problem of a prepared fit directory once per process and keeps it, including the compiled
+    sasmodels kernels, until the runfile or one of its data files changes.
+
+    :param fit_dir: (str or Path-like) the prepared fit directory
+    :param runfile: (str) name of the run script in fit_dir
+    :param datafile_names: (list) names of the data files referenced by the run script
+    :return: bumps FitProblem
+    """
+    fit_dir = Path(fit_dir).expanduser().resolve()
+    path = fit_dir / runfile
+    digest = tuple(caching.file_digest(p) for p in [path] + [fit_dir / f for f in datafile_names]
+                   if p.is_file())
+    cached = _problem_cache.get(str(path))
+    if cached is not None and cached[0] == digest:
+        return cached[1]
+    # run scripts load their data files with relative paths
+    with working_directory(fit_dir):
+        problem = fitproblem.load_problem(str(path))
+    if cached is not None:
+        with _problem_locks_lock:
+            _problem_locks.pop(id(cached[1]), None)
+    _problem_cache[str(path)] = (digest, problem)
+    return problem
+
+
+def problem_lock(problem) -> threading.RLock:
+    """
+    :return: (RLock) the lock that serializes parameter changes of a bumps problem shared between sessions
+    """
+    with _problem_locks_lock:
+        return _problem_locks.setdefault(id(problem), threading.RLock())
+
+
+def geometry(configuration: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    :return: (dict) the settings of a configuration that determine Q-grid and resolution
+    """
+    return {key: value for key, value in configuration.items() if key not in COUNTING_FIELDS}
+
+
+def counting_scale(configurations: List[Dict[str, Any]], t_total=None) -> float:
+    """
+    :return: (float) total neutron exposure of a configuration set; uncertainties scale with its inverse square root
+    """
+    scale = 0.0
+    for configuration in configurations:
+        # a total counting time is split between the configurations by fnSimulateData regardless of their time
+        time = float(t_total) / len(configurations) if t_total else float(configuration.get('time', 1.0))
+        scale += time * float(configuration.get('neutron_flux', 1.0))
+    return scale
+
+
+# instrument templates keyed by template_key(), with the counting scale they were simulated for
+template_cache = caching.ArrayCache(max_bytes=64 * 2 ** 20)
+
+
+def template_key(model_key: str, dataset_configurations, qmin, qmax, simpar, average) -> str:
+    """
+    :return: (str) cache key of an instrument template, independent of counting time and neutron flux
+    """
+    return caching.digest('template', model_key, [[geometry(c) for c in configurations]
+                                                  for configurations in dataset_configurations],
+                          float(qmin), float(qmax), simpar, bool(average))
+
+
+def instrument_templates(fitobj, configuration_sets, qmin, qmax, simpar, average=True, t_total=None,
+                         model_key=None):
+    """
+    Simulates each configuration set once through fnSimulateData to obtain the instrument-specific Q-grid, Q-resolution
+    and counting statistics of every dataset. This is the only step that writes to disk.
+
+    With a model_key, templates are cached by instrument geometry. Configuration sets that only differ in counting
+    time or neutron flux reuse a cached template with uncertainties rescaled to their exposure, see counting_scale().
+    The simulated intensities are noisy draws for the exposure of the first simulation and are not kept, 'I' of
+    cached templates is nan. Callers that show simulated data pass no model_key.
+
+    The rescaling by sqrt(scale / scale_cached) is an approximation. It assumes dI is pure Poisson counting noise of
+    the sample and that fnSimulateData splits time and flux the same way for both exposures. Background subtraction,
+    a minimum relative error or time-dependent corrections of fnSimulateData are not rescaled exactly.
+
+    :param fitobj: molstat.CMolStat of the prepared fit directory
+    :param configuration_sets: (list) M entries, each a list of configurations per dataset as expected by
+                               fnSimulateData(liConfigurations=)
+    :param qmin: (float) lower Q limit
+    :param qmax: (float) upper Q limit
+    :param simpar: (Pandas dataframe) reference parameter values with columns 'par' and 'value'
+    :param average: (bool) stitching mode for multiple configurations per dataset
+    :param t_total: (float or None) total counting time
+    :param model_key: (str) digest of the model script, None disables the cache
+    :return: (list) M lists of Pandas dataframes (Q, I, dI, dQ), one per dataset
+    """
+    templates = []
+    if model_key is None:
+        for dataset_configurations in configuration_sets:
+            liData = fitobj.fnSimulateData(basefilename='sim.dat', liConfigurations=dataset_configurations, qmin=qmin,
+                                           qmax=qmax, t_total=t_total, simpar=simpar, average=average)
+            templates.append([data[1] for data in liData])
+        return templates
+
+    for dataset_configurations in configuration_sets:
+        scale = [counting_scale(configurations, t_total) for configurations in dataset_configurations]
+        key = template_key(model_key, dataset_configurations, qmin, qmax, simpar, average)
+        cached = template_cache.get(key)
+        if cached is None:
+            liData = fitobj.fnSimulateData(basefilename='sim.dat', liConfigurations=dataset_configurations,
+                                           qmin=qmin, qmax=qmax, t_total=t_total, simpar=simpar, average=average)
+            cached = pack_datasets([data[1].assign(I=numpy.nan) for data in liData])
+            cached['scale'] = numpy.asarray(scale, dtype=float)
+            template_cache.put(key, cached)
+        datasets = unpack_datasets({name: value for name, value in cached.items() if name != 'scale'})
+        for d, df in enumerate(datasets):
+            df['dI'] = df['dI'] * numpy.sqrt(cached['scale'][d] / scale[d])
+        templates.append(datasets)
+    return templates
+
+
+def parameter_matrix(problem, parameter_sets: pandas.DataFrame) -> numpy.ndarray:
+    """
+    Expands a table of parameter sets into full bumps parameter vectors. Parameters not given in the table keep their
+    current value in the problem.
+
+    :param problem: bumps FitProblem
+    :param parameter_sets: (Pandas dataframe) one row per parameter set, one column per fit parameter
+    :return: (numpy array) N x P parameter vectors
+    """
+    labels = list(problem.labels())
+    # the current values, not those of an evaluation of another session
+    with problem_lock(problem):
+        p0 = numpy.asarray(problem.getp(), dtype=float)
+    p = numpy.tile(p0, (len(parameter_sets), 1))
+    for name in parameter_sets.columns:
+        if name not in labels:
+            raise KeyError('Unknown fit parameter ' + str(name) + '.')
+        p[:, labels.index(name)] = parameter_sets[name].to_numpy(dtype=float)
+    return p
+
+
+def simpar_to_parameter_sets(simpar: pandas.DataFrame) -> pandas.DataFrame:
+    """
+    Converts the (par, value) table used by the simulation pages into a single-row parameter set table.
+    """
+    return pandas.DataFrame([simpar.set_index('par')['value'].astype(float).to_dict()])
+
+
+def make_resolution(Q, dQ):
+    """
+    :return: sasmodels resolution object for a Q-grid with pinhole resolution dQ, no smearing if dQ is missing
+    """
+    if dQ is None or not numpy.any(dQ):
+        return resolution.Perfect1D(Q)
+    return resolution.Pinhole1D(Q, dQ)
+
+
+_resolution_cache: OrderedDict[str, Any] = OrderedDict()
+_resolution_lock = threading.Lock()
+
+
+def cached_resolution(Q, dQ):
+    """
+    make_resolution() with a per-process LRU cache keyed by the Q-grid and dQ. Parameter changes and counting-time
+    sweeps on the same instrument geometry reuse the Q-grid, and with it the smearing weights. Resolution objects are
+    only read by evaluate_theory() and must not be modified.
+    """
+    Q = numpy.asarray(Q, dtype=float)
+    dQ = None if dQ is None else numpy.asarray(dQ, dtype=float)
+    key = caching.digest(Q, dQ)
+    with _resolution_lock:
+        res = _resolution_cache.get(key)
+        if res is not None:
+            _resolution_cache.move_to_end(key)
+            return res
+    res = make_resolution(Q, dQ)
+    with _resolution_lock:
+        _resolution_cache[key] = res
+        while len(_resolution_cache) > RESOLUTION_CACHE_SIZE:
+            _resolution_cache.popitem(last=False)
+    return res
+
+
+def evaluate_theory(problem, resolutions, p: numpy.ndarray) -> List[numpy.ndarray]:
+    """
+    Evaluates the model of each dataset for a stack of parameter vectors.
+
+    :param problem: bumps FitProblem
+    :param resolutions: (list) one sasmodels resolution object per dataset
+    :param p: (numpy array) N x P parameter vectors
+    :return: (list) one N x nq array of resolution-smeared intensities per dataset
+    """
+    models = list(problem.models)
+    theory = [numpy.empty((len(p), len(res.q))) for res in resolutions]
+    # the whole evaluation holds the problem, other sessions would otherwise set their parameters in between
+    with problem_lock(problem):
+        p0 = numpy.asarray(problem.getp(), dtype=float)
+        kernels = [models[d].model.sasmodel.make_kernel([res.q_calc]) for d, res in enumerate(resolutions)]
+        try:
+            for n in range(len(p)):
+                problem.setp(p[n])
+                for d, res in enumerate(resolutions):
+                    Iq_calc = direct_model.call_kernel(kernels[d], models[d].model.state())
+                    theory[d][n] = res.apply(Iq_calc)
+        finally:
+            problem.setp(p0)
+            for kernel in kernels:
+                kernel.release()
+    return theory
+
+
+def simulate_batch(problem, templates, parameter_sets: pandas.DataFrame, reference: pandas.DataFrame,
+                   noise=False, seed=None) -> List[List[Dict[str, numpy.ndarray]]]:
+    """
+    Simulates N parameter sets for M instrument configuration sets in memory.
+
+    The sasmodels kernel of each dataset and Q-grid is built once and evaluated for all parameter sets. Uncertainties
+    are derived from the counting statistics of the template: dI scales with the square root of the intensity
+    relative to the reference parameter set the template was simulated with.
+
+    dI = dI_template * sqrt(I / I_ref) is an approximation of fnSimulateData. It holds for uncertainties dominated by
+    the counts of the sample. Where the background or a minimum relative error dominates dI, it over- or
+    underestimates the uncertainty of parameter sets far from the reference.
+
+    :param problem: bumps FitProblem, see get_problem()
+    :param templates: (list) M lists of per-dataset Pandas dataframes, see instrument_templates()
+    :param parameter_sets: (Pandas dataframe) N rows of fit parameter values
+    :param reference: (Pandas dataframe) single-row parameter set the templates were simulated with
+    :param noise: (bool) whether to add Gaussian noise according to dI
+    :param seed: (int or None) seed of the noise generator
+    :return: (list) M lists of dictionaries per dataset with arrays 'Q', 'dQ' of length nq and 'I', 'dI' of shape
+             N x nq
+    """
+    rng = numpy.random.default_rng(seed)
+    p = parameter_matrix(problem, parameter_sets)
+    p_ref = parameter_matrix(problem, reference)
+
+    results = []
+    for template in templates:
+        Q = [df['Q'].to_numpy(dtype=float) for df in template]
+        dQ = [df['dQ'].to_numpy(dtype=float) for df in template]
+        dI_template = [df['dI'].to_numpy(dtype=float) for df in template]
+        resolutions = [cached_resolution(Q[d], dQ[d]) for d in range(len(template))]
+
+        # reference and batch in one stack so that every kernel is evaluated in a single pass
+        theory = evaluate_theory(problem, resolutions, numpy.vstack([p_ref, p]))
+        datasets = []
+        for d in range(len(template)):
+            I_ref = theory[d][0]
+            I = theory[d][1:]
+            ratio = numpy.divide(I, I_ref, out=numpy.ones_like(I), where=(I_ref > 0) & (I > 0))
+            dI = dI_template[d] * numpy.sqrt(ratio)
+            if noise:
+                I = I + rng.normal(size=I.shape) * dI
+            datasets.append({'Q': Q[d], 'dQ': dQ[d], 'I': I, 'dI': dI})
+        results.append(datasets)
+    return results
+
+
+def batch_to_dataframe(dataset: Dict[str, numpy.ndarray], n: int) -> pandas.DataFrame:
+    """
+    :return: (Pandas dataframe) Q, I, dI, dQ of parameter set n of a simulated dataset
+    """
+    return pandas.DataFrame({'Q': dataset['Q'], 'I': dataset['I'][n], 'dI': dataset['dI'][n], 'dQ': dataset['dQ']})
+
+
+# simulated datasets of the Simulation page, see simulation_key()
+simulation_cache = caching.ArrayCache(max_bytes=int(os.environ.get('SANS_APP_SIM_CACHE_MB', 256)) * 2 ** 20)
+
+
+def simulation_key(runfile, simpar, configurations, qmin, qmax, average, num_datasets) -> str:
+    """
+    :param runfile: (str or Path-like) the model script in the user model directory
+    :param simpar: (Pandas dataframe) simulation parameters
+    :param configurations: (list) configuration dictionaries
+    :return: (str) cache key of a simulation
+    """
+    return caching.digest('simulation', caching.file_digest(runfile), simpar, configurations, float(qmin),
+                          float(qmax), bool(average), int(num_datasets))
+
+
+def pack_datasets(datasets: Sequence[pandas.DataFrame]) -> Dict[str, numpy.ndarray]:
+    value = {}
+    for i, df in enumerate(datasets):
+        for column in ('Q', 'I', 'dI', 'dQ'):
+            value[str(i) + '/' + column] = df[column].to_numpy(dtype=float)
+    return value
+
+
+def unpack_datasets(value: Dict[str, numpy.ndarray]) -> List[pandas.DataFrame]:
+    num = len({name.split('/')[0] for name in value})
+    return [pandas.DataFrame({column: value[str(i) + '/' + column] for column in ('Q', 'I', 'dI', 'dQ')})
+            for i in range(num)]
+
+
+def write_sans_file(df: pandas.DataFrame, path) -> None:
+    """
+    Writes a dataset in the four-column text format of the example data files.
+    """
+    df[['Q', 'I', 'dI', 'dQ']].to_csv(path, sep=' ', index=False)
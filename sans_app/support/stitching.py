@@ -0,0 +1,167 @@
+from __future__ import annotations
+
+from typing import Dict, List, Optional, Sequence, Union
+
+import numpy
+import pandas
+
+# Merging of SANS datasets measured or simulated in several instrument configurations. Datasets are dictionaries of
+# arrays 'Q', 'I', 'dI' and 'dQ' or Pandas dataframes with these columns. 'I' and 'dI' may also be 2-D (parameter
+# sets x points) as returned by simulation.simulate_batch(), all rows are merged at once.
+COLUMNS = ('Q', 'I', 'dI', 'dQ')
+# density of the common log grid of averaged datasets
+POINTS_PER_DECADE = 60
+
+Dataset = Union[Dict[str, numpy.ndarray], pandas.DataFrame]
+
+
+def _arrays(dataset: Dataset) -> Dict[str, numpy.ndarray]:
+    return {column: numpy.asarray(dataset[column], dtype=float) for column in COLUMNS}
+
+
+def _concatenate(datasets: Sequence[Dataset]) -> tuple:
+    """
+    :return: (tuple) dictionary of the concatenated arrays and the index of the source dataset of every point
+    """
+    arrays = [_arrays(dataset) for dataset in datasets]
+    merged = {column: numpy.concatenate([a[column] for a in arrays], axis=-1) for column in COLUMNS}
+    source = numpy.repeat(numpy.arange(len(arrays)), [a['Q'].shape[-1] for a in arrays])
+    return merged, source
+
+
+def _select(merged: Dict[str, numpy.ndarray], keep: numpy.ndarray) -> Dict[str, numpy.ndarray]:
+    order = numpy.argsort(merged['Q'][keep], kind='stable')
+    return {column: merged[column][..., keep][..., order] for column in COLUMNS}
+
+
+def log_grid(qmin: float, qmax: float, points_per_decade: int = POINTS_PER_DECADE) -> numpy.ndarray:
+    """
+    :return: (numpy array) bin edges equidistant in log(Q) that cover qmin to qmax
+    """
+    decades = numpy.log10(qmax) - numpy.log10(qmin)
+    num = max(int(numpy.ceil(decades * points_per_decade)), 1)
+    return numpy.logspace(numpy.log10(qmin), numpy.log10(qmax), num + 1)
+
+
+def overlap_limits(datasets: Sequence[Dataset]) -> numpy.ndarray:
+    """
+    Splits the Q-ranges of datasets ordered by their median Q at the geometric center of each overlap with the next
+    dataset.
+
+    :return: (numpy array) lower and upper Q limit per dataset, shape (datasets, 2)
+    """
+    ranges = numpy.array([[numpy.min(d['Q']), numpy.max(d['Q']), numpy.median(d['Q'])] for d in datasets],
+                         dtype=float)
+    order = numpy.argsort(ranges[:, 2], kind='stable')
+    limits = numpy.tile([-numpy.inf, numpy.inf], (len(datasets), 1))
+    lower, upper = ranges[order, 0], ranges[order, 1]
+    # overlap of each dataset with the next one; adjacent ranges without overlap are split in the gap
+    start = numpy.minimum(lower[1:], upper[:-1])
+    end = numpy.maximum(lower[1:], upper[:-1])
+    split = numpy.sqrt(start * end)
+    limits[order[:-1], 1] = split
+    limits[order[1:], 0] = split
+    return limits
+
+
+def trim_overlap(datasets: Sequence[Dataset]) -> Dict[str, numpy.ndarray]:
+    """
+    Merges datasets without averaging. In the overlap of two datasets, each keeps its points on its side of the
+    geometric center of the overlap.
+
+    :return: (dict) merged arrays sorted by Q
+    """
+    merged, source = _concatenate(datasets)
+    limits = overlap_limits(datasets)
+    keep = (merged['Q'] >= limits[source, 0]) & (merged['Q'] < limits[source, 1])
+    return _select(merged, keep)
+
+
+def rebin(dataset: Dataset, edges: numpy.ndarray) -> Dict[str, numpy.ndarray]:
+    """
+    Inverse-variance weighted average of all points within each bin. Points without uncertainty only count if no
+    point of the bin has one. Q and dQ are averaged without weights, so that they are shared by all rows of 2-D
+    intensities. Empty bins are dropped.
+
+    :param dataset: (dict or Pandas dataframe) the points to rebin, in any order
+    :param edges: (numpy array) bin edges, see log_grid()
+    :return: (dict) rebinned arrays
+    """
+    data = _arrays(dataset)
+    Q = data['Q']
+    index = numpy.searchsorted(edges, Q, side='right') - 1
+    inside = (index >= 0) & (index < len(edges) - 1) & numpy.isfinite(Q)
+    index = index[inside]
+    num_bins = len(edges) - 1
+    # one-hot assignment of points to bins, sums over bins become matrix products for all rows at once
+    assign = numpy.zeros((len(index), num_bins))
+    assign[numpy.arange(len(index)), index] = 1.0
+    count = assign.sum(axis=0)
+    occupied = count > 0
+
+    I = data['I'][..., inside]
+    dI = data['dI'][..., inside]
+    has_error = dI > 0
+    weight = numpy.divide(1.0, dI ** 2, out=numpy.zeros_like(dI), where=has_error)
+    weight_sum = weight @ assign
+    # bins without any uncertainty fall back to the plain mean
+    plain = weight_sum == 0
+    weight = weight + (~has_error) * (plain @ assign.T)
+    weight_sum = weight @ assign
+
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        I_bin = (weight * I) @ assign / weight_sum
+        dI_bin = numpy.where(plain, 0.0, 1.0 / numpy.sqrt(weight_sum))
+        Q_bin = Q[inside] @ assign / count
+        dQ_bin = numpy.sqrt(data['dQ'][inside] ** 2 @ assign / count)
+    return {'Q': Q_bin[occupied], 'I': I_bin[..., occupied], 'dI': dI_bin[..., occupied], 'dQ': dQ_bin[occupied]}
+
+
+def stitch(datasets: Sequence[Dataset], mode: str = 'overlap', edges: Optional[numpy.ndarray] = None,
+           points_per_decade: int = POINTS_PER_DECADE) -> Dict[str, numpy.ndarray]:
+    """
+    Merges the datasets of several instrument configurations into one dataset.
+
+    :param datasets: (list) one dataset per configuration
+    :param mode: (str) 'overlap' trims overlapping Q-ranges, see trim_overlap(); 'average' takes inverse-variance
+                 weighted averages of all points on a common log grid, see rebin()
+    :param edges: (numpy array) bin edges of the result; None keeps the points for 'overlap' and uses a log grid of
+                  points_per_decade over the combined Q-range for 'average'
+    :param points_per_decade: (int) density of the default log grid
+    :return: (dict) merged arrays sorted by Q
+    """
+    if mode not in ('overlap', 'average'):
+        raise ValueError('Unknown stitching mode ' + str(mode) + '.')
+    if len(datasets) == 1 and edges is None:
+        return _arrays(datasets[0])
+    if mode == 'overlap':
+        merged = trim_overlap(datasets)
+    else:
+        merged, _ = _concatenate(datasets)
+        if edges is None:
+            positive = merged['Q'][merged['Q'] > 0]
+            edges = log_grid(positive.min(), positive.max() * (1 + 1e-9), points_per_decade)
+    if edges is None:
+        return merged
+    return rebin(merged, edges)
+
+
+def stitch_frames(frames: Sequence[pandas.DataFrame], mode: str = 'overlap',
+                  edges: Optional[numpy.ndarray] = None) -> pandas.DataFrame:
+    """
+    stitch() for Pandas dataframes of single datasets.
+
+    :return: (Pandas dataframe) with columns Q, I, dI, dQ
+    """
+    return pandas.DataFrame(stitch(frames, mode=mode, edges=edges), columns=list(COLUMNS))
+
+
+def stitch_batches(batches: Sequence[List[Dict[str, numpy.ndarray]]], mode: str = 'overlap',
+                   edges: Optional[numpy.ndarray] = None) -> List[Dict[str, numpy.ndarray]]:
+    """
+    Stitches simulated batches per dataset, see simulation.simulate_batch().
+
+    :param batches: (list) one entry per configuration, each a list of datasets with 2-D 'I' and 'dI'
+    :return: (list) one stitched dataset per dataset
+    """
+    return [stitch([batch[d] for batch in batches], mode=mode, edges=edges) for d in range(len(batches[0]))]
@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+import json
+import os
+from pathlib import Path
+import time
+from typing import Any, Dict, List, Optional
+import uuid
+
+import numpy
+
+# Fit results are stored as <model digest>_<data digest>.npz with the best point, next to a .json file with the
+# parameter labels and the metadata used to find the nearest stored result. The DREAM population is not stored, a warm
+# fit draws its population around the best point instead.
+DIGEST_LENGTH = 16
+# fraction of the requested burn-in steps of a DREAM fit that starts from a stored result of the same model or data
+WARM_BURN_FRACTION = 0.25
+# matches of find() that justify a reduced burn-in; a result that only shares the parameter labels is a starting point
+REDUCED_BURN_MATCHES = ('exact', 'model', 'data')
+
+
+def _name(model_digest: str, data_digest: str) -> str:
+    return model_digest[:DIGEST_LENGTH] + '_' + data_digest[:DIGEST_LENGTH]
+
+
+def save(store_dir, model_digest: str, data_digest: str, labels: List[str], best) -> None:
+    """
+    Stores the result of a fit.
+
+    :param store_dir: (str or Path-like) the result store, a cache folder of the user fit directory
+    :param model_digest: (str) content digest of the model script
+    :param data_digest: (str) content digest of the data files
+    :param labels: (list) parameter labels of the fit problem
+    :param best: (numpy array) best point
+    """
+    store_dir = Path(store_dir)
+    name = _name(model_digest, data_digest)
+    tmp = store_dir / (name + '.' + uuid.uuid4().hex + '.tmp.npz')
+    numpy.savez(tmp, best=numpy.asarray(best, dtype=float))
+    os.replace(tmp, store_dir / (name + '.npz'))
+    meta = {'model': model_digest, 'data': data_digest, 'labels': list(labels), 'saved': time.time()}
+    tmp = store_dir / (name + '.json.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp, store_dir / (name + '.json'))
+
+
+def find(store_dir, model_digest: str, data_digest: str, labels: List[str]) -> Optional[Dict[str, Any]]:
+    """
+    Finds the stored result closest to a new fit. Only results with the same parameter labels qualify. A result for
+    the same model and data is preferred over one for the same model, which is preferred over one of another model
+    script, e.g. with edited fit ranges. Among equals, the most recent result wins.
+
+    :return: (dict) with 'best', 'model', 'data' and 'match' ('exact', 'model', 'data' or 'labels'), None if there
+             is no such result
+    """
+    candidates = []
+    for path in Path(store_dir).glob('*.json'):
+        try:
+            with open(path) as f:
+                meta = json.load(f)
+        except (IOError, ValueError):
+            continue
+        if meta.get('labels') != list(labels):
+            continue
+        rank = 2 if meta['model'] == model_digest else 0
+        rank += 1 if meta['data'] == data_digest else 0
+        candidates.append((rank, meta.get('saved', 0), path, meta))
+    for rank, _, path, meta in sorted(candidates, key=lambda c: (c[0], c[1]), reverse=True):
+        try:
+            with numpy.load(path.with_suffix('.npz'), allow_pickle=False) as npz:
+                best = npz['best']
+        except (IOError, ValueError, KeyError):
+            continue
+        match = ('labels', 'data', 'model', 'exact')[rank]
+        return dict(best=best, model=meta['model'], data=meta['data'], match=match)
+    return None
+
+
+def warm_burn(burn: int, match: str) -> int:
+    """
+    :param burn: (int) requested burn-in steps
+    :param match: (str) the match of the seed, see find()
+    :return: (int) burn-in steps of a fit started from the seed
+    """
+    if match not in REDUCED_BURN_MATCHES:
+        return burn
+    return max(1, int(burn * WARM_BURN_FRACTION))
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# the tests import sans_app from the source tree, without an installed package
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,101 @@
+import os
+from types import SimpleNamespace
+
+import pandas
+import pytest
+
+pytest.importorskip('streamlit')
+pytest.importorskip('PIL')
+pytest.importorskip('roadmap_datamanager')
+pytest.importorskip('pse')
+from sans_app.support import app_functions
+
+
+class _FitObject:
+    # stands in for molstat.CMolStat, counting how often a fit problem is loaded
+    loaded = 0
+
+    def __init__(self, **kwargs):
+        type(self).loaded += 1
+        self.runfile = kwargs['runfile']
+
+    def fnLoadParameters(self):
+        return {'par': ['radius', 'sld'], 'value': [20.0, 1.0]}
+
+    def fnGetAllParameterNames(self, model=0):
+        return ['radius', 'sld', 'scale']
+
+
+@pytest.fixture
+def runfile_setup(tmp_path, monkeypatch):
+    parsed = []
+
+    def extract_data_filenames_from_runfile(runfile):
+        parsed.append(runfile)
+        return ['sample.dat', 'missing.dat']
+
+    monkeypatch.setattr(app_functions, 'api_sasview', SimpleNamespace(
+        extract_data_filenames_from_runfile=extract_data_filenames_from_runfile,
+        write_dummy_sans_file=lambda path: open(path, 'w').close()))
+    monkeypatch.setattr(app_functions, 'molstat', SimpleNamespace(CMolStat=_FitObject))
+    monkeypatch.setattr(app_functions, '_runfile_cache', {})
+    monkeypatch.setattr(_FitObject, 'loaded', 0)
+    # process_runfile changes into the fit directory
+    monkeypatch.chdir(tmp_path)
+
+    model_dir, file_dir, fit_dir = tmp_path / 'models', tmp_path / 'data', tmp_path / 'fit'
+    for path in (model_dir, file_dir, fit_dir):
+        path.mkdir()
+    (model_dir / 'sphere.py').write_text('model = "sphere"\n')
+    (file_dir / 'sample.dat').write_text('0.1 1.0 0.1 0.01\n')
+    return model_dir, file_dir, fit_dir, parsed
+
+
+def test_cold_path_prepares_the_fit_directory(runfile_setup):
+    model_dir, file_dir, fit_dir, parsed = runfile_setup
+    (fit_dir / 'stale.py').write_text('')
+    (fit_dir / 'jobs').mkdir()
+    df_pars, li_allpars, datafile_names, fitobj = app_functions.process_runfile('sphere.py', model_dir, file_dir,
+                                                                                fit_dir)
+    assert len(parsed) == 1 and _FitObject.loaded == 1
+    assert isinstance(fitobj, _FitObject)
+    assert list(df_pars['par']) == ['radius', 'sld']
+    assert li_allpars == ['radius', 'sld', 'scale']
+    assert datafile_names == ['sample.dat', 'missing.dat']
+    # the job folder survives, a missing data file is replaced by a dummy
+    assert sorted(p.name for p in fit_dir.iterdir()) == sorted(['jobs', 'missing.dat', 'sample.dat', 'sphere.py',
+                                                                app_functions.RUNFILE_CACHE_FILE])
+    assert os.getcwd() == str(fit_dir.resolve())
+
+
+def test_warm_path_skips_parsing_and_loading(runfile_setup):
+    model_dir, file_dir, fit_dir, parsed = runfile_setup
+    cold = app_functions.process_runfile('sphere.py', model_dir, file_dir, fit_dir)
+    warm = app_functions.process_runfile('sphere.py', model_dir, file_dir, fit_dir)
+    assert len(parsed) == 1 and _FitObject.loaded == 1
+    pandas.testing.assert_frame_equal(warm[0], cold[0])
+    assert warm[1:3] == cold[1:3]
+    # the fit object is only loaded when it is used
+    assert isinstance(warm[3], app_functions._LazyFitObject)
+    assert warm[3].runfile == 'sphere.py'
+    assert _FitObject.loaded == 2
+
+    # a new server process finds the cache file in the fit directory
+    app_functions._runfile_cache.clear()
+    app_functions.process_runfile('sphere.py', model_dir, file_dir, fit_dir)
+    assert len(parsed) == 1
+
+
+def test_touched_files_stay_warm_and_changed_files_do_not(runfile_setup):
+    model_dir, file_dir, fit_dir, parsed = runfile_setup
+    app_functions.process_runfile('sphere.py', model_dir, file_dir, fit_dir)
+    datafile = file_dir / 'sample.dat'
+    stat = datafile.stat()
+    os.utime(datafile, (stat.st_atime + 10, stat.st_mtime + 10))
+    app_functions.process_runfile('sphere.py', model_dir, file_dir, fit_dir)
+    assert len(parsed) == 1
+
+    datafile.write_text('0.1 2.0 0.1 0.01\n')
+    app_functions.process_runfile('sphere.py', model_dir, file_dir, fit_dir)
+    assert len(parsed) == 2 and _FitObject.loaded == 2
+    assert (fit_dir / 'sample.dat').read_text() == '0.1 2.0 0.1 0.01\n'
@@ -0,0 +1,58 @@
+import json
+import os
+import zipfile
+
+from sans_app.support import archive
+
+
+def _write(path, text):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text)
+
+
+def _names(path):
+    with zipfile.ZipFile(path) as zf:
+        assert zf.testzip() is None
+        return sorted(zf.namelist())
+
+
+def test_build_archive_reuses_appends_and_rebuilds(tmp_path):
+    src = tmp_path / 'fit'
+    _write(src / 'run.py', 'print(1)\n')
+    _write(src / 'MCMC' / 'run.par', 'a 1\n')
+    zip_path = tmp_path / 'fit.zip'
+
+    archive.build_archive(src, zip_path)
+    assert _names(zip_path) == ['MCMC/run.par', 'run.py']
+    manifest = json.loads((tmp_path / ('fit.zip' + archive.MANIFEST_SUFFIX)).read_text())
+    assert sorted(manifest) == ['MCMC/run.par', 'run.py']
+
+    # unchanged: the archive is reused as it is
+    mtime = zip_path.stat().st_mtime_ns
+    archive.build_archive(src, zip_path)
+    assert zip_path.stat().st_mtime_ns == mtime
+
+    # added file: appended, existing members are kept once
+    _write(src / 'MCMC' / 'run.err', 'chisq 1\n')
+    archive.build_archive(src, zip_path)
+    assert _names(zip_path) == ['MCMC/run.err', 'MCMC/run.par', 'run.py']
+
+    # changed and deleted files: rebuilt from scratch
+    _write(src / 'run.py', 'print(2)\n')
+    os.utime(src / 'run.py', (1e9, 1e9))
+    (src / 'MCMC' / 'run.par').unlink()
+    archive.build_archive(src, zip_path)
+    assert _names(zip_path) == ['MCMC/run.err', 'run.py']
+    with zipfile.ZipFile(zip_path) as zf:
+        assert zf.read('run.py') == b'print(2)\n'
+    assert not list(tmp_path.glob('*.tmp'))
+
+
+def test_build_archive_stores_compressed_files(tmp_path):
+    src = tmp_path / 'fit'
+    _write(src / 'plot.png', 'not really a png')
+    _write(src / 'chain.txt', 'x' * 1000)
+    zip_path = archive.build_archive(src, tmp_path / 'fit.zip')
+    with zipfile.ZipFile(zip_path) as zf:
+        assert zf.getinfo('plot.png').compress_type == zipfile.ZIP_STORED
+        assert zf.getinfo('chain.txt').compress_type != zipfile.ZIP_STORED
@@ -0,0 +1,75 @@
+import os
+
+import numpy
+
+from sans_app.support import caching
+
+
+def _entry(n):
+    return {'a': numpy.zeros(n)}
+
+
+def test_digest_is_stable_and_content_sensitive():
+    assert caching.digest({'b': 1, 'a': [1, 2]}, numpy.arange(3)) == caching.digest({'a': [1, 2], 'b': 1},
+                                                                                    numpy.arange(3))
+    assert caching.digest(numpy.arange(3)) != caching.digest(numpy.arange(3.0) + 1)
+
+
+def test_array_cache_evicts_least_recently_used():
+    cache = caching.ArrayCache(max_bytes=2 * 8 * 10)
+    cache.put('first', _entry(10))
+    cache.put('second', _entry(10))
+    # touching first makes second the oldest entry
+    assert cache.get('first') is not None
+    cache.put('third', _entry(10))
+    assert cache.get('second') is None
+    assert cache.get('first') is not None
+    assert cache.get('third') is not None
+    assert cache.nbytes == 2 * 8 * 10
+
+
+def test_array_cache_keeps_a_single_oversized_entry():
+    cache = caching.ArrayCache(max_bytes=8)
+    cache.put('large', _entry(100))
+    assert cache.get('large') is not None
+
+
+def test_array_cache_replacing_a_key_updates_its_size():
+    cache = caching.ArrayCache()
+    cache.put('key', _entry(10))
+    cache.put('key', _entry(4))
+    assert cache.nbytes == 8 * 4
+
+
+def test_array_cache_disk_tier(tmp_path):
+    value = {'x': numpy.arange(5.0), 'y': numpy.ones((2, 3))}
+    caching.ArrayCache().put('key', value, disk_dir=tmp_path)
+    assert (tmp_path / 'key.npz').is_file()
+    assert not list(tmp_path.glob('*.tmp*'))
+
+    # a fresh cache, e.g. of another process, is served from disk and keeps the entry in memory afterwards
+    cache = caching.ArrayCache()
+    loaded = cache.get('key', disk_dir=tmp_path)
+    numpy.testing.assert_array_equal(loaded['x'], value['x'])
+    numpy.testing.assert_array_equal(loaded['y'], value['y'])
+    (tmp_path / 'key.npz').unlink()
+    assert cache.get('key') is not None
+    assert cache.get('missing', disk_dir=tmp_path) is None
+
+
+def test_array_cache_disk_tier_is_bounded(tmp_path):
+    writer = caching.ArrayCache()
+    writer.put('a', _entry(1000), disk_dir=tmp_path)
+    entry_size = (tmp_path / 'a.npz').stat().st_size
+    cache = caching.ArrayCache(max_disk_bytes=3 * entry_size)
+    for age, key in enumerate(['a', 'b', 'c']):
+        cache.put(key, _entry(1000), disk_dir=tmp_path)
+        os.utime(tmp_path / (key + '.npz'), (1e9 + age, 1e9 + age))
+
+    # a disk hit marks the entry as recently used, so that the next put() evicts 'b' instead
+    cache.clear()
+    assert cache.get('a', disk_dir=tmp_path) is not None
+    cache.put('d', _entry(1000), disk_dir=tmp_path)
+    assert sorted(p.stem for p in tmp_path.glob('*.npz')) == ['a', 'c', 'd']
+    cache.put('e', _entry(1000), disk_dir=tmp_path)
+    assert sorted(p.stem for p in tmp_path.glob('*.npz')) == ['a', 'd', 'e']
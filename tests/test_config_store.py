@@ -0,0 +1,58 @@
+import os
+
+import pandas
+import pytest
+
+from sans_app.support import config_store
+
+
+def _frame(time=60):
+    return pandas.DataFrame({'setting': ['time', 'detector_distance'], 'value': [time, 4.0]})
+
+
+def test_save_writes_only_changes(tmp_path):
+    store = config_store.ConfigStore(tmp_path)
+    assert store.save('a.json', _frame())
+    mtime = os.stat(tmp_path / 'a.json').st_mtime_ns
+    assert not store.save('a.json', _frame())
+    assert os.stat(tmp_path / 'a.json').st_mtime_ns == mtime
+    assert store.save('a.json', _frame(time=120))
+    assert store.configuration('a.json') == {'time': 120, 'detector_distance': 4.0}
+    assert not list(tmp_path.glob('.*.tmp'))
+
+
+def test_unchanged_content_is_detected_across_stores(tmp_path):
+    config_store.ConfigStore(tmp_path).save('a.json', _frame())
+    # a new store, e.g. after a restart, compares with the parsed file
+    assert not config_store.ConfigStore(tmp_path).save('a.json', _frame())
+
+
+def test_external_edits_are_parsed_again(tmp_path):
+    store = config_store.ConfigStore(tmp_path)
+    store.save('a.json', _frame())
+    assert store.configuration('a.json')['time'] == 60
+    _frame(time=30).to_json(tmp_path / 'a.json', orient='records')
+    os.utime(tmp_path / 'a.json', ns=(1, 1))
+    assert store.configuration('a.json')['time'] == 30
+    frame = store.frame('a.json')
+    frame.loc[0, 'value'] = 0
+    assert store.configuration('a.json')['time'] == 30
+
+
+def test_names_copy_and_delete(tmp_path):
+    store = config_store.ConfigStore(tmp_path)
+    store.save('b.json', _frame())
+    store.copy('b.json', 'a.json')
+    (tmp_path / 'notes.txt').write_text('')
+    (tmp_path / '.hidden.json').write_text('[]')
+    assert store.names() == ['a.json', 'b.json']
+    assert store.configurations(['a.json', 'b.json'])[0] == store.configuration('b.json')
+    assert store.delete('a.json')
+    assert not store.delete('a.json')
+    with pytest.raises(FileNotFoundError):
+        store.configuration('a.json')
+    assert config_store.ConfigStore(tmp_path / 'missing').names() == []
+
+
+def test_get_store_is_shared_per_folder(tmp_path):
+    assert config_store.get_store(tmp_path) is config_store.get_store(str(tmp_path) + '/.')
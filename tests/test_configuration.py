@@ -0,0 +1,117 @@
+import dataclasses
+import json
+
+import pytest
+
+pytest.importorskip('roadmap_datamanager')
+pytest.importorskip('pse')
+from sans_app.support import configuration
+
+
+@pytest.fixture
+def writes(tmp_path, monkeypatch):
+    written = []
+
+    def save_config(data, env_var, app_name, app_author, filename):
+        path = tmp_path / filename
+        with open(path, 'w') as f:
+            json.dump(dataclasses.asdict(data), f, default=configuration._json_default)
+        written.append(filename)
+        return path
+
+    monkeypatch.setattr(configuration, 'save_config', save_config)
+    monkeypatch.setattr(configuration, '_main_written', None)
+    return written
+
+
+def _main_writes(written):
+    # the main file goes through a unique temporary name per write
+    assert all(name.startswith('config.json.') and name.endswith('.tmp') for name in written)
+    assert len(set(written)) == len(written)
+    return len(written)
+
+
+def _sidecar(path):
+    with open(configuration._sidecar_path(path)) as f:
+        return json.load(f)
+
+
+def test_save_detects_in_place_changes(writes):
+    cfg = configuration.DataManagerConfig()
+    path = configuration.save_persistent_cfg(cfg, force=True)
+    writes.clear()
+
+    configuration.save_persistent_cfg(cfg, force=True)
+    assert writes == []
+
+    # only the sidecar holds the tables, the main file is left alone
+    cfg.pse_configs_json.append({'time': 60})
+    configuration.save_persistent_cfg(cfg, force=True)
+    assert writes == []
+    assert _sidecar(path)['pse_configs_json'] == [{'time': 60}]
+    with open(path) as f:
+        assert json.load(f)['pse_configs_json'] == []
+
+    cfg.pse_qmin = 0.002
+    configuration.save_persistent_cfg(cfg, force=True)
+    assert _main_writes(writes) == 1
+
+
+def test_bookkeeping_stays_off_the_configuration(writes):
+    cfg = configuration.DataManagerConfig()
+    cfg.pse_qmin = 0.003
+    configuration.save_persistent_cfg(cfg, force=True)
+    assert '_assigned' not in vars(cfg)
+    assert set(dataclasses.asdict(cfg)) == {f.name for f in dataclasses.fields(cfg)}
+
+
+def test_writers_are_kept_per_configuration(writes):
+    first, second = configuration.DataManagerConfig(), configuration.DataManagerConfig()
+    configuration.save_persistent_cfg(first, force=True)
+    configuration.save_persistent_cfg(second, force=True)
+    assert configuration._writer(first) is not configuration._writer(second)
+    writes.clear()
+    second.pse_qmax = 0.4
+    configuration.save_persistent_cfg(first, force=True)
+    assert writes == []
+    configuration.save_persistent_cfg(second, force=True)
+    assert _main_writes(writes) == 1
+
+
+def test_temporary_names_are_unique(writes):
+    first, second = configuration.DataManagerConfig(), configuration.DataManagerConfig()
+    configuration.save_persistent_cfg(first, force=True)
+    configuration.save_persistent_cfg(second, force=True)
+    assert _main_writes(writes) == 2
+
+
+def test_attach_skips_unchanged_main_file(writes):
+    cfg = configuration.DataManagerConfig()
+    configuration._writer(cfg).attach(cfg)
+    writes.clear()
+
+    # a reload of the file this process just wrote does not rewrite it
+    reloaded = configuration.DataManagerConfig()
+    configuration._writer(reloaded).attach(reloaded)
+    assert writes == []
+    assert configuration._writer(reloaded).path == configuration._writer(cfg).path
+
+    changed = configuration.DataManagerConfig()
+    changed.pse_qmin = 0.005
+    configuration._writer(changed).attach(changed)
+    assert _main_writes(writes) == 1
+
+
+def test_pending_write_outlives_the_configuration(writes, monkeypatch):
+    monkeypatch.setattr(configuration, 'SAVE_DEBOUNCE', 0.2)
+    cfg = configuration.DataManagerConfig()
+    path = configuration.save_persistent_cfg(cfg, force=True)
+    cfg.pse_qmin = 0.007
+    configuration.save_persistent_cfg(cfg)
+    writer = configuration._writer(cfg)
+    timer = writer._timer
+    assert timer is not None
+    del cfg
+    timer.join()
+    with open(path) as f:
+        assert json.load(f)['pse_qmin'] == 0.007
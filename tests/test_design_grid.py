@@ -0,0 +1,69 @@
+import math
+
+import numpy
+import pandas
+import pytest
+
+from sans_app.support import design_grid
+
+
+def _summary():
+    rows = [
+        # type, dataset, config., parameter, value, l_fit, u_fit, l_opt, u_opt, step_opt
+        ('i', '0', '*', 'scale', 0.5, 0.0, 10.0, '0.0', '1.0', '0.5'),
+        ('fd', '-', '-', 'sld', 1.0, 0.0, 4.0, None, None, None),
+        ('n', '*', '*', 'time', 60, None, None, '60', '120', '60'),
+        ('n', '*', '1', 'detector_distance', 4.0, None, None, None, None, None),
+        ('n', '*', '1', 'guide', 'open', None, None, None, None, None),
+    ]
+    return pandas.DataFrame(rows, columns=['type', 'dataset', 'config.', 'parameter', 'value', 'l_fit', 'u_fit',
+                                           'l_opt', 'u_opt', 'step_opt'])
+
+
+def test_grid_axes_and_number_of_points():
+    axes = design_grid.grid_axes(_summary())
+    assert [axis['name'] for axis in axes] == ['scale', 'time']
+    numpy.testing.assert_allclose(axes[0]['values'], [0.0, 0.5, 1.0])
+    numpy.testing.assert_allclose(axes[1]['values'], [60, 120])
+    points = design_grid.design_points(axes)
+    assert points.shape == (6, 2)
+    assert design_grid.num_points(axes) == len(points)
+    assert design_grid.num_points([]) == len(design_grid.design_points([]))
+
+
+def test_apply_point_resolves_relative_values_and_configurations():
+    df_summary = _summary()
+    configurations = [{'time': 10, 'detector_distance': 1.0}, {'time': 10, 'detector_distance': 1.0}]
+    axes = design_grid.grid_axes(df_summary)
+    values, resolved = design_grid.apply_point(df_summary, configurations, axes, [0.5, 120])
+    # design values of relative parameters are fractions of the fit range
+    assert values == {'scale': 5.0, 'sld': 1.0}
+    assert [c['time'] for c in resolved] == [120.0, 120.0]
+    assert [c['detector_distance'] for c in resolved] == [1.0, 4.0]
+    assert resolved[1]['guide'] == 'open'
+    # the input configurations are left alone
+    assert configurations[0] == {'time': 10, 'detector_distance': 1.0}
+
+
+def test_apply_point_without_design_uses_summary_values():
+    values, resolved = design_grid.apply_point(_summary(), [{}, {}], [], [])
+    assert values == {'scale': 0.5, 'sld': 1.0}
+    assert resolved[0] == {'time': 60.0}
+
+
+def test_information_gain_of_a_gaussian_posterior():
+    sigma, width = 0.1, 4.0
+    gain = design_grid.information_gain(numpy.array([[sigma ** 2]]), ['sld'], {'sld': width})
+    assert gain == pytest.approx(math.log2(width) - 0.5 * math.log2(2 * math.pi * math.e * sigma ** 2))
+
+
+def test_information_gain_marginalizes_nuisance_parameters():
+    cov = numpy.array([[0.01, 0.005], [0.005, 0.04]])
+    gain = design_grid.information_gain(cov, ['sld', 'scale'], {'sld': 4.0})
+    assert gain == pytest.approx(design_grid.information_gain(cov[:1, :1], ['sld'], {'sld': 4.0}))
+    widths = design_grid.information_parameters(_summary())
+    assert widths == {'sld': 4.0}
+
+
+def test_information_gain_of_a_singular_covariance_is_nan():
+    assert math.isnan(design_grid.information_gain(numpy.zeros((2, 2)), ['a', 'b'], {'a': 1.0, 'b': 1.0}))
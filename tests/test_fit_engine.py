@@ -0,0 +1,150 @@
+from types import SimpleNamespace
+
+import numpy
+import pytest
+
+from sans_app.support import fit_engine
+
+LABELS = ['a', 'b', 'c']
+
+
+class _Conn:
+    # the worker end of the pipe to the server
+    def __init__(self, incoming=()):
+        self.incoming = list(incoming)
+        self.sent = []
+
+    def poll(self):
+        return bool(self.incoming)
+
+    def recv(self):
+        return self.incoming.pop(0)
+
+    def send(self, message):
+        self.sent.append(message)
+
+
+def _monitor(burn=0, steps=100, rhat_stop=0.0, conn=None):
+    problem = SimpleNamespace(labels=lambda: LABELS, dof=10)
+    return fit_engine._ProgressMonitor(conn or _Conn(), problem, burn, steps, rhat_stop=rhat_stop)
+
+
+def _history(step, population, values):
+    best = numpy.argmin(values)
+    return SimpleNamespace(step=[step], point=[population[best]], value=[values[best]],
+                           population_points=[population], population_values=[values])
+
+
+def _chains(steps=200, chains=4, seed=0, offsets=None):
+    rng = numpy.random.default_rng(seed)
+    samples = rng.normal(size=(steps, chains, len(LABELS))) * [1.0, 2.0, 0.5]
+    if offsets is not None:
+        samples += numpy.asarray(offsets)[:, numpy.newaxis]
+    return samples
+
+
+def _feed(monitor, samples, first_step=1):
+    for k, population in enumerate(samples):
+        monitor(_history(first_step + k, population, (population ** 2).sum(axis=1)))
+
+
+def _gelman_rubin(samples):
+    n = len(samples)
+    within = samples.var(axis=0, ddof=1).mean(axis=0)
+    between = n * samples.mean(axis=0).var(axis=0, ddof=1)
+    return numpy.sqrt(((n - 1) / n * within + between / n) / within)
+
+
+def test_welford_accumulators_match_numpy():
+    samples = _chains()
+    monitor = _monitor()
+    _feed(monitor, samples)
+    assert monitor.count == len(samples)
+    numpy.testing.assert_allclose(monitor.mean, samples.mean(axis=0))
+    numpy.testing.assert_allclose(monitor.m2 / (monitor.count - 1), samples.var(axis=0, ddof=1))
+
+
+def test_samples_of_the_burn_in_are_skipped():
+    samples = _chains(seed=1)
+    monitor = _monitor(burn=50)
+    _feed(monitor, samples)
+    assert monitor.count == len(samples) - 50
+    numpy.testing.assert_allclose(monitor.mean, samples[50:].mean(axis=0))
+
+
+def test_rhat_matches_gelman_rubin():
+    monitor = _monitor()
+    assert monitor.rhat() is None
+    samples = _chains(seed=2, offsets=[0.0, 0.5, -0.5, 1.0])
+    _feed(monitor, samples)
+    numpy.testing.assert_allclose(monitor.rhat(), _gelman_rubin(samples))
+    # chains that disagree give a clearly larger R-hat than well-mixed ones
+    assert numpy.all(monitor.rhat() > _gelman_rubin(_chains(seed=2)))
+
+
+def test_rhat_needs_two_samples_and_two_chains():
+    monitor = _monitor()
+    _feed(monitor, _chains(steps=1))
+    assert monitor.rhat() is None
+    assert monitor.posterior() is None
+    monitor = _monitor()
+    _feed(monitor, _chains(steps=20, chains=1))
+    assert monitor.rhat() is None
+
+
+def test_posterior_pools_all_chains():
+    samples = _chains(seed=3, offsets=[0.0, 0.2, 0.4, 0.6])
+    monitor = _monitor()
+    _feed(monitor, samples)
+    posterior = monitor.posterior()
+    pooled = samples.reshape(-1, len(LABELS))
+    rhat = _gelman_rubin(samples)
+    for i, label in enumerate(LABELS):
+        assert posterior[label]['mean'] == pytest.approx(pooled[:, i].mean())
+        assert posterior[label]['std'] == pytest.approx(pooled[:, i].std(ddof=1))
+        assert posterior[label]['rhat'] == pytest.approx(rhat[i])
+
+
+def test_acceptance_counts_moved_chains():
+    monitor = _monitor()
+    population = _chains(steps=1)[0]
+    monitor(_history(1, population, numpy.ones(4)))
+    assert monitor.proposed == 0
+    moved = population.copy()
+    moved[[0, 2]] += 1.0
+    monitor(_history(2, moved, numpy.ones(4)))
+    monitor(_history(3, moved, numpy.ones(4)))
+    assert (monitor.accepted, monitor.proposed) == (2, 8)
+
+
+def test_best_point_and_report():
+    conn = _Conn()
+    monitor = _monitor(burn=2, conn=conn)
+    samples = _chains(steps=5, seed=4)
+    _feed(monitor, samples)
+    values = (samples ** 2).sum(axis=2)
+    step, chain = numpy.unravel_index(numpy.argmin(values), values.shape)
+    numpy.testing.assert_array_equal(monitor.best_point, samples[step, chain])
+
+    monitor.report(final=True)
+    kind, report = conn.sent[-1]
+    assert kind == 'progress'
+    assert report['final'] and report['phase'] == 'sampling' and report['samples'] == 3
+    assert report['total_steps'] == 102
+    assert report['best_chisq'] == pytest.approx(2 * values.min() / 10)
+    assert report['best_point'] == dict(zip(LABELS, samples[step, chain].tolist()))
+    assert report['max_rhat'] == pytest.approx(monitor.rhat().max())
+
+
+def test_abort_test_on_convergence_and_stop_request():
+    monitor = _monitor(steps=100, rhat_stop=1.2)
+    _feed(monitor, _chains(steps=19, seed=5))
+    # fewer samples than MIN_STEPS_FRACTION of the steps never converge
+    assert not monitor.converged and not monitor()
+    _feed(monitor, _chains(steps=200, seed=6), first_step=20)
+    assert monitor.converged and monitor()
+
+    monitor = _monitor(conn=_Conn(['stop']))
+    assert not monitor()
+    _feed(monitor, _chains(steps=1))
+    assert monitor.stop_requested and monitor()
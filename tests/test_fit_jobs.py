@@ -0,0 +1,174 @@
+from collections import OrderedDict
+import pickle
+
+import pytest
+
+from sans_app.support import fit_engine
+from sans_app.support import fit_jobs
+
+
+class _Executor:
+    # runs the queued jobs when the test says so
+    def __init__(self):
+        self.queued = []
+
+    def submit(self, fn, *args):
+        self.queued.append((fn, args))
+
+    def run_all(self):
+        while self.queued:
+            fn, args = self.queued.pop(0)
+            fn(*args)
+
+
+class _Engine:
+    def __init__(self, outcome):
+        self.outcome = outcome
+        self.calls = []
+        self.cancelled = False
+
+    def fit(self, fdir, runfile, log, **kwargs):
+        self.calls.append((fdir, runfile, kwargs))
+        return self.outcome(self)
+
+    def cancel(self):
+        self.cancelled = True
+
+
+@pytest.fixture
+def jobs(tmp_path, monkeypatch):
+    executor = _Executor()
+    monkeypatch.setattr(fit_jobs, '_executor', executor)
+    monkeypatch.setattr(fit_jobs, '_active', {})
+    monkeypatch.setattr(fit_jobs, '_progress', {})
+    monkeypatch.setattr(fit_jobs, '_results', OrderedDict())
+    engines = []
+
+    def use(outcome):
+        engine = _Engine(outcome)
+        engines.append(engine)
+        return engine
+
+    monkeypatch.setattr(fit_engine, 'acquire', lambda: engines[-1])
+    monkeypatch.setattr(fit_engine, 'release', lambda engine: None)
+    runfile = tmp_path / 'model.py'
+    runfile.write_text('a = 1\n')
+    datafile = tmp_path / 'sample.dat'
+    datafile.write_text('0.1 1.0 0.1 0.01\n')
+    return tmp_path / 'fits', executor, use, runfile, [datafile]
+
+
+def test_fit_runs_from_queued_to_done(jobs):
+    fit_dir, executor, use, runfile, datafiles = jobs
+    engine = use(lambda engine: {'chisq': 1.0})
+    job_id = fit_jobs.submit_fit(fit_dir, runfile, datafiles, burn=10, steps=20)
+    assert fit_jobs.get_job(fit_dir, job_id)['status'] == 'queued'
+    assert fit_jobs.queued_jobs() == 1
+
+    executor.run_all()
+    state = fit_jobs.get_job(fit_dir, job_id)
+    assert state['status'] == 'done'
+    assert fit_jobs.load_results(fit_dir, job_id) == {'chisq': 1.0}
+    fdir, runfile_name, kwargs = engine.calls[0]
+    assert runfile_name == 'model'
+    assert sorted(p.name for p in fdir.iterdir()) == ['model.py', 'results.pkl', 'sample.dat']
+    assert (kwargs['burn'], kwargs['steps'], kwargs['warm_start_dir']) == (10, 20, None)
+    assert fit_jobs.queued_jobs() == fit_jobs.running_jobs() == 0
+
+
+def test_failed_fit_records_the_error(jobs):
+    fit_dir, executor, use, runfile, datafiles = jobs
+
+    def fail(engine):
+        raise fit_engine.FitError('model does not load')
+
+    use(fail)
+    job_id = fit_jobs.submit_fit(fit_dir, runfile, datafiles)
+    executor.run_all()
+    state = fit_jobs.get_job(fit_dir, job_id)
+    assert state['status'] == 'failed'
+    assert state['error'] == 'model does not load'
+    assert fit_jobs.load_results(fit_dir, job_id) is None
+
+
+def test_cancelled_queued_fit_never_starts(jobs):
+    fit_dir, executor, use, runfile, datafiles = jobs
+    engine = use(lambda engine: {})
+    job_id = fit_jobs.submit_fit(fit_dir, runfile, datafiles)
+    fit_jobs.cancel_job(fit_dir, job_id)
+    executor.run_all()
+    assert fit_jobs.get_job(fit_dir, job_id)['status'] == 'cancelled'
+    assert engine.calls == []
+
+
+def test_cancelling_a_running_fit_stops_its_engine(jobs):
+    fit_dir, executor, use, runfile, datafiles = jobs
+    job_ids = []
+
+    def cancelled_while_running(engine):
+        assert fit_jobs.get_job(fit_dir, job_ids[0])['status'] == 'running'
+        assert fit_jobs.running_jobs() == 1
+        fit_jobs.cancel_job(fit_dir, job_ids[0])
+        assert engine.cancelled
+        raise fit_engine.FitError('Fit cancelled.')
+
+    use(cancelled_while_running)
+    job_ids.append(fit_jobs.submit_fit(fit_dir, runfile, datafiles))
+    executor.run_all()
+    assert fit_jobs.get_job(fit_dir, job_ids[0])['status'] == 'cancelled'
+    # finished jobs ignore further cancellations
+    fit_jobs.cancel_job(fit_dir, job_ids[0])
+    assert fit_jobs.get_job(fit_dir, job_ids[0])['status'] == 'cancelled'
+
+
+def test_jobs_of_a_previous_server_process_are_interrupted(jobs, monkeypatch):
+    fit_dir, executor, use, runfile, datafiles = jobs
+    use(lambda engine: {})
+    job_id = fit_jobs.submit_fit(fit_dir, runfile, datafiles)
+    # a new server process does not know the queued job
+    monkeypatch.setattr(fit_jobs, '_active', {})
+    assert fit_jobs.get_job(fit_dir, job_id)['status'] == 'interrupted'
+    assert [job['job_id'] for job in fit_jobs.list_jobs(fit_dir)] == [job_id]
+
+
+def test_results_cache_keeps_the_most_recently_used_jobs(jobs, monkeypatch):
+    fit_dir, executor, use, runfile, datafiles = jobs
+    monkeypatch.setattr(fit_jobs, 'RESULTS_CACHE_SIZE', 3)
+    for i in range(4):
+        fit_jobs._remember_results('job' + str(i), {'i': i})
+        if i == 1:
+            # a use moves job0 ahead of job1
+            assert fit_jobs.load_results(fit_dir, 'job0') == {'i': 0}
+    assert list(fit_jobs._results) == ['job0', 'job2', 'job3']
+
+
+def test_evicted_results_are_read_from_their_file(jobs):
+    fit_dir, executor, use, runfile, datafiles = jobs
+    use(lambda engine: {'chisq': 2.0})
+    job_id = fit_jobs.submit_fit(fit_dir, runfile, datafiles)
+    executor.run_all()
+    fit_jobs._results.clear()
+    path = fit_jobs.job_dir(fit_dir, job_id) / fit_jobs.JOB_FIT_DIR / fit_jobs.JOB_RESULTS_FILE
+    with open(path, 'rb') as f:
+        assert pickle.load(f) == {'chisq': 2.0}
+    assert fit_jobs.load_results(fit_dir, job_id) == {'chisq': 2.0}
+    assert list(fit_jobs._results) == [job_id]
+    assert fit_jobs.load_results(fit_dir, 'unknown') is None
+
+
+def test_prepare_fit_directory_keeps_listed_entries(tmp_path):
+    fit_dir = tmp_path / 'fit'
+    (fit_dir / 'MCMC').mkdir(parents=True)
+    (fit_dir / 'MCMC' / 'chain.mc').write_text('')
+    (fit_dir / 'old').mkdir()
+    (fit_dir / 'stale.dat').write_text('')
+    (fit_dir / 'notes.txt').write_text('keep')
+    runfile = tmp_path / 'model.py'
+    runfile.write_text('a = 1\n')
+    datafile = tmp_path / 'sample.dat'
+    datafile.write_text('0.1 1.0 0.1 0.01\n')
+
+    fit_jobs.prepare_fit_directory(fit_dir, runfile, [datafile, tmp_path / 'missing.dat'], keep=['MCMC', 'notes.txt'])
+    assert sorted(p.name for p in fit_dir.iterdir()) == ['MCMC', 'model.py', 'notes.txt', 'sample.dat']
+    assert (fit_dir / 'MCMC' / 'chain.mc').is_file()
+    assert (fit_dir / 'notes.txt').read_text() == 'keep'
@@ -0,0 +1,127 @@
+import numpy
+import pandas
+import pytest
+
+pytest.importorskip('streamlit')
+from sans_app.support import ml_serving
+
+
+def _reference(Iq, dI):
+    # the loop of the original implementation
+    background = None
+    for i in range(-5, -30, -1):
+        background_new = numpy.average(Iq[i:])
+        if numpy.abs(Iq[i - 1] - background_new) > 2 * dI[i - 1]:
+            break
+        background = background_new
+    return background
+
+
+def _curves(num, length=60, seed=0):
+    rng = numpy.random.default_rng(seed)
+    Q = numpy.tile(numpy.logspace(-3, -0.5, length), (num, 1))
+    dI = numpy.full((num, length), 0.1)
+    level = rng.uniform(0.5, 2.0, (num, 1))
+    Iq = level + 0.05 * Q ** -1.5 * rng.uniform(0.1, 1.0, (num, 1)) + rng.normal(0, 0.05, (num, length))
+    return Q, Iq, dI
+
+
+def test_auto_background_single_curve_matches_the_loop():
+    Q, Iq, dI = _curves(1)
+    assert ml_serving.auto_background(Q[0], Iq[0], dI[0]) == pytest.approx(_reference(Iq[0], dI[0]))
+
+
+def test_auto_background_many_curves_match_the_loop():
+    Q, Iq, dI = _curves(50, seed=1)
+    background = ml_serving.auto_background(Q, Iq, dI)
+    for i in range(len(Iq)):
+        expected = _reference(Iq[i], dI[i])
+        if expected is None:
+            assert numpy.isnan(background[i])
+        else:
+            assert background[i] == pytest.approx(expected)
+
+
+def test_auto_background_rejects_a_steep_tail():
+    Q = numpy.logspace(-3, -0.5, 40)
+    Iq = Q ** -4
+    dI = 1e-3 * Iq
+    assert ml_serving.auto_background(Q, Iq, dI) is None
+
+
+def test_auto_background_clamps_above_qmax():
+    Q, Iq, dI = _curves(1, seed=2)
+    qmax = Q[0, -20]
+    clamped = numpy.where(Q[0] >= qmax, Iq[0, -20], Iq[0])
+    assert ml_serving.auto_background(Q[0], Iq[0], dI[0], qmax=qmax) == pytest.approx(_reference(clamped, dI[0]))
+
+
+class _Predictor:
+    # stands in for BatchPredictor, the outputs are simple functions of the model input
+    def __init__(self):
+        self.calls = []
+
+    def predict(self, intensities, sup):
+        self.calls.append((intensities, sup))
+        return [intensities[:, :1], intensities[:, 1:2], numpy.column_stack([sup[:, 0], intensities.mean(axis=1)])]
+
+
+def _files(monkeypatch, tmp_path, num=3):
+    # curves with a flat high-Q tail, so that every file has a background
+    rng = numpy.random.default_rng(3)
+    Q = numpy.tile(numpy.logspace(-3, 0, 80), (num, 1))
+    dI = numpy.full((num, 80), 0.1)
+    Iq = rng.uniform(0.5, 2.0, (num, 1)) + 1e-4 * Q ** -2 + rng.normal(0, 0.02, (num, 80))
+    data = {}
+    for i in range(num):
+        data[str(tmp_path / ('s' + str(i) + '.dat'))] = (Q[i], Iq[i], dI[i])
+
+    def read_curve(path):
+        if str(path) not in data:
+            raise IOError('no such file')
+        return data[str(path)]
+
+    monkeypatch.setattr(ml_serving, 'read_curve', read_curve)
+    return list(data), data
+
+
+def test_classify_files_matches_single_file_prediction(monkeypatch, tmp_path):
+    paths, data = _files(monkeypatch, tmp_path)
+    paths.insert(1, str(tmp_path / 'missing.dat'))
+    predictor = _Predictor()
+    df = ml_serving.classify_files(predictor, paths, ['sphere', 'cylinder'], [['radius_sld'], ['length']], 6.4,
+                                   qmin=0.002, qmax=0.2)
+
+    # one forward pass for all loaded files, rows keep the order of the input
+    assert len(predictor.calls) == 1
+    assert list(df['file']) == ['s0.dat', 'missing.dat', 's1.dat', 's2.dat']
+    assert df['error'][1].startswith('OSError')
+    assert numpy.isnan(df['background'][1])
+    for row, path in zip([0, 2, 3], [paths[0], paths[2], paths[3]]):
+        Q, Iq, dI = data[path]
+        background = ml_serving.auto_background(Q, Iq, dI, 0.002, 0.2)
+        assert df['background'][row] == pytest.approx(background)
+        model_input = ml_serving.prepare_input(Q, Iq, background, 0.002, 0.2)
+        assert df['p_cylinder'][row] == pytest.approx(model_input.mean(), rel=1e-5)
+        assert df['p_sphere'][row] == pytest.approx(background, rel=1e-5)
+        # sld parameters are corrected by 0.1 as in format_prediction()
+        assert df['sphere:radius_sld'][row] == pytest.approx(0.1 * model_input[0], rel=1e-5)
+        assert df['cylinder:length'][row] == pytest.approx(model_input[1], rel=1e-5)
+
+
+def test_classify_files_defaults_to_the_full_q_range(monkeypatch, tmp_path):
+    paths, data = _files(monkeypatch, tmp_path, num=2)
+    df = ml_serving.classify_files(_Predictor(), paths, ['sphere', 'cylinder'], [['radius'], ['length']], 6.4)
+    for row, path in enumerate(paths):
+        Q, Iq, dI = data[path]
+        assert df['background'][row] == pytest.approx(ml_serving.auto_background(Q, Iq, dI))
+
+
+def test_write_results(tmp_path):
+    df = pandas.DataFrame({'file': ['a.dat', 'b.dat'], 'p_sphere': [0.25, 0.75]})
+    written = ml_serving.write_results(df, tmp_path / 'predictions')
+    assert written[0] == tmp_path / 'predictions.csv'
+    pandas.testing.assert_frame_equal(pandas.read_csv(written[0]), df)
+    assert all(path.is_file() for path in written)
+    if len(written) > 1:
+        pandas.testing.assert_frame_equal(pandas.read_parquet(written[1]), df)
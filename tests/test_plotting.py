@@ -0,0 +1,39 @@
+import numpy
+import pandas
+
+from sans_app.support import plotting
+
+
+def test_decimate_keeps_small_datasets_sorted_without_nonpositive_q():
+    Q = numpy.array([0.3, 0.1, 0.0, 0.2, -0.1])
+    numpy.testing.assert_array_equal(plotting.decimate(Q, max_points=10), [1, 3, 0])
+
+
+def test_decimate_limits_points_evenly_in_log_q():
+    Q = numpy.geomspace(1e-3, 1.0, 10000)
+    keep = plotting.decimate(Q, max_points=100)
+    assert 90 <= len(keep) <= 100
+    assert keep[0] == 0
+    assert numpy.all(numpy.diff(keep) > 0)
+    # at most one point per bin of the log(Q) grid, so the spacing is close to uniform
+    spacing = numpy.diff(numpy.log10(Q[keep]))
+    assert spacing.max() < 2.5 * (3.0 / 100)
+
+
+def test_decimate_unsorted_input():
+    Q = numpy.geomspace(1e-3, 1.0, 2000)
+    rng = numpy.random.default_rng(0)
+    shuffled = rng.permutation(Q)
+    keep = plotting.decimate(shuffled, max_points=50)
+    assert numpy.all(numpy.diff(shuffled[keep]) > 0)
+    assert len(keep) <= 50
+
+
+def test_dataset_traces_are_cached_by_content():
+    df = pandas.DataFrame({'Q': [0.01, 0.02], 'I': [2.0, 0.0], 'dI': [0.2, 0.1], 'dQ': [0.001, 0.002]})
+    traces = plotting.dataset_traces(df, 'sample')
+    assert plotting.dataset_traces(df.copy(), 'sample') is traces
+    numpy.testing.assert_allclose(traces['dI/I']['y'], [0.1, 0.0])
+    numpy.testing.assert_allclose(traces['dQ/Q']['y'], [0.1, 0.1])
+    df.loc[0, 'I'] = 3.0
+    assert plotting.dataset_traces(df, 'sample')['key'] != traces['key']
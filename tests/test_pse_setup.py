@@ -0,0 +1,67 @@
+import pandas
+
+from sans_app.support import pse_setup
+
+
+def _config(values, shared=(False, False, False)):
+    return pandas.DataFrame({'value': list(values), 'shared': list(shared), 'optimize': [False] * 3},
+                            index=pandas.Index(['time', 'distance', 'wavelength'], name='setting'))
+
+
+def test_propagate_shared_copies_shared_rows():
+    configs = [_config([60, 1.0, 6.0], shared=(True, False, True)), _config([10, 4.0, 8.0]),
+               _config([20, 13.0, 8.0])]
+    originals = [df.copy() for df in configs]
+    assert pse_setup.propagate_shared(configs, originals) == [1, 2]
+    for df in configs[1:]:
+        assert df.loc['time', 'value'] == 60
+        assert df.loc['wavelength', 'value'] == 6.0
+        assert bool(df.loc['time', 'shared'])
+    assert [df.loc['distance', 'value'] for df in configs] == [1.0, 4.0, 13.0]
+    # the loaded tables are not touched
+    assert originals[1].loc['time', 'value'] == 10
+    # nothing left to do
+    assert pse_setup.propagate_shared(configs, originals) == []
+
+
+def test_propagate_shared_restores_unshared_rows():
+    originals = [_config([60, 1.0, 6.0]), _config([10, 4.0, 8.0])]
+    configs = [_config([60, 1.0, 6.0], shared=(True, False, False)), originals[1].copy()]
+    pse_setup.propagate_shared(configs, originals)
+    assert configs[1].loc['time', 'value'] == 60
+
+    configs[0].loc['time', 'shared'] = False
+    assert pse_setup.propagate_shared(configs, originals) == [1]
+    assert configs[1].loc['time', 'value'] == 10
+    assert not configs[1].loc['time', 'shared']
+
+
+def test_propagate_shared_only_updates_targets():
+    configs = [_config([60, 1.0, 6.0], shared=(True, True, True)), _config([10, 4.0, 8.0]),
+               _config([20, 13.0, 8.0])]
+    originals = [df.copy() for df in configs]
+    assert pse_setup.propagate_shared(configs, originals, targets=[2]) == [2]
+    assert configs[1].loc['time', 'value'] == 10
+    assert configs[2].loc['time', 'value'] == 60
+
+
+def test_propagate_shared_needs_two_configurations_and_a_shared_column():
+    configs = [_config([60, 1.0, 6.0], shared=(True, True, True))]
+    assert pse_setup.propagate_shared(configs, configs) == []
+    configs = [_config([60, 1.0, 6.0]).drop(columns='shared'), _config([10, 4.0, 8.0])]
+    assert pse_setup.propagate_shared(configs, configs) == []
+
+
+def test_setup_tracker_rebuilds_only_on_changed_inputs():
+    tracker = pse_setup.SetupTracker()
+    df = _config([60, 1.0, 6.0])
+    calls = []
+
+    def build():
+        calls.append(1)
+        return len(calls)
+
+    assert tracker.derive('key', build, df) == (1, True)
+    assert tracker.derive('key', build, df.copy()) == (1, False)
+    df.loc['time', 'value'] = 61
+    assert tracker.derive('key', build, df) == (2, True)
@@ -0,0 +1,133 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import numpy
+import pandas
+import pytest
+
+from sans_app.support import simulation
+
+
+class _Problem:
+    # the part of a bumps FitProblem used by the simulation; each model's intensity is a function of the parameters
+    def __init__(self, labels, p):
+        self._labels = list(labels)
+        self.p = numpy.asarray(p, dtype=float)
+        self.models = [SimpleNamespace(model=_Model(self, d)) for d in range(2)]
+
+    def labels(self):
+        return self._labels
+
+    def getp(self):
+        return self.p.copy()
+
+    def setp(self, p):
+        self.p = numpy.asarray(p, dtype=float).copy()
+
+
+class _Model:
+    def __init__(self, problem, d):
+        self.problem = problem
+        self.sasmodel = SimpleNamespace(make_kernel=lambda q: SimpleNamespace(q=q[0], d=d, release=lambda: None))
+
+    def state(self):
+        return self.problem
+
+
+def _call_kernel(kernel, problem):
+    # a thread switch between setting and reading the parameters exposes unguarded evaluations
+    time.sleep(0.0005)
+    return (kernel.d + 1) * problem.p.sum() * numpy.ones_like(kernel.q)
+
+
+def _dataset(n, offset=0.0):
+    Q = numpy.linspace(0.01, 0.5, n)
+    return pandas.DataFrame({'Q': Q, 'I': 1.0 / Q + offset, 'dI': 0.1 * numpy.ones(n), 'dQ': 0.05 * Q})
+
+
+def test_parameter_matrix_fills_missing_parameters_from_the_problem():
+    problem = _Problem(['a', 'b', 'c'], [1.0, 2.0, 3.0])
+    p = simulation.parameter_matrix(problem, pandas.DataFrame({'c': [4.0, 5.0], 'a': [6, 7]}))
+    numpy.testing.assert_array_equal(p, [[6.0, 2.0, 4.0], [7.0, 2.0, 5.0]])
+    with pytest.raises(KeyError):
+        simulation.parameter_matrix(problem, pandas.DataFrame({'d': [1.0]}))
+
+
+def test_simpar_to_parameter_sets():
+    simpar = pandas.DataFrame({'par': ['a', 'b'], 'value': ['1.5', 2]})
+    parameter_sets = simulation.simpar_to_parameter_sets(simpar)
+    assert parameter_sets.to_dict('records') == [{'a': 1.5, 'b': 2.0}]
+    problem = _Problem(['a', 'b', 'c'], [0.0, 0.0, 3.0])
+    numpy.testing.assert_array_equal(simulation.parameter_matrix(problem, parameter_sets), [[1.5, 2.0, 3.0]])
+
+
+def test_pack_and_unpack_datasets_round_trip():
+    datasets = [_dataset(5), _dataset(8, offset=1.0)]
+    unpacked = simulation.unpack_datasets(simulation.pack_datasets(datasets))
+    assert len(unpacked) == 2
+    for df, expected in zip(unpacked, datasets):
+        pandas.testing.assert_frame_equal(df, expected[['Q', 'I', 'dI', 'dQ']])
+
+
+def test_simulation_key(tmp_path):
+    runfile = tmp_path / 'model.py'
+    runfile.write_text('a = 1\n')
+    simpar = pandas.DataFrame({'par': ['a'], 'value': [1.0]})
+    configurations = [{'time': 60, 'sdd': 4}]
+    key = simulation.simulation_key(runfile, simpar, configurations, 0.01, 0.5, True, 1)
+    assert key == simulation.simulation_key(runfile, simpar.copy(), [{'sdd': 4, 'time': 60}], 0.01, 0.5, True, 1)
+    assert key != simulation.simulation_key(runfile, simpar, configurations, 0.01, 0.5, False, 1)
+    assert key != simulation.simulation_key(runfile, simpar.assign(value=2.0), configurations, 0.01, 0.5, True, 1)
+    # a changed model script invalidates its simulations
+    runfile.write_text('a = 2\n')
+    assert key != simulation.simulation_key(runfile, simpar, configurations, 0.01, 0.5, True, 1)
+
+
+def test_instrument_templates_rescale_cached_uncertainties(monkeypatch):
+    monkeypatch.setattr(simulation, 'template_cache', simulation.caching.ArrayCache())
+    calls = []
+
+    def fnSimulateData(basefilename, liConfigurations, qmin, qmax, t_total, simpar, average):
+        calls.append(liConfigurations)
+        return [('sim' + str(i) + '.dat', _dataset(6)) for i in range(len(liConfigurations))]
+
+    fitobj = SimpleNamespace(fnSimulateData=fnSimulateData)
+    simpar = pandas.DataFrame({'par': ['a'], 'value': [1.0]})
+    short = [[{'sdd': 4, 'time': 100}], [{'sdd': 1, 'time': 100}]]
+    long = [[{'sdd': 4, 'time': 400}], [{'sdd': 1, 'time': 25}]]
+    first = simulation.instrument_templates(fitobj, [short], 0.01, 0.5, simpar, model_key='m')
+    second = simulation.instrument_templates(fitobj, [long], 0.01, 0.5, simpar, model_key='m')
+    # only the geometry decides about a new simulation
+    assert len(calls) == 1
+    numpy.testing.assert_allclose(second[0][0]['dI'], first[0][0]['dI'] / 2)
+    numpy.testing.assert_allclose(second[0][1]['dI'], first[0][1]['dI'] * 2)
+    numpy.testing.assert_array_equal(second[0][0]['Q'], first[0][0]['Q'])
+    assert second[0][0]['I'].isna().all()
+
+    # without a model key, every call simulates and keeps the intensities
+    uncached = simulation.instrument_templates(fitobj, [short], 0.01, 0.5, simpar)
+    assert len(calls) == 2
+    assert not uncached[0][0]['I'].isna().any()
+
+
+def test_evaluate_theory_holds_the_problem_across_sessions(monkeypatch):
+    monkeypatch.setattr(simulation, 'direct_model', SimpleNamespace(call_kernel=_call_kernel))
+    problem = _Problem(['a', 'b'], [1.0, 1.0])
+    resolutions = [SimpleNamespace(q=numpy.ones(3), q_calc=numpy.ones(3), apply=lambda Iq: Iq)]
+    stacks = [numpy.full((20, 2), float(k)) for k in range(4)]
+    results = [None] * len(stacks)
+
+    def session(k):
+        results[k] = simulation.evaluate_theory(problem, resolutions, stacks[k])
+
+    threads = [threading.Thread(target=session, args=(k,)) for k in range(len(stacks))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # every session sees its own parameters, and the problem is restored afterwards
+    for k, theory in enumerate(results):
+        numpy.testing.assert_array_equal(theory[0], numpy.full((20, 3), 2.0 * k))
+    numpy.testing.assert_array_equal(problem.getp(), [1.0, 1.0])
+    assert simulation.problem_lock(problem) is simulation.problem_lock(problem)
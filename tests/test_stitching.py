@@ -0,0 +1,95 @@
+import numpy
+import pandas
+import pytest
+
+from sans_app.support import stitching
+
+
+def _dataset(Q, I=1.0, dI=0.1, dQ=0.0):
+    Q = numpy.asarray(Q, dtype=float)
+    return {'Q': Q, 'I': numpy.full_like(Q, I), 'dI': numpy.full_like(Q, dI), 'dQ': numpy.full_like(Q, dQ)}
+
+
+def test_rebin_weights_by_inverse_variance():
+    dataset = {'Q': numpy.array([1.0, 1.5, 3.0]), 'I': numpy.array([1.0, 3.0, 5.0]),
+               'dI': numpy.array([1.0, 1.0, 0.0]), 'dQ': numpy.array([0.1, 0.1, 0.2])}
+    result = stitching.rebin(dataset, numpy.array([0.5, 2.0, 2.5, 4.0]))
+    # the empty middle bin is dropped
+    numpy.testing.assert_allclose(result['Q'], [1.25, 3.0])
+    numpy.testing.assert_allclose(result['I'], [2.0, 5.0])
+    # a bin without uncertainties falls back to the plain mean with dI = 0
+    numpy.testing.assert_allclose(result['dI'], [numpy.sqrt(0.5), 0.0])
+    numpy.testing.assert_allclose(result['dQ'], [0.1, 0.2])
+
+
+def test_rebin_prefers_points_with_uncertainty():
+    dataset = {'Q': numpy.array([1.0, 1.5]), 'I': numpy.array([1.0, 100.0]), 'dI': numpy.array([0.5, 0.0]),
+               'dQ': numpy.zeros(2)}
+    result = stitching.rebin(dataset, numpy.array([0.5, 2.0]))
+    numpy.testing.assert_allclose(result['I'], [1.0])
+    numpy.testing.assert_allclose(result['dI'], [0.5])
+
+
+def test_rebin_handles_rows_of_intensities():
+    Q = numpy.array([1.0, 1.5, 3.0])
+    dataset = {'Q': Q, 'I': numpy.array([[1.0, 3.0, 5.0], [2.0, 2.0, 2.0]]), 'dI': numpy.ones((2, 3)),
+               'dQ': numpy.zeros(3)}
+    result = stitching.rebin(dataset, numpy.array([0.5, 2.0, 4.0]))
+    numpy.testing.assert_allclose(result['I'], [[2.0, 5.0], [2.0, 2.0]])
+    for row in range(2):
+        single = stitching.rebin(dict(dataset, I=dataset['I'][row], dI=dataset['dI'][row]),
+                                 numpy.array([0.5, 2.0, 4.0]))
+        numpy.testing.assert_allclose(result['I'][row], single['I'])
+        numpy.testing.assert_allclose(result['dI'][row], single['dI'])
+
+
+def test_trim_overlap_splits_at_the_geometric_center():
+    low = _dataset(numpy.geomspace(0.01, 0.1, 11), I=1.0)
+    high = _dataset(numpy.geomspace(0.04, 0.4, 11), I=2.0)
+    split = numpy.sqrt(0.04 * 0.1)
+    # the order of the datasets does not matter
+    merged = stitching.trim_overlap([high, low])
+    assert numpy.all(numpy.diff(merged['Q']) >= 0)
+    numpy.testing.assert_array_equal(merged['I'], numpy.where(merged['Q'] < split, 1.0, 2.0))
+    expected = numpy.sum(low['Q'] < split) + numpy.sum(high['Q'] >= split)
+    assert len(merged['Q']) == expected
+
+
+def test_overlap_limits_of_disjoint_ranges_split_the_gap():
+    limits = stitching.overlap_limits([_dataset([0.01, 0.02]), _dataset([0.08, 0.1])])
+    assert limits[0, 1] == pytest.approx(numpy.sqrt(0.02 * 0.08))
+    assert limits[1, 0] == limits[0, 1]
+    assert limits[0, 0] == -numpy.inf and limits[1, 1] == numpy.inf
+
+
+def test_stitch_average_covers_all_points():
+    low = _dataset(numpy.geomspace(0.01, 0.1, 30), I=1.0)
+    high = _dataset(numpy.geomspace(0.04, 0.4, 30), I=1.0)
+    merged = stitching.stitch([low, high], mode='average', points_per_decade=10)
+    assert len(merged['Q']) <= 17
+    numpy.testing.assert_allclose(merged['I'], 1.0)
+    assert merged['Q'].min() >= 0.01 and merged['Q'].max() <= 0.4
+
+
+def test_stitch_frames_and_errors():
+    frame = pandas.DataFrame(_dataset([0.01, 0.02, 0.03]))
+    df = stitching.stitch_frames([frame])
+    assert list(df.columns) == list(stitching.COLUMNS)
+    pandas.testing.assert_frame_equal(df, frame)
+    with pytest.raises(ValueError):
+        stitching.stitch([frame, frame], mode='median')
+
+
+def test_stitch_batches_stitches_per_dataset():
+    Q1, Q2 = numpy.geomspace(0.01, 0.1, 5), numpy.geomspace(0.05, 0.5, 5)
+
+    def batch(Q, value):
+        # two datasets of three parameter sets each
+        return [{'Q': Q, 'I': numpy.full((3, len(Q)), value + d), 'dI': numpy.ones((3, len(Q))),
+                 'dQ': numpy.zeros(len(Q))} for d in range(2)]
+
+    result = stitching.stitch_batches([batch(Q1, 0.0), batch(Q2, 10.0)])
+    assert len(result) == 2
+    for d, merged in enumerate(result):
+        assert merged['I'].shape == (3, len(merged['Q']))
+        assert set(numpy.unique(merged['I'])) == {d, 10.0 + d}
@@ -0,0 +1,55 @@
+import json
+
+import numpy
+import pytest
+
+from sans_app.support import warm_start
+
+LABELS = ['a', 'b']
+
+
+def _save(store, model, data, best, saved, labels=LABELS):
+    warm_start.save(store, model, data, labels, best)
+    # order results by an explicit save time instead of the clock
+    path = store / (warm_start._name(model, data) + '.json')
+    meta = json.loads(path.read_text())
+    meta['saved'] = saved
+    path.write_text(json.dumps(meta))
+
+
+def test_find_prefers_exact_then_model_then_data_then_labels(tmp_path):
+    _save(tmp_path, 'm0', 'd0', [0, 0], saved=5)
+    assert warm_start.find(tmp_path, 'm1', 'd1', LABELS)['match'] == 'labels'
+    _save(tmp_path, 'm0', 'd1', [1, 1], saved=4)
+    assert warm_start.find(tmp_path, 'm1', 'd1', LABELS)['match'] == 'data'
+    _save(tmp_path, 'm1', 'd0', [2, 2], saved=3)
+    assert warm_start.find(tmp_path, 'm1', 'd1', LABELS)['match'] == 'model'
+    _save(tmp_path, 'm1', 'd1', [3, 3], saved=2)
+    seed = warm_start.find(tmp_path, 'm1', 'd1', LABELS)
+    assert seed['match'] == 'exact'
+    numpy.testing.assert_array_equal(seed['best'], [3, 3])
+
+
+def test_find_takes_the_most_recent_among_equals(tmp_path):
+    _save(tmp_path, 'm0', 'd0', [0, 0], saved=1)
+    _save(tmp_path, 'm0', 'd1', [1, 1], saved=2)
+    seed = warm_start.find(tmp_path, 'm0', 'd2', LABELS)
+    assert seed['match'] == 'model'
+    numpy.testing.assert_array_equal(seed['best'], [1, 1])
+
+
+def test_find_requires_the_same_labels(tmp_path):
+    _save(tmp_path, 'm0', 'd0', [0, 0, 0], saved=1, labels=['a', 'b', 'c'])
+    assert warm_start.find(tmp_path, 'm0', 'd0', LABELS) is None
+
+
+def test_find_skips_results_without_arrays(tmp_path):
+    _save(tmp_path, 'm0', 'd0', [0, 0], saved=1)
+    _save(tmp_path, 'm0', 'd1', [1, 1], saved=2)
+    (tmp_path / (warm_start._name('m0', 'd1') + '.npz')).unlink()
+    numpy.testing.assert_array_equal(warm_start.find(tmp_path, 'm0', 'd1', LABELS)['best'], [0, 0])
+
+
+@pytest.mark.parametrize('match, burn', [('exact', 250), ('model', 250), ('data', 250), ('labels', 1000)])
+def test_warm_burn_requires_a_model_or_data_match(match, burn):
+    assert warm_start.warm_burn(1000, match) == burn